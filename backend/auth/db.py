@@ -0,0 +1,184 @@
+'''
+Business: Pooled Postgres connections reused across warm invocations
+Args: DATABASE_URL, optional DB_POOL_SIZE and DB_HEALTH_CHECK_AFTER env vars
+Returns: psycopg2 connections via get_connection / release_connection, instrumented while metrics are on
+
+Identical copies live in every backend function directory because each
+function is deployed on its own; change them together.
+'''
+
+import os
+import select
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Set, Tuple
+
+import psycopg2
+import psycopg2.extensions
+
+import metrics
+
+POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '4'))
+HEALTH_CHECK_AFTER = float(os.environ.get('DB_HEALTH_CHECK_AFTER', '30'))
+ACQUIRE_TIMEOUT = float(os.environ.get('DB_ACQUIRE_TIMEOUT', '10'))
+# A long-poll keeps its pooled connection while it waits; fewer waiters
+# than connections leaves room for every other request of the instance
+MAX_WAITERS = int(os.environ.get('DB_MAX_WAITERS', str(max(POOL_SIZE - 1, 0))))
+
+_idle: List[Tuple[psycopg2.extensions.connection, float]] = []
+_in_use = 0
+_available = threading.Condition()
+_waiters = threading.Semaphore(MAX_WAITERS)
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class Connection(psycopg2.extensions.connection):
+    '''Pooled connection that remembers which statements it has PREPAREd.'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared: Set[str] = set()
+
+
+def _is_healthy(conn: psycopg2.extensions.connection, idle_since: float) -> bool:
+    if conn.closed:
+        return False
+    if time.monotonic() - idle_since < HEALTH_CHECK_AFTER:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+def _discard(conn: psycopg2.extensions.connection) -> None:
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+def get_connection() -> psycopg2.extensions.connection:
+    '''Check out a connection, reusing an idle one when it is still alive.'''
+    with metrics.phase('connect'):
+        conn = _checkout()
+    metrics.attach(conn)
+    return conn
+
+
+def _checkout() -> psycopg2.extensions.connection:
+    global _in_use
+    deadline = time.monotonic() + ACQUIRE_TIMEOUT
+    with _available:
+        while not _idle and _in_use >= POOL_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PoolExhausted(f'no free connection within {ACQUIRE_TIMEOUT}s')
+            _available.wait(remaining)
+        candidate = _idle.pop() if _idle else None
+        _in_use += 1
+
+    try:
+        if candidate is not None:
+            conn, idle_since = candidate
+            if _is_healthy(conn, idle_since):
+                return conn
+            _discard(conn)
+        return psycopg2.connect(os.environ['DATABASE_URL'], connection_factory=Connection)
+    except Exception:
+        with _available:
+            _in_use -= 1
+            _available.notify()
+        raise
+
+
+def release_connection(conn: psycopg2.extensions.connection) -> None:
+    '''Return a connection to the pool, rolling back any open transaction.
+
+    Broken connections are dropped; the next checkout reconnects.
+    '''
+    global _in_use
+    if not conn.closed:
+        try:
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except psycopg2.Error:
+            _discard(conn)
+
+    with _available:
+        _in_use -= 1
+        if not conn.closed and len(_idle) < POOL_SIZE:
+            _idle.append((conn, time.monotonic()))
+        else:
+            _discard(conn)
+        _available.notify()
+
+
+def close_idle() -> None:
+    '''Close every idle connection, e.g. before the container is frozen.'''
+    with _available:
+        while _idle:
+            _discard(_idle.pop()[0])
+
+
+@contextmanager
+def listening(conn: psycopg2.extensions.connection, *channels: str) -> Iterator[None]:
+    '''LISTEN on channels for the duration of the block.
+
+    Channels are UNLISTENed afterwards so a pooled connection never carries
+    subscriptions into the next invocation.
+    '''
+    with conn.cursor() as cur:
+        for channel in channels:
+            cur.execute(f'LISTEN "{channel}"')
+    conn.commit()
+    try:
+        yield
+    finally:
+        if not conn.closed:
+            try:
+                conn.rollback()
+                with conn.cursor() as cur:
+                    cur.execute('UNLISTEN *')
+                conn.commit()
+                del conn.notifies[:]
+            except psycopg2.Error:
+                _discard(conn)
+
+
+@contextmanager
+def waiter() -> Iterator[bool]:
+    '''A long-poll slot: yields whether the request may wait for a NOTIFY.
+
+    At most MAX_WAITERS requests per instance hold one; the others should
+    answer at once and let the client retry after a pause.
+    '''
+    admitted = _waiters.acquire(blocking=False)
+    try:
+        yield admitted
+    finally:
+        if admitted:
+            _waiters.release()
+
+
+def wait_for_notify(conn: psycopg2.extensions.connection, timeout: float) -> bool:
+    '''Block until a NOTIFY arrives on a listened channel or timeout passes.'''
+    # Notifications are only delivered between transactions
+    conn.rollback()
+    deadline = time.monotonic() + timeout
+    with metrics.phase('wait'):
+        while not conn.notifies:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if select.select([conn], [], [], remaining) != ([], [], []):
+                conn.poll()
+    del conn.notifies[:]
+    return True
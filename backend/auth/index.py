@@ -1,14 +1,26 @@
 '''
-Business: User authentication - registration and login
-Args: event with httpMethod, body (username, password, nickname for registration)
-Returns: HTTP response with user data or error
+Business: User authentication - registration, login and logout
+Args: event with httpMethod, body (username, password, nickname for registration); logout needs the session token
+Returns: HTTP response with user data and a session token, or error
 '''
 
 import json
-import os
-import psycopg2
 from typing import Dict, Any
 
+import db
+import metrics
+import session
+
+_unknown_user_hash = None
+
+def unknown_user_hash() -> str:
+    '''Checked when the username is unknown, so a miss costs as much as a wrong password.'''
+    global _unknown_user_hash
+    if _unknown_user_hash is None:
+        _unknown_user_hash = session.hash_password('')
+    return _unknown_user_hash
+
+@metrics.instrument('auth')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
@@ -19,7 +31,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
@@ -34,6 +46,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     body_data = json.loads(event.get('body', '{}'))
     action = body_data.get('action')
+    
+    if action == 'logout':
+        return logout(event)
+    
     username = body_data.get('username', '').strip()
     password = body_data.get('password', '')
     
@@ -45,7 +61,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'body': json.dumps({'error': 'Username must contain only a-z, A-Z, 0-9'})
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = db.get_connection()
     cur = conn.cursor()
     
     try:
@@ -70,8 +86,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             # Create user
             cur.execute(
-                "INSERT INTO users (username, password, nickname) VALUES (%s, %s, %s) RETURNING id, username, nickname, avatar, theme",
-                (username, password, nickname)
+                "INSERT INTO users (username, password, nickname) VALUES (%s, %s, %s) RETURNING id, username, nickname, avatar, theme, session_epoch",
+                (username, session.hash_password(password), nickname)
             )
             user = cur.fetchone()
             conn.commit()
@@ -84,24 +100,31 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'username': user[1],
                     'nickname': user[2],
                     'avatar': user[3],
-                    'theme': user[4]
+                    'theme': user[4],
+                    'token': session.issue(user[0], user[5])
                 })
             }
         
         elif action == 'login':
             cur.execute(
-                "SELECT id, username, nickname, avatar, theme FROM users WHERE username = %s AND password = %s",
-                (username, password)
+                "SELECT id, username, nickname, avatar, theme, session_epoch, password FROM users WHERE username = %s AND deleted_at IS NULL",
+                (username,)
             )
             user = cur.fetchone()
+            matches, needs_rehash = session.check_password(password, user[6] if user else unknown_user_hash())
             
-            if not user:
+            if not user or not matches:
                 return {
                     'statusCode': 401,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                     'body': json.dumps({'error': 'Invalid credentials'})
                 }
             
+            # Plaintext and weaker hashes are replaced on the first login after the upgrade
+            if needs_rehash:
+                cur.execute("UPDATE users SET password = %s WHERE id = %s", (session.hash_password(password), user[0]))
+                conn.commit()
+            
             return {
                 'statusCode': 200,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
@@ -110,7 +133,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'username': user[1],
                     'nickname': user[2],
                     'avatar': user[3],
-                    'theme': user[4]
+                    'theme': user[4],
+                    'token': session.issue(user[0], user[5])
                 })
             }
         
@@ -123,4 +147,27 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     finally:
         cur.close()
-        conn.close()
+        db.release_connection(conn)
+
+def logout(event: Dict[str, Any]) -> Dict[str, Any]:
+    '''Revoke every session of the token's user.'''
+    conn = db.get_connection()
+    cur = conn.cursor()
+    
+    try:
+        user_id = session.authenticate(event, cur)
+        if user_id is None:
+            return session.unauthorized()
+        
+        session.revoke(cur, user_id)
+        conn.commit()
+        
+        return {
+            'statusCode': 200,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': True})
+        }
+    
+    finally:
+        cur.close()
+        db.release_connection(conn)
@@ -0,0 +1,108 @@
+'''
+Business: Batch reads - run several GET operations in one round trip
+Args: event with httpMethod, body {requests: [{id, op, params, etag}]}; op is messages, search, chats, participants or profile
+Returns: HTTP response with one result (id, status, etag, body) per request, in order
+'''
+
+import json
+from typing import Dict, Any
+
+import db
+import metrics
+import reads
+import session
+
+MAX_REQUESTS = 10
+
+OPERATIONS = {
+    'messages': lambda conn, cur, params, etag: reads.messages(conn, cur, params, etag),
+    'search': lambda conn, cur, params, etag: reads.search(cur, params),
+    'chats': lambda conn, cur, params, etag: reads.chats(conn, cur, params, etag),
+    'participants': lambda conn, cur, params, etag: reads.participants(cur, params, etag),
+    'profile': lambda conn, cur, params, etag: reads.profile(cur, params, etag),
+}
+
+def run(conn, cur, session_user: int, request: Dict[str, Any]) -> reads.Reply:
+    '''One entry of the batch; a malformed one gets a 400 of its own.'''
+    op = request.get('op')
+    operation = OPERATIONS.get(op) if isinstance(op, str) else None
+    params = request.get('params') or {}
+    etag = request.get('etag') or ''
+
+    if operation is None:
+        return reads.Reply(400, {'error': 'Unknown op'})
+    if not isinstance(params, dict) or not isinstance(etag, str):
+        return reads.Reply(400, {'error': 'params must be an object and etag a string'})
+
+    # Long-polling would end the snapshot and hold the whole batch
+    params = {key: value for key, value in params.items() if key != 'wait'}
+    if not session.claim(params, session_user, 'user_id'):
+        return reads.Reply(403, {'error': 'Forbidden'})
+    return operation(conn, cur, params, etag)
+
+@metrics.instrument('batch')
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'POST')
+
+    # Handle CORS OPTIONS
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': ''
+        }
+
+    if method != 'POST':
+        return reads.to_response(reads.Reply(405, {'error': 'Method not allowed'}))
+
+    try:
+        body_data = json.loads(event.get('body') or '{}')
+    except ValueError:
+        return reads.to_response(reads.Reply(400, {'error': 'Body must be JSON'}))
+    if not isinstance(body_data, dict):
+        return reads.to_response(reads.Reply(400, {'error': 'Body must be an object'}))
+    requests = body_data.get('requests')
+
+    if not isinstance(requests, list) or not requests:
+        return reads.to_response(reads.Reply(400, {'error': 'requests required'}))
+    if len(requests) > MAX_REQUESTS:
+        return reads.to_response(reads.Reply(400, {'error': f'At most {MAX_REQUESTS} requests per batch'}))
+
+    conn = db.get_connection()
+    cur = conn.cursor()
+
+    try:
+        session_user = session.authenticate(event, cur)
+        if session_user is None:
+            return session.unauthorized()
+
+        # One read-only snapshot for every operation, so the chat list,
+        # history and participants agree with each other
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+
+        results = []
+        for index, request in enumerate(requests):
+            # A malformed entry fails on its own instead of failing the batch
+            if not isinstance(request, dict):
+                request_id, reply = index, reads.Reply(400, {'error': 'Each request must be an object'})
+            else:
+                request_id = request.get('id', index)
+                reply = run(conn, cur, session_user, request)
+
+            results.append({
+                'id': request_id,
+                'status': reply.status,
+                'etag': reply.etag,
+                'body': reply.payload
+            })
+
+        return reads.to_response(reads.Reply(200, {'results': results}), event)
+
+    finally:
+        cur.close()
+        db.release_connection(conn)
@@ -0,0 +1,158 @@
+'''
+Business: Sessions - signed expiring bearer tokens, a revocation cache and salted password hashes
+Args: SESSION_SECRET (required), SESSION_TTL_DAYS (default 30), SESSION_REVOCATION_TTL seconds (default 60)
+Returns: the authenticated user id of a request, tokens for login and register, password hashes
+
+A token is "<user id>.<session epoch>.<expiry>.<HMAC-SHA256>". Checking it
+is CPU only; the only database read is the user's current session epoch,
+cached per warm instance for SESSION_REVOCATION_TTL seconds. Bumping the
+epoch (logout, account deletion) revokes every token issued before it.
+
+Identical copies live in every backend function directory because each
+function is deployed on its own; change them together.
+'''
+
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+TOKEN_TTL = int(float(os.environ.get('SESSION_TTL_DAYS', '30')) * 86400)
+REVOCATION_TTL = float(os.environ.get('SESSION_REVOCATION_TTL', '60'))
+REVOCATION_CACHE_SIZE = 10000
+
+PASSWORD_SCHEME = 'pbkdf2_sha256'
+PASSWORD_ITERATIONS = 600000
+
+# user id -> (current session epoch, or None for a deleted user; fetched at)
+_epochs: 'OrderedDict[int, Tuple[Optional[int], float]]' = OrderedDict()
+_epochs_lock = threading.Lock()
+
+
+def _sign(payload: str) -> str:
+    digest = hmac.new(os.environ['SESSION_SECRET'].encode('utf-8'), payload.encode('utf-8'), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+
+def issue(user_id: int, epoch: int) -> str:
+    payload = f'{user_id}.{epoch}.{int(time.time()) + TOKEN_TTL}'
+    return f'{payload}.{_sign(payload)}'
+
+
+def verify(token: str) -> Optional[Tuple[int, int]]:
+    '''(user id, session epoch) of a well-formed, correctly signed, unexpired token.'''
+    payload, _, signature = token.rpartition('.')
+    if not payload or not hmac.compare_digest(signature.encode('utf-8'), _sign(payload).encode('ascii')):
+        return None
+    try:
+        user_id, epoch, expires = (int(part) for part in payload.split('.'))
+    except ValueError:
+        return None
+    if expires < time.time():
+        return None
+    return user_id, epoch
+
+
+def bearer_token(event: Dict[str, Any]) -> str:
+    for name, value in (event.get('headers') or {}).items():
+        if name.lower() == 'authorization' and value and value[:7].lower() == 'bearer ':
+            return value[7:].strip()
+    return ''
+
+
+def current_epoch(cur, user_id: int) -> Optional[int]:
+    '''The user's session epoch, from the cache while it is fresh.'''
+    now = time.monotonic()
+    with _epochs_lock:
+        cached = _epochs.get(user_id)
+        if cached is not None and now - cached[1] < REVOCATION_TTL:
+            _epochs.move_to_end(user_id)
+            return cached[0]
+
+    cur.execute("SELECT session_epoch FROM users WHERE id = %s", (user_id,))
+    row = cur.fetchone()
+    # End the lookup's transaction so the caller starts its own, e.g. the
+    # batch endpoint's read-only snapshot
+    cur.connection.rollback()
+    epoch = row[0] if row else None
+
+    with _epochs_lock:
+        _epochs[user_id] = (epoch, now)
+        _epochs.move_to_end(user_id)
+        while len(_epochs) > REVOCATION_CACHE_SIZE:
+            _epochs.popitem(last=False)
+    return epoch
+
+
+def authenticate(event: Dict[str, Any], cur) -> Optional[int]:
+    '''The user id a request's bearer token proves, or None.'''
+    claims = verify(bearer_token(event))
+    if claims is None:
+        return None
+    user_id, epoch = claims
+    return user_id if current_epoch(cur, user_id) == epoch else None
+
+
+def revoke(cur, user_id: int) -> None:
+    '''Invalidate every token of the user; other warm instances notice within REVOCATION_TTL.'''
+    cur.execute("UPDATE users SET session_epoch = session_epoch + 1 WHERE id = %s", (user_id,))
+    with _epochs_lock:
+        _epochs.pop(user_id, None)
+
+
+def claim(values: Dict[str, Any], user_id: int, *keys: str) -> bool:
+    '''Bind the identity fields of a request to the session user.
+
+    Missing fields are filled in; a field naming anyone else fails.
+    '''
+    for key in keys:
+        claimed = values.get(key)
+        if claimed not in (None, '') and str(claimed) != str(user_id):
+            return False
+        values[key] = user_id
+    return True
+
+
+def unauthorized() -> Dict[str, Any]:
+    return {
+        'statusCode': 401,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'error': 'Authentication required'}),
+        'isBase64Encoded': False
+    }
+
+
+def forbidden() -> Dict[str, Any]:
+    return {
+        'statusCode': 403,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'error': 'Forbidden'}),
+        'isBase64Encoded': False
+    }
+
+
+def hash_password(password: str) -> str:
+    salt = secrets.token_bytes(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, PASSWORD_ITERATIONS)
+    return '$'.join((
+        PASSWORD_SCHEME, str(PASSWORD_ITERATIONS),
+        base64.b64encode(salt).decode('ascii'), base64.b64encode(digest).decode('ascii')
+    ))
+
+
+def check_password(password: str, stored: str) -> Tuple[bool, bool]:
+    '''(matches, needs rehash). Plaintext rows from before hashing still
+    match once so login can upgrade them.'''
+    scheme, _, rest = stored.partition('$')
+    if scheme != PASSWORD_SCHEME:
+        return hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8')), True
+    iterations, salt, digest = rest.split('$')
+    candidate = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), base64.b64decode(salt), int(iterations))
+    matches = hmac.compare_digest(candidate, base64.b64decode(digest))
+    return matches, matches and int(iterations) < PASSWORD_ITERATIONS
@@ -0,0 +1,158 @@
+'''
+Business: Image pipeline - decode an uploaded photo or avatar once and render size-capped, metadata-free variants
+Args: IMAGE_WORKERS processes (default: CPU count), IMAGE_TIMEOUT seconds per upload (default 20); needs Pillow
+Returns: encoded bytes of each variant by name, None for formats stored as they came, ImageError otherwise
+
+Decoding and resampling are CPU bound and hold the GIL, so they run in a
+process pool: a large upload occupies one worker process instead of
+stalling every request thread of the instance. Workers start from a fork
+server (spawn where there is none), never by forking the threaded request
+process itself, and put this module's directory on sys.path to import it.
+
+A JPEG, PNG or WebP that cannot be rendered is refused rather than stored
+as uploaded, since the raw bytes keep their EXIF (GPS included).
+
+Identical copies live in every backend function directory that handles
+uploads because each function is deployed on its own; change them together.
+'''
+
+import importlib.util
+import io
+import multiprocessing
+import os
+import site
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, NamedTuple, Optional, Sequence
+
+WORKERS = int(os.environ.get('IMAGE_WORKERS', '0')) or os.cpu_count() or 1
+TIMEOUT = float(os.environ.get('IMAGE_TIMEOUT', '20'))
+MAX_PIXELS = 40_000_000
+OUTPUT_TYPE = 'image/webp'
+QUALITY = 80
+# GIFs keep their animation and are stored as uploaded
+SOURCE_TYPES = {'image/jpeg', 'image/png', 'image/webp'}
+
+
+class Variant(NamedTuple):
+    name: str
+    size: int  # longest side, or both sides when square
+    square: bool
+
+
+# Every variant set has a capped 'preview' and a small 'thumb'
+PHOTO = (Variant('preview', 1280, False), Variant('thumb', 320, False))
+AVATAR = (Variant('preview', 512, True), Variant('thumb', 128, True))
+
+class ImageError(Exception):
+    '''An upload that must not be stored; `status` is the HTTP status to answer with.'''
+
+    def __init__(self, message: str, status: int):
+        super().__init__(message, status)
+        self.message = message
+        self.status = status
+
+    def __str__(self) -> str:
+        return self.message
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_available: Optional[bool] = None
+
+
+def available() -> bool:
+    global _available
+    if _available is None:
+        _available = importlib.util.find_spec('PIL') is not None
+    return _available
+
+
+def render(data: bytes, variants: Sequence[Variant]) -> Dict[str, bytes]:
+    '''Decode once and resample each variant from the previous, largest first.
+
+    Runs in a pool worker. Orientation from EXIF is applied to the pixels;
+    Pillow only writes metadata passed to save(), so the variants carry no
+    EXIF (GPS included), XMP or ICC data.
+    '''
+    from PIL import Image, ImageOps
+
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+    try:
+        source = Image.open(io.BytesIO(data))
+    except Image.DecompressionBombError:
+        raise ImageError('Image is too large', 413) from None
+    except Exception:
+        raise ImageError('Image could not be decoded', 400) from None
+    with source:
+        # open() reads only the header, so this is checked before decoding
+        if source.width * source.height > MAX_PIXELS:
+            raise ImageError('Image is too large', 413)
+        transparent = source.mode in ('RGBA', 'LA', 'PA') or 'transparency' in source.info
+        image = ImageOps.exif_transpose(source).convert('RGBA' if transparent else 'RGB')
+
+    rendered = {}
+    for variant in sorted(variants, key=lambda variant: variant.size, reverse=True):
+        if variant.square:
+            side = min(variant.size, *image.size)
+            image = ImageOps.fit(image, (side, side), Image.LANCZOS)
+        else:
+            image = image.copy()
+            image.thumbnail((variant.size, variant.size), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, 'WEBP', quality=QUALITY, method=4)
+        rendered[variant.name] = output.getvalue()
+    return rendered
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(
+                max_workers=WORKERS, mp_context=multiprocessing.get_context(method),
+                initializer=site.addsitedir, initargs=(os.path.dirname(os.path.abspath(__file__)),)
+            )
+        return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def process(data: bytes, content_type: str, variants: Sequence[Variant]) -> Optional[Dict[str, bytes]]:
+    '''Variants of an upload, or None for a format stored as it came.
+
+    Raises ImageError with 400 for data Pillow cannot decode, 413 for
+    images over MAX_PIXELS, 503 when Pillow or the worker pool is not
+    available and 504 when a worker did not finish within IMAGE_TIMEOUT.
+    '''
+    if content_type not in SOURCE_TYPES:
+        return None
+    if not available():
+        raise ImageError('Image processing is unavailable', 503)
+    try:
+        future = _get_pool().submit(render, bytes(data), tuple(variants))
+    except (BrokenProcessPool, RuntimeError, OSError):
+        _reset_pool()
+        raise ImageError('Image processing is unavailable', 503) from None
+    try:
+        return future.result(timeout=TIMEOUT)
+    except ImageError:
+        raise
+    except BrokenProcessPool:
+        _reset_pool()
+        raise ImageError('Image processing is unavailable', 503) from None
+    except FutureTimeout:
+        future.cancel()
+        raise ImageError('Image processing timed out', 504) from None
+    except Exception:
+        # Anything else Pillow raised while decoding inside the worker
+        raise ImageError('Image could not be decoded', 400) from None
@@ -5,10 +5,70 @@ Returns: HTTP response with chat data
 '''
 
 import json
-import os
-import psycopg2
 from typing import Dict, Any
 
+import conditional
+import db
+import images
+import media
+import metrics
+import queries
+import reads
+import session
+
+USER_BY_USERNAME = queries.Statement(
+    'user_by_username',
+    "SELECT id FROM users WHERE username = %s AND deleted_at IS NULL"
+)
+DIRECT_CHAT = queries.Statement(
+    'direct_chat',
+    "SELECT chat_id FROM direct_chats WHERE user_low = %s AND user_high = %s"
+)
+CREATE_DIRECT_CHAT = queries.Statement('create_direct_chat', "INSERT INTO chats (is_group) VALUES (FALSE) RETURNING id")
+CLAIM_DIRECT_CHAT = queries.Statement('claim_direct_chat', """
+    INSERT INTO direct_chats (user_low, user_high, chat_id) VALUES (%s, %s, %s)
+    ON CONFLICT (user_low, user_high) DO NOTHING
+    RETURNING chat_id
+""")
+ADD_PAIR = queries.Statement(
+    'add_pair',
+    "INSERT INTO chat_participants (chat_id, user_id) VALUES (%s, %s), (%s, %s)"
+)
+# Each side sees the chat under the other participant's name
+PERSONAL_INBOX = queries.Statement('personal_inbox', """
+    INSERT INTO user_inbox (user_id, chat_id, is_group, other_user_id, other_username, display_name, display_avatar)
+    SELECT cp.user_id, cp.chat_id, FALSE, u.id, u.username, u.nickname, COALESCE(u.avatar_thumb_url, u.avatar)
+    FROM chat_participants cp
+    JOIN chat_participants ocp ON ocp.chat_id = cp.chat_id AND ocp.user_id != cp.user_id
+    JOIN users u ON u.id = ocp.user_id
+    WHERE cp.chat_id = %s
+""")
+CREATE_GROUP = queries.Statement(
+    'create_group',
+    "INSERT INTO chats (name, avatar, avatar_key, avatar_thumb_url, is_group, creator_id) "
+    "VALUES (%s, %s, %s, %s, TRUE, %s) RETURNING id"
+)
+# Creator and members in one statement; duplicates, unknown and deleted user ids are skipped
+ADD_GROUP_MEMBERS = queries.Statement('add_group_members', """
+    INSERT INTO chat_participants (chat_id, user_id)
+    SELECT %s, u.id
+    FROM (SELECT DISTINCT unnest(%s::int[]) AS id) m
+    JOIN users u ON u.id = m.id AND u.deleted_at IS NULL
+    ON CONFLICT (chat_id, user_id) DO NOTHING
+""")
+GROUP_INBOX = queries.Statement('group_inbox', """
+    INSERT INTO user_inbox (user_id, chat_id, is_group, creator_id, display_name, display_avatar)
+    SELECT cp.user_id, c.id, TRUE, c.creator_id, c.name, COALESCE(c.avatar_thumb_url, c.avatar)
+    FROM chat_participants cp
+    JOIN chats c ON c.id = cp.chat_id
+    WHERE cp.chat_id = %s
+""")
+NOTIFY_INBOXES = queries.Statement(
+    'notify_inboxes',
+    "SELECT pg_notify('inbox_' || user_id, '') FROM user_inbox WHERE chat_id = %s"
+)
+
+@metrics.instrument('chats')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
@@ -19,84 +79,40 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': '',
             'isBase64Encoded': False
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = db.get_connection()
     cur = conn.cursor()
     
     try:
+        session_user = session.authenticate(event, cur)
+        if session_user is None:
+            return session.unauthorized()
+        
         if method == 'GET':
             # Get user's chats
-            user_id = event.get('queryStringParameters', {}).get('user_id')
-            
-            if not user_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'user_id required'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute(f"""
-                SELECT DISTINCT c.id, c.name, c.avatar, c.is_group, c.creator_id,
-                       (SELECT content FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message,
-                       (SELECT created_at FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message_time
-                FROM chats c
-                JOIN chat_participants cp ON c.id = cp.chat_id
-                WHERE cp.user_id = {user_id} AND cp.left_at IS NULL
-                ORDER BY last_message_time DESC NULLS LAST
-            """)
-            
-            chats = []
-            for row in cur.fetchall():
-                chat_data = {
-                    'id': row[0],
-                    'name': row[1],
-                    'avatar': row[2],
-                    'is_group': row[3],
-                    'creator_id': row[4],
-                    'last_message': row[5],
-                    'last_message_time': row[6].isoformat() if row[6] else None
-                }
-                
-                # Get other participant for personal chats
-                if not row[3]:
-                    cur.execute(f"""
-                        SELECT u.username, u.nickname, u.avatar
-                        FROM users u
-                        JOIN chat_participants cp ON u.id = cp.user_id
-                        WHERE cp.chat_id = {row[0]} AND cp.user_id != {user_id}
-                    """)
-                    other_user = cur.fetchone()
-                    if other_user:
-                        chat_data['name'] = other_user[1]
-                        chat_data['avatar'] = other_user[2]
-                        chat_data['other_username'] = other_user[0]
-                
-                chats.append(chat_data)
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'chats': chats}),
-                'isBase64Encoded': False
-            }
+            params = dict(event.get('queryStringParameters') or {})
+            if not session.claim(params, session_user, 'user_id'):
+                return session.forbidden()
+            return reads.to_response(reads.chats(conn, cur, params, conditional.if_none_match(event)), event)
         
         elif method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
+            if not session.claim(body_data, session_user, 'user_id'):
+                return session.forbidden()
             action = body_data.get('action')
             user_id = body_data.get('user_id')
             
             if action == 'create_personal':
-                other_username = body_data.get('other_username', '').replace("'", "''")
+                other_username = body_data.get('other_username', '')
                 
                 # Find other user
-                cur.execute(f"SELECT id FROM users WHERE username = '{other_username}'")
+                USER_BY_USERNAME.execute(cur, (other_username,))
                 other_user = cur.fetchone()
                 
                 if not other_user:
@@ -108,18 +124,34 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     }
                 
                 other_user_id = other_user[0]
+                user_id = int(user_id)
                 
-                # Check if chat already exists
-                cur.execute(f"""
-                    SELECT c.id FROM chats c
-                    JOIN chat_participants cp1 ON c.id = cp1.chat_id
-                    JOIN chat_participants cp2 ON c.id = cp2.chat_id
-                    WHERE c.is_group = FALSE
-                      AND cp1.user_id = {user_id}
-                      AND cp2.user_id = {other_user_id}
-                """)
+                if other_user_id == user_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'Cannot start a chat with yourself'}),
+                        'isBase64Encoded': False
+                    }
                 
+                # Check if chat already exists: one probe on the pair key
+                pair = (min(user_id, other_user_id), max(user_id, other_user_id))
+                DIRECT_CHAT.execute(cur, pair)
                 existing_chat = cur.fetchone()
+                
+                if not existing_chat:
+                    # Create new chat and claim the pair. A concurrent request
+                    # for the same pair waits on the unique key; the loser
+                    # rolls back and returns the winner's chat.
+                    CREATE_DIRECT_CHAT.execute(cur)
+                    chat_id = cur.fetchone()[0]
+                    CLAIM_DIRECT_CHAT.execute(cur, pair + (chat_id,))
+                    
+                    if not cur.fetchone():
+                        conn.rollback()
+                        DIRECT_CHAT.execute(cur, pair)
+                        existing_chat = cur.fetchone()
+                
                 if existing_chat:
                     return {
                         'statusCode': 200,
@@ -128,13 +160,10 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'isBase64Encoded': False
                     }
                 
-                # Create new chat
-                cur.execute("INSERT INTO chats (is_group) VALUES (FALSE) RETURNING id")
-                chat_id = cur.fetchone()[0]
-                
                 # Add participants
-                cur.execute(f"INSERT INTO chat_participants (chat_id, user_id) VALUES ({chat_id}, {user_id})")
-                cur.execute(f"INSERT INTO chat_participants (chat_id, user_id) VALUES ({chat_id}, {other_user_id})")
+                ADD_PAIR.execute(cur, (chat_id, user_id, chat_id, other_user_id))
+                PERSONAL_INBOX.execute(cur, (chat_id,))
+                NOTIFY_INBOXES.execute(cur, (chat_id,))
                 conn.commit()
                 
                 return {
@@ -145,23 +174,33 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 }
             
             elif action == 'create_group':
-                name = body_data.get('name', '').replace("'", "''")
-                avatar = body_data.get('avatar', '').replace("'", "''") if body_data.get('avatar') else 'NULL'
+                name = body_data.get('name', '')
                 member_ids = body_data.get('member_ids', [])
                 
-                # Create group
-                avatar_value = f"'{avatar}'" if avatar != 'NULL' else 'NULL'
-                cur.execute(
-                    f"INSERT INTO chats (name, avatar, is_group, creator_id) VALUES ('{name}', {avatar_value}, TRUE, {user_id}) RETURNING id"
-                )
-                chat_id = cur.fetchone()[0]
+                if not isinstance(member_ids, list) or not all(isinstance(m, int) for m in member_ids):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'member_ids must be a list of user ids'}),
+                        'isBase64Encoded': False
+                    }
                 
-                # Add creator
-                cur.execute(f"INSERT INTO chat_participants (chat_id, user_id) VALUES ({chat_id}, {user_id})")
+                try:
+                    avatar, avatar_key, avatar_thumb = media.store_image_data_url(cur, body_data.get('avatar') or None, images.AVATAR)
+                except (images.ImageError, media.DataURLError) as error:
+                    return {
+                        'statusCode': error.status,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': str(error)}),
+                        'isBase64Encoded': False
+                    }
                 
-                # Add members
-                for member_id in member_ids:
-                    cur.execute(f"INSERT INTO chat_participants (chat_id, user_id) VALUES ({chat_id}, {member_id})")
+                # Create group
+                CREATE_GROUP.execute(cur, (name, avatar, avatar_key, avatar_thumb, user_id))
+                chat_id = cur.fetchone()[0]
+                ADD_GROUP_MEMBERS.execute(cur, (chat_id, [user_id] + member_ids))
+                GROUP_INBOX.execute(cur, (chat_id,))
+                NOTIFY_INBOXES.execute(cur, (chat_id,))
                 
                 conn.commit()
                 
@@ -181,4 +220,4 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     finally:
         cur.close()
-        conn.close()
+        db.release_connection(conn)
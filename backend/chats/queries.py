@@ -0,0 +1,58 @@
+'''
+Business: Declared SQL statements run as server-side prepared statements on pooled connections
+Args: DB_PREPARE=0 turns preparation off (e.g. behind a transaction-mode pooler)
+Returns: Statement objects whose execute() binds every parameter and reuses the connection's cached plan
+
+Identical copies live in every backend function directory because each
+function is deployed on its own; change them together.
+'''
+
+import os
+import re
+from typing import Dict, Sequence
+
+PREPARE_ENABLED = os.environ.get('DB_PREPARE', '1') != '0'
+
+_PLACEHOLDER = re.compile(r'%%|%s')
+_declared: Dict[str, 'Statement'] = {}
+
+
+class Statement:
+    '''One SQL statement, declared once at import time.
+
+    `sql` uses psycopg2's positional %s placeholders. The first execute()
+    on a connection PREPAREs it; later calls only send EXECUTE with the
+    bound values, so Postgres parses it once per connection and can
+    settle on a cached plan.
+    '''
+
+    def __init__(self, name: str, sql: str):
+        if name in _declared:
+            raise ValueError(f'statement {name} is declared twice')
+        _declared[name] = self
+        self.name = name
+        self.sql = sql
+        self.arity = 0
+
+        def positional(match: 're.Match') -> str:
+            if match.group() == '%%':
+                return '%'
+            self.arity += 1
+            return f'${self.arity}'
+
+        self.prepare_sql = f'PREPARE {name} AS {_PLACEHOLDER.sub(positional, sql)}'
+        self.execute_sql = f"EXECUTE {name} ({', '.join(['%s'] * self.arity)})" if self.arity else f'EXECUTE {name}'
+
+    def execute(self, cur, params: Sequence = ()) -> None:
+        if len(params) != self.arity:
+            raise ValueError(f'{self.name} takes {self.arity} parameters, got {len(params)}')
+        # Connections from db.get_connection track what they have prepared;
+        # any other connection runs the plain statement
+        prepared = getattr(cur.connection, 'prepared', None)
+        if not PREPARE_ENABLED or prepared is None:
+            cur.execute(self.sql, params)
+            return
+        if self.name not in prepared:
+            cur.execute(self.prepare_sql)
+            prepared.add(self.name)
+        cur.execute(self.execute_sql, params)
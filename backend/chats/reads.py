@@ -0,0 +1,505 @@
+'''
+Business: Read operations - messages, search, chat list, group participants, profile
+Args: pooled connection/cursor, query parameters and the client's If-None-Match
+Returns: Reply (status, payload, etag) that callers turn into HTTP responses
+
+Shared by the GET handlers and the batch endpoint, which runs several reads
+over one connection. Identical copies live in every function directory that
+serves reads because each function is deployed on its own; change them together.
+'''
+
+import base64
+from contextlib import nullcontext
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+import cache
+import conditional
+import db
+import encoding
+import metrics
+import queries
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+MAX_WAIT_SECONDS = 25
+# Sent as retry_after when every long-poll slot of the instance is taken
+RETRY_AFTER_SECONDS = 2
+SEARCH_PAGE_SIZE = 20
+RECENT_WINDOW_DAYS = 31
+
+# System messages have no sender, so users is an outer join
+# Shown as the sender of messages whose account was deleted; system
+# messages have no sender and keep a null name
+DELETED_ACCOUNT_NAME = 'Удалённый аккаунт'
+MESSAGE_COLUMNS = f"""
+    SELECT m.id, m.sender_id,
+           CASE WHEN m.sender_id IS NOT NULL AND u.id IS NULL THEN '{DELETED_ACCOUNT_NAME}' ELSE u.nickname END,
+           u.username, m.content,
+           m.photo_url, m.photo_thumb_url, m.photo_caption, m.voice_url, m.voice_duration,
+           m.is_edited, m.created_at, m.updated_at, COALESCE(m.is_system, FALSE), m.change_seq
+    FROM messages m
+    LEFT JOIN users u ON m.sender_id = u.id
+"""
+RECENT_WINDOW_SQL = "AND m.created_at >= LOCALTIMESTAMP - make_interval(days => %s)"
+# Response fields of a message: the first fourteen MESSAGE_COLUMNS, then is_read
+MESSAGE_FIELDS = (
+    'id', 'sender_id', 'sender_nickname', 'sender_username', 'content',
+    'photo_url', 'photo_thumb_url', 'photo_caption', 'voice_url', 'voice_duration',
+    'is_edited', 'created_at', 'updated_at', 'is_system', 'is_read'
+)
+SEARCH_FIELDS = ('id', 'chat_id', 'chat_name', 'sender_id', 'sender_nickname', 'created_at', 'rank', 'snippet')
+
+# Kept on the chat row by every writer, so conditional reads never scan
+# the message partitions
+CHAT_VERSION = queries.Statement(
+    'chat_version',
+    "SELECT last_change_seq, updated_at FROM chats WHERE id = %s"
+)
+CHAT_READ_CURSORS = queries.Statement('chat_read_cursors', """
+    SELECT user_id, last_read_message_id
+    FROM chat_read_state
+    WHERE chat_id = %s
+    ORDER BY last_read_message_id DESC
+    LIMIT 2
+""")
+MESSAGE_CHANGES = queries.Statement('message_changes', MESSAGE_COLUMNS + """
+    WHERE m.chat_id = %s AND m.change_seq > %s
+    ORDER BY m.change_seq ASC
+    LIMIT %s
+""")
+# History pages, keyed by (before_id given, recent window only). Separate
+# statements instead of optional predicates keep each cached plan tight.
+# Older pages never try the recent window: they would mostly miss it.
+MESSAGE_PAGES = {
+    (before, recent): queries.Statement(
+        'message_page' + ('_before' if before else '') + ('_recent' if recent else ''),
+        MESSAGE_COLUMNS + f"""
+    WHERE m.chat_id = %s {'AND m.id < %s' if before else ''} {RECENT_WINDOW_SQL if recent else ''}
+    ORDER BY m.id DESC
+    LIMIT %s
+"""
+    )
+    for before, recent in ((False, True), (False, False), (True, False))
+}
+# Digest of every row's version rather than the newest one: versions come
+# from a sequence and can commit out of order, so a row committed late
+# with a lower version would never move MAX(version)
+INBOX_VERSION = queries.Statement('inbox_version', """
+    SELECT left(md5(COALESCE(string_agg(chat_id || ':' || version, ',' ORDER BY chat_id), '')), 16)
+    FROM user_inbox
+    WHERE user_id = %s
+""")
+CHAT_LIST = queries.Statement('chat_list', """
+    SELECT chat_id, display_name, display_avatar, is_group, creator_id,
+           last_message, last_message_time, other_username, unread_count
+    FROM user_inbox
+    WHERE user_id = %s AND left_at IS NULL
+    ORDER BY last_message_time DESC NULLS LAST
+""")
+CHAT_UPDATED_AT = queries.Statement('chat_updated_at', "SELECT updated_at FROM chats WHERE id = %s")
+IS_MEMBER = queries.Statement(
+    'is_member',
+    "SELECT 1 FROM chat_participants WHERE chat_id = %s AND user_id = %s AND left_at IS NULL"
+)
+GROUP_PARTICIPANTS = queries.Statement('group_participants', """
+    SELECT u.id, u.username, u.nickname, COALESCE(u.avatar_thumb_url, u.avatar),
+           cp.joined_at, c.creator_id
+    FROM users u
+    JOIN chat_participants cp ON u.id = cp.user_id
+    JOIN chats c ON c.id = cp.chat_id
+    WHERE cp.chat_id = %s AND cp.left_at IS NULL
+    ORDER BY cp.joined_at ASC, cp.id ASC
+""")
+PROFILE = queries.Statement(
+    'profile',
+    "SELECT id, username, nickname, avatar, theme, hide_online_status, updated_at FROM users WHERE id = %s"
+)
+
+
+class Reply(NamedTuple):
+    status: int
+    payload: Optional[Dict[str, Any]]
+    etag: Optional[str] = None
+
+
+def not_modified(etag: str) -> Reply:
+    return Reply(304, None, etag)
+
+
+def to_response(reply: Reply, event: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    '''HTTP response for a reply; given the request event, the body is
+    compressed with a coding from its Accept-Encoding.'''
+    if reply.status == 304:
+        return conditional.not_modified(reply.etag)
+    headers = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+    if reply.etag:
+        headers.update({'ETag': reply.etag, **conditional.CACHE_HEADERS})
+    with metrics.phase('serialize'):
+        body = encoding.dumps(reply.payload)
+        coding = None
+        if event is not None:
+            headers['Vary'] = 'Accept-Encoding'
+            body, coding = encoding.compress(body, event)
+    if coding is None:
+        return {
+            'statusCode': reply.status,
+            'headers': headers,
+            'body': body.decode('utf-8'),
+            'isBase64Encoded': False
+        }
+    headers['Content-Encoding'] = coding
+    if reply.etag:
+        # Like nginx: the compressed bytes differ per coding, so the
+        # validator becomes weak; If-None-Match still matches it
+        headers['ETag'] = 'W/' + reply.etag
+    return {
+        'statusCode': reply.status,
+        'headers': headers,
+        'body': base64.b64encode(body).decode('ascii'),
+        'isBase64Encoded': True
+    }
+
+
+def is_member(cur, chat_id: Any, user_id: Any) -> bool:
+    '''Whether the user is an active member of the chat.'''
+    IS_MEMBER.execute(cur, (chat_id, user_id))
+    return cur.fetchone() is not None
+
+
+def chat_version(cur, chat_id: int) -> Tuple[int, list, Any]:
+    '''Newest change_seq in the chat, its two furthest read cursors and
+    chats.updated_at.
+
+    A message is read once anyone but its sender has a cursor at or past
+    it; the two furthest cursors are enough to decide that. updated_at
+    moves when a member changes the nickname shown on their messages.
+    '''
+    CHAT_VERSION.execute(cur, (chat_id,))
+    latest, updated_at = cur.fetchone() or (0, None)
+    CHAT_READ_CURSORS.execute(cur, (chat_id,))
+    read_cursors = cur.fetchall()
+    return latest, read_cursors, updated_at
+
+
+def fetch_changes(cur, chat_id: int, since: int, limit: int) -> list:
+    MESSAGE_CHANGES.execute(cur, (chat_id, since, limit + 1))
+    return cur.fetchmany(limit + 1)
+
+
+def fetch_page(cur, chat_id: int, before_id: Optional[int], limit: int, window_days: Optional[int] = None) -> list:
+    '''History page, newest first. With `window_days` (newest page only)
+    only messages created in that recent window are considered, which
+    lets Postgres prune the older monthly partitions.'''
+    params = (chat_id,) + ((before_id,) if before_id is not None else ()) + ((window_days,) if window_days else ())
+    MESSAGE_PAGES[before_id is not None, bool(window_days)].execute(cur, params + (limit + 1,))
+    return cur.fetchmany(limit + 1)
+
+
+def messages(conn, cur, params: Dict[str, Any], client_etag: str = '') -> Reply:
+    '''Messages for a chat, newest page first.
+
+    `before_id` pages back through history (keyset on id), `since` (change
+    watermark from a previous response) returns only rows inserted, edited,
+    read or deleted after it, and `wait` long-polls for such changes.
+    Only active members (`user_id`) may read a chat.
+    '''
+    chat_id = params.get('chat_id')
+    if not chat_id:
+        return Reply(400, {'error': 'chat_id required'})
+
+    try:
+        chat_id = int(chat_id)
+        viewer_id = int(params['user_id']) if params.get('user_id') else None
+        since = int(params['since']) if params.get('since') is not None else None
+        before_id = int(params['before_id']) if params.get('before_id') else None
+        limit = min(max(int(params.get('limit') or DEFAULT_PAGE_SIZE), 1), MAX_PAGE_SIZE)
+        wait = min(max(float(params.get('wait') or 0), 0), MAX_WAIT_SECONDS)
+    except (TypeError, ValueError):
+        return Reply(400, {'error': 'chat_id, user_id, since, before_id, limit and wait must be numbers'})
+
+    if viewer_id is None or not is_member(cur, chat_id, viewer_id):
+        return Reply(403, {'error': 'Forbidden'})
+
+    # The newest change, the two furthest read cursors and the chat's
+    # updated_at version everything this response can contain. They are read before the
+    # rows, so a body is never older than the ETag sent with it.
+    # Long-poll: LISTEN comes first so a write between the query and
+    # the wait still wakes us up.
+    long_poll = since is not None and wait
+    with db.waiter() if long_poll else nullcontext(False) as admitted:
+        with db.listening(conn, f'chat_{chat_id}') if admitted else nullcontext():
+            latest, read_cursors, updated_at = chat_version(cur, chat_id)
+            if admitted and latest <= since and db.wait_for_notify(conn, wait):
+                latest, read_cursors, updated_at = chat_version(cur, chat_id)
+
+    etag = conditional.make_etag(latest, read_cursors, updated_at)
+    if conditional.matches(client_etag, etag):
+        return not_modified(etag)
+
+    if since is not None:
+        # Nothing past the watermark: skip the scan of every partition
+        rows = fetch_changes(cur, chat_id, since, limit) if latest > since else []
+        cursor = since
+    else:
+        # The watermark was read before the page, so anything
+        # committed in between is re-delivered by the next delta.
+        cursor = latest
+        rows = []
+        if before_id is None:
+            # Active chats fill the newest page from the newest partitions alone
+            rows = fetch_page(cur, chat_id, None, limit, RECENT_WINDOW_DAYS)
+        if len(rows) <= limit:
+            rows = fetch_page(cur, chat_id, before_id, limit)
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if since is None:
+        rows.reverse()
+
+    # Rows go to the encoder as they come from the cursor: no per-row
+    # isoformat, and with format=columns no per-row dict either
+    result = []
+    for row in rows:
+        is_read = any(reader != row[1] and last_read >= row[0] for reader, last_read in read_cursors)
+        result.append(row[:14] + (is_read,))
+        if since is not None:
+            cursor = row[14]
+    if since is not None and not has_more:
+        # Everything up to the watermark has been seen, including changes
+        # that left no row to return (purged chats), so never hand back a
+        # cursor a long-poll would wake up for again straight away
+        cursor = max(cursor, latest)
+    if encoding.wants_columns(params):
+        result = encoding.columns(MESSAGE_FIELDS, result)
+    else:
+        result = [dict(zip(MESSAGE_FIELDS, values)) for values in result]
+
+    payload = {'messages': result, 'cursor': cursor, 'has_more': has_more}
+    if long_poll and not admitted:
+        payload['retry_after'] = RETRY_AFTER_SECONDS
+    # Furthest point anyone else has read, for the viewer's own ticks
+    payload['read_up_to'] = next(
+        (last_read for reader, last_read in read_cursors if reader != viewer_id), 0
+    )
+    return Reply(200, payload, etag)
+
+
+def search(cur, params: Dict[str, Any]) -> Reply:
+    '''Full-text search over the user's chats, best matches first.
+
+    `chat_id` narrows it to one chat. Only chats the user is still a member
+    of are searched; the membership join uses the active-participants
+    index instead of filtering results afterwards. Pages are keyset on
+    (rank, id): pass `cursor` from the previous response.
+    '''
+    query = str(params.get('q') or '').strip()
+    if not query or not params.get('user_id'):
+        return Reply(400, {'error': 'q and user_id required'})
+
+    try:
+        user_id = int(params['user_id'])
+        chat_id = int(params['chat_id']) if params.get('chat_id') else None
+        limit = min(max(int(params.get('limit') or SEARCH_PAGE_SIZE), 1), MAX_PAGE_SIZE)
+        after_rank, after_id = None, None
+        if params.get('cursor'):
+            rank_text, _, id_text = str(params['cursor']).partition(':')
+            after_rank, after_id = float(rank_text), int(id_text)
+    except (TypeError, ValueError):
+        return Reply(400, {'error': 'user_id, chat_id, limit and cursor must be numbers'})
+
+    # Snippets are HTML with <mark> around matches, so the message text is
+    # escaped before ts_headline adds the tags
+    cur.execute("""
+        WITH query AS (
+            SELECT websearch_to_tsquery('russian', %(q)s) || websearch_to_tsquery('simple', %(q)s) AS q
+        ), hits AS (
+            SELECT m.id, m.chat_id, m.sender_id, m.created_at,
+                   concat_ws(' ', m.content, m.photo_caption) AS text,
+                   ts_rank(m.search_vector, query.q) AS rank
+            FROM query, chat_participants cp
+            JOIN messages m ON m.chat_id = cp.chat_id
+            WHERE cp.user_id = %(user_id)s AND cp.left_at IS NULL
+              AND (%(chat_id)s::int IS NULL OR cp.chat_id = %(chat_id)s::int)
+              AND m.search_vector @@ query.q
+              AND (%(after_rank)s::real IS NULL
+                   OR (ts_rank(m.search_vector, query.q), m.id) < (%(after_rank)s::real, %(after_id)s::int))
+            ORDER BY rank DESC, m.id DESC
+            LIMIT %(limit)s
+        )
+        SELECT h.id, h.chat_id, i.display_name, h.sender_id, u.nickname, h.created_at, h.rank,
+               ts_headline(
+                   'russian',
+                   replace(replace(replace(h.text, '&', '&amp;'), '<', '&lt;'), '>', '&gt;'),
+                   query.q,
+                   'StartSel=<mark>, StopSel=</mark>, MaxWords=24, MinWords=8, MaxFragments=2'
+               )
+        FROM hits h
+        CROSS JOIN query
+        LEFT JOIN users u ON u.id = h.sender_id
+        LEFT JOIN user_inbox i ON i.user_id = %(user_id)s AND i.chat_id = h.chat_id
+        ORDER BY h.rank DESC, h.id DESC
+    """, {
+        'q': query, 'user_id': user_id, 'chat_id': chat_id,
+        'after_rank': after_rank, 'after_id': after_id, 'limit': limit + 1
+    })
+    rows = cur.fetchall()
+
+    result = rows[:limit]
+    if encoding.wants_columns(params):
+        result = encoding.columns(SEARCH_FIELDS, result)
+    else:
+        result = [dict(zip(SEARCH_FIELDS, row)) for row in result]
+
+    next_cursor = f'{rows[limit - 1][6]!r}:{rows[limit - 1][0]}' if len(rows) > limit else None
+    return Reply(200, {'results': result, 'next_cursor': next_cursor})
+
+
+def inbox_version(cur, user_id: int) -> str:
+    INBOX_VERSION.execute(cur, (user_id,))
+    return cur.fetchone()[0]
+
+
+def chats(conn, cur, params: Dict[str, Any], client_etag: str = '') -> Reply:
+    '''The user's chat list from the inbox projection.
+
+    With `since` (inbox version from a previous response) and `wait`, the
+    request is held until the chat list changes. The version is opaque:
+    it only tells whether anything in the inbox changed.
+    '''
+    user_id = params.get('user_id')
+    if not user_id:
+        return Reply(400, {'error': 'user_id required'})
+
+    try:
+        user_id = int(user_id)
+        since = str(params['since']) if params.get('since') is not None else None
+        wait = min(max(float(params.get('wait') or 0), 0), MAX_WAIT_SECONDS)
+    except (TypeError, ValueError):
+        return Reply(400, {'error': 'user_id and wait must be numbers'})
+
+    long_poll = since is not None and wait
+    with db.waiter() if long_poll else nullcontext(False) as admitted:
+        with db.listening(conn, f'inbox_{user_id}') if admitted else nullcontext():
+            version = inbox_version(cur, user_id)
+            if admitted and version == since and db.wait_for_notify(conn, wait):
+                version = inbox_version(cur, user_id)
+    retry_after = {'retry_after': RETRY_AFTER_SECONDS} if long_poll and not admitted else {}
+
+    # Every inbox write takes a fresh version, so it doubles as the ETag
+    etag = conditional.make_etag(user_id, version)
+    if conditional.matches(client_etag, etag):
+        return not_modified(etag)
+
+    if version == since:
+        return Reply(200, {'unchanged': True, 'version': version, **retry_after}, etag)
+
+    # The chat list is read from the per-user inbox projection,
+    # an index range scan already in display order.
+    CHAT_LIST.execute(cur, (user_id,))
+
+    result = []
+    for row in cur.fetchall():
+        chat_data = {
+            'id': row[0],
+            'name': row[1],
+            'avatar': row[2],
+            'is_group': row[3],
+            'creator_id': row[4],
+            'last_message': row[5],
+            'last_message_time': row[6],
+            'unread_count': row[8]
+        }
+
+        if row[7] is not None:
+            chat_data['other_username'] = row[7]
+
+        result.append(chat_data)
+
+    return Reply(200, {'chats': result, 'version': version, **retry_after}, etag)
+
+
+def participants(cur, params: Dict[str, Any], client_etag: str = '') -> Reply:
+    '''Active members of a group, oldest first; only members may list them.'''
+    chat_id = params.get('chat_id')
+    if not chat_id:
+        return Reply(400, {'error': 'chat_id required'})
+
+    try:
+        chat_id = int(chat_id)
+        viewer_id = int(params['user_id']) if params.get('user_id') else None
+    except (TypeError, ValueError):
+        return Reply(400, {'error': 'chat_id and user_id must be numbers'})
+
+    if viewer_id is None or not is_member(cur, chat_id, viewer_id):
+        return Reply(403, {'error': 'Forbidden'})
+
+    # chats.updated_at moves on every membership, group info or
+    # member profile change, so it versions the participant list
+    CHAT_UPDATED_AT.execute(cur, (chat_id,))
+    chat = cur.fetchone()
+    etag = conditional.make_etag(str(chat_id), chat[0] if chat else None)
+    if conditional.matches(client_etag, etag):
+        return not_modified(etag)
+
+    def load() -> Dict[str, Any]:
+        GROUP_PARTICIPANTS.execute(cur, (chat_id,))
+        result = []
+        creator_id = None
+        for row in cur.fetchall():
+            creator_id = row[5]
+            result.append({
+                'id': row[0],
+                'username': row[1],
+                'nickname': row[2],
+                'avatar': row[3],
+                'joined_at': row[4].isoformat() if row[4] else None,
+                'is_creator': row[0] == creator_id
+            })
+        return {'etag': etag, 'payload': {'participants': result, 'creator_id': creator_id}}
+
+    # The cached list is only served for the chat version just read, so a
+    # change this instance was not told about costs a reload, not staleness
+    key = cache.participants_key(chat_id)
+    cached = cache.get_or_load(key, load)
+    if cached['etag'] != etag:
+        cached = load()
+        cache.put(key, cached)
+
+    return Reply(200, cached['payload'], etag)
+
+
+def profile(cur, params: Dict[str, Any], client_etag: str = '') -> Reply:
+    user_id = params.get('user_id')
+    if not user_id:
+        return Reply(400, {'error': 'user_id required'})
+
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return Reply(400, {'error': 'user_id must be a number'})
+
+    def load() -> Optional[Dict[str, Any]]:
+        PROFILE.execute(cur, (user_id,))
+        user = cur.fetchone()
+        if not user:
+            return None
+        return {
+            'etag': conditional.make_etag(user[0], user[6]),
+            'payload': {
+                'id': user[0],
+                'username': user[1],
+                'nickname': user[2],
+                'avatar': user[3],
+                'theme': user[4],
+                'hide_online_status': user[5]
+            }
+        }
+
+    cached = cache.get_or_load(cache.profile_key(user_id), load)
+    if cached is None:
+        return Reply(404, {'error': 'User not found'})
+
+    if conditional.matches(client_etag, cached['etag']):
+        return not_modified(cached['etag'])
+
+    return Reply(200, cached['payload'], cached['etag'])
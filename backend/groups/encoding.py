@@ -0,0 +1,92 @@
+'''
+Business: Response encoding - fast JSON, a compact columnar row format and negotiated gzip/brotli
+Args: RESPONSE_COMPRESS_MIN_BYTES (default 1024); orjson and brotli are used when installed
+Returns: encoded response bodies and their Content-Encoding
+
+orjson writes datetimes itself (same ISO 8601 text as isoformat()), so
+readers can hand it raw row values. Without orjson the stdlib encoder
+runs with compact separators and a default hook for the same types.
+
+Identical copies live in every backend function directory that serves
+reads because each function is deployed on its own; change them together.
+'''
+
+import gzip
+import json
+import os
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESS_MIN_BYTES', '1024'))
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+
+def _default(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def dumps(payload: Any) -> bytes:
+    '''UTF-8 JSON of a payload that may hold datetimes.'''
+    if orjson is not None:
+        return orjson.dumps(payload, default=_default)
+    return json.dumps(payload, default=_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def columns(names: Sequence[str], rows: List[Sequence[Any]]) -> Dict[str, Any]:
+    '''Columnar form of a row list: field names once instead of once per row.'''
+    return {'columns': list(names), 'rows': rows}
+
+
+def wants_columns(params: Dict[str, Any]) -> bool:
+    return params.get('format') == 'columns'
+
+
+def accepted_encodings(event: Dict[str, Any]) -> Dict[str, float]:
+    '''Content codings from Accept-Encoding with their q-values.'''
+    header = ''
+    for name, value in (event.get('headers') or {}).items():
+        if name.lower() == 'accept-encoding':
+            header = value or ''
+            break
+    accepted = {}
+    for item in header.split(','):
+        coding, _, parameters = item.strip().partition(';')
+        if not coding:
+            continue
+        quality = 1.0
+        parameter, _, value = parameters.strip().partition('=')
+        if parameter.strip() == 'q':
+            try:
+                quality = float(value)
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    return accepted
+
+
+def compress(body: bytes, event: Dict[str, Any]) -> Tuple[bytes, Optional[str]]:
+    '''Body in the best coding the client accepts; small bodies stay as they are.'''
+    if len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    accepted = accepted_encodings(event)
+    if brotli is not None and accepted.get('br', 0) > 0:
+        return brotli.compress(body, quality=BROTLI_QUALITY), 'br'
+    if accepted.get('gzip', 0) > 0:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0), 'gzip'
+    return body, None
@@ -5,10 +5,128 @@ Returns: HTTP response with group data
 '''
 
 import json
-import os
-import psycopg2
-from typing import Dict, Any
+from typing import Dict, Any, List
 
+import cache
+import conditional
+import db
+import images
+import media
+import metrics
+import queries
+import reads
+import session
+
+NAMES_IN_SYSTEM_MESSAGE = 3
+
+CHAT_CREATOR = queries.Statement('chat_creator', "SELECT creator_id FROM chats WHERE id = %s")
+JOIN_MEMBERS = queries.Statement('join_members', """
+    WITH joined AS (
+        INSERT INTO chat_participants (chat_id, user_id)
+        SELECT %s, u.id
+        FROM (SELECT DISTINCT unnest(%s::int[]) AS id) m
+        JOIN users u ON u.id = m.id AND u.deleted_at IS NULL
+        ON CONFLICT (chat_id, user_id) DO UPDATE
+            SET left_at = NULL, joined_at = CURRENT_TIMESTAMP
+            WHERE chat_participants.left_at IS NOT NULL
+        RETURNING user_id
+    )
+    SELECT u.id, u.nickname FROM joined JOIN users u ON u.id = joined.user_id ORDER BY u.id
+""")
+JOIN_INBOX = queries.Statement('join_inbox', """
+    INSERT INTO user_inbox (user_id, chat_id, is_group, creator_id, display_name, display_avatar)
+    SELECT m.id, c.id, TRUE, c.creator_id, c.name, COALESCE(c.avatar_thumb_url, c.avatar)
+    FROM unnest(%s::int[]) AS m(id)
+    JOIN chats c ON c.id = %s
+    ON CONFLICT (user_id, chat_id) DO UPDATE
+        SET left_at = NULL, display_name = EXCLUDED.display_name, display_avatar = EXCLUDED.display_avatar,
+            version = nextval('user_inbox_version_seq')
+""")
+LEAVE_MEMBERS = queries.Statement('leave_members', """
+    WITH removed AS (
+        UPDATE chat_participants SET left_at = CURRENT_TIMESTAMP
+        WHERE chat_id = %s AND user_id = ANY(%s::int[]) AND left_at IS NULL
+        RETURNING user_id
+    )
+    SELECT u.id, u.nickname FROM removed JOIN users u ON u.id = removed.user_id ORDER BY u.id
+""")
+LEAVE_INBOX = queries.Statement(
+    'leave_inbox',
+    "UPDATE user_inbox SET left_at = CURRENT_TIMESTAMP, version = nextval('user_inbox_version_seq') "
+    "WHERE chat_id = %s AND user_id = ANY(%s::int[])"
+)
+TOUCH_CHAT = queries.Statement('touch_chat', "UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = %s")
+# Membership changes lock the chat row before any participant or inbox row,
+# in the same order as sending a message (next_change_seq, then the inbox)
+LOCK_CHAT = queries.Statement('lock_chat', "SELECT 1 FROM chats WHERE id = %s FOR UPDATE")
+
+def describe_members(nicknames: List[str], singular: str, plural: str) -> str:
+    '''One system message line for any number of members, e.g. "A, B, C и ещё 7 ..."'''
+    if len(nicknames) == 1:
+        return f"{nicknames[0]} {singular}"
+    shown = ', '.join(nicknames[:NAMES_IN_SYSTEM_MESSAGE])
+    rest = len(nicknames) - NAMES_IN_SYSTEM_MESSAGE
+    return f"{shown} и ещё {rest} {plural}" if rest > 0 else f"{shown} {plural}"
+
+def add_members(cur, chat_id: int, member_ids: List[int]) -> List[str]:
+    '''Add members (or re-admit ones who left) with set-based statements.
+
+    Returns the nicknames of users who actually joined; existing members,
+    unknown and deleted ids are skipped.
+    '''
+    LOCK_CHAT.execute(cur, (chat_id,))
+    JOIN_MEMBERS.execute(cur, (chat_id, member_ids))
+    joined = cur.fetchall()
+    if not joined:
+        return []
+    
+    JOIN_INBOX.execute(cur, ([row[0] for row in joined], chat_id))
+    TOUCH_CHAT.execute(cur, (chat_id,))
+    return [row[1] for row in joined]
+
+def remove_members(cur, chat_id: int, member_ids: List[int]) -> List[str]:
+    '''Mark members as left with set-based statements.
+
+    Returns the nicknames of users who were active members.
+    '''
+    LOCK_CHAT.execute(cur, (chat_id,))
+    LEAVE_MEMBERS.execute(cur, (chat_id, member_ids))
+    removed = cur.fetchall()
+    if not removed:
+        return []
+    
+    LEAVE_INBOX.execute(cur, (chat_id, [row[0] for row in removed]))
+    TOUCH_CHAT.execute(cur, (chat_id,))
+    return [row[1] for row in removed]
+
+def post_system_message(cur, chat_id: int, content: str) -> None:
+    '''Insert a system message, update member previews and wake pollers.
+
+    System messages show in the preview but never count as unread.
+    '''
+    # Writers of a chat take its change_seq values in commit order, see
+    # next_change_seq in backend/messages/index.py
+    cur.execute(
+        "UPDATE chats SET last_change_seq = nextval('messages_change_seq') WHERE id = %s RETURNING last_change_seq",
+        (chat_id,)
+    )
+    change_seq = cur.fetchone()[0]
+    cur.execute(
+        "INSERT INTO messages (chat_id, content, is_system, change_seq) VALUES (%s, %s, TRUE, %s) RETURNING id, created_at",
+        (chat_id, content, change_seq)
+    )
+    system_message = cur.fetchone()
+    cur.execute("""
+        UPDATE user_inbox i
+        SET last_message_id = m.id, last_message = m.content, last_message_time = m.created_at,
+            version = nextval('user_inbox_version_seq')
+        FROM messages m
+        WHERE m.id = %s AND m.created_at = %s AND i.chat_id = m.chat_id AND i.left_at IS NULL
+    """, system_message)
+    cur.execute("SELECT pg_notify('chat_' || %s, '')", (chat_id,))
+    cur.execute("SELECT pg_notify('inbox_' || user_id, '') FROM user_inbox WHERE chat_id = %s", (chat_id,))
+
+@metrics.instrument('groups')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
@@ -19,64 +137,34 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = db.get_connection()
     cur = conn.cursor()
     
     try:
+        session_user = session.authenticate(event, cur)
+        if session_user is None:
+            return session.unauthorized()
+        
         if method == 'GET':
             # Get group participants
-            chat_id = event.get('queryStringParameters', {}).get('chat_id')
-            
-            if not chat_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'chat_id required'})
-                }
-            
-            cur.execute("""
-                SELECT u.id, u.username, u.nickname, u.avatar, 
-                       cp.joined_at, c.creator_id
-                FROM users u
-                JOIN chat_participants cp ON u.id = cp.user_id
-                JOIN chats c ON c.id = cp.chat_id
-                WHERE cp.chat_id = %s AND cp.left_at IS NULL
-                ORDER BY cp.joined_at ASC
-            """, (chat_id,))
-            
-            participants = []
-            creator_id = None
-            for row in cur.fetchall():
-                creator_id = row[5]
-                participants.append({
-                    'id': row[0],
-                    'username': row[1],
-                    'nickname': row[2],
-                    'avatar': row[3],
-                    'joined_at': row[4].isoformat() if row[4] else None,
-                    'is_creator': row[0] == creator_id
-                })
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'participants': participants,
-                    'creator_id': creator_id
-                })
-            }
+            params = dict(event.get('queryStringParameters') or {})
+            if not session.claim(params, session_user, 'user_id'):
+                return session.forbidden()
+            return reads.to_response(reads.participants(cur, params, conditional.if_none_match(event)), event)
         
         elif method == 'POST':
             body_data = json.loads(event.get('body', '{}'))
             action = body_data.get('action')
             
             if action == 'leave':
+                if not session.claim(body_data, session_user, 'user_id'):
+                    return session.forbidden()
                 chat_id = body_data.get('chat_id')
                 user_id = body_data.get('user_id')
                 
@@ -91,19 +179,11 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'body': json.dumps({'error': 'User not found'})
                     }
                 
-                # Mark as left
-                cur.execute(
-                    "UPDATE chat_participants SET left_at = CURRENT_TIMESTAMP WHERE chat_id = %s AND user_id = %s",
-                    (chat_id, user_id)
-                )
-                
-                # Add system message
-                cur.execute(
-                    "INSERT INTO messages (chat_id, content, is_system) VALUES (%s, %s, TRUE)",
-                    (chat_id, f"{user[0]} покинул(а) группу")
-                )
+                if remove_members(cur, chat_id, [user_id]):
+                    post_system_message(cur, chat_id, f"{user[0]} покинул(а) группу")
                 
                 conn.commit()
+                cache.invalidate(cache.participants_key(chat_id))
                 
                 return {
                     'statusCode': 200,
@@ -113,12 +193,14 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         elif method == 'PUT':
             body_data = json.loads(event.get('body', '{}'))
+            if not session.claim(body_data, session_user, 'user_id'):
+                return session.forbidden()
             action = body_data.get('action')
             chat_id = body_data.get('chat_id')
             user_id = body_data.get('user_id')
             
             # Verify user is creator
-            cur.execute("SELECT creator_id FROM chats WHERE id = %s", (chat_id,))
+            CHAT_CREATOR.execute(cur, (chat_id,))
             chat = cur.fetchone()
             
             if not chat or chat[0] != user_id:
@@ -130,13 +212,29 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             if action == 'update_info':
                 name = body_data.get('name')
-                avatar = body_data.get('avatar')
+                cur.execute("SELECT avatar, avatar_key, avatar_thumb_url FROM chats WHERE id = %s", (chat_id,))
+                current = cur.fetchone()
+                try:
+                    avatar, avatar_key, avatar_thumb = media.store_image_data_url(cur, body_data.get('avatar'), images.AVATAR, current)
+                except (images.ImageError, media.DataURLError) as error:
+                    return {
+                        'statusCode': error.status,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': str(error)})
+                    }
                 
                 cur.execute(
-                    "UPDATE chats SET name = %s, avatar = %s WHERE id = %s",
-                    (name, avatar, chat_id)
+                    "UPDATE chats SET name = %s, avatar = %s, avatar_key = %s, avatar_thumb_url = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                    (name, avatar, avatar_key, avatar_thumb, chat_id)
                 )
+                cur.execute(
+                    "UPDATE user_inbox SET display_name = %s, display_avatar = %s, version = nextval('user_inbox_version_seq') WHERE chat_id = %s",
+                    (name, avatar_thumb, chat_id)
+                )
+                cur.execute("SELECT pg_notify('chat_' || %s, '')", (chat_id,))
+                cur.execute("SELECT pg_notify('inbox_' || user_id, '') FROM user_inbox WHERE chat_id = %s", (chat_id,))
                 conn.commit()
+                cache.invalidate(cache.participants_key(chat_id))
                 
                 return {
                     'statusCode': 200,
@@ -147,30 +245,61 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             elif action == 'remove_member':
                 member_id = body_data.get('member_id')
                 
-                # Get member nickname for system message
-                cur.execute("SELECT nickname FROM users WHERE id = %s", (member_id,))
-                member = cur.fetchone()
+                if not isinstance(member_id, int):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'member_id must be a user id'})
+                    }
+                if member_id == user_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'The creator cannot be removed'})
+                    }
                 
-                if member:
-                    # Mark as left
-                    cur.execute(
-                        "UPDATE chat_participants SET left_at = CURRENT_TIMESTAMP WHERE chat_id = %s AND user_id = %s",
-                        (chat_id, member_id)
-                    )
-                    
-                    # Add system message
-                    cur.execute(
-                        "INSERT INTO messages (chat_id, content, is_system) VALUES (%s, %s, TRUE)",
-                        (chat_id, f"{member[0]} был(а) удален(а) из группы")
-                    )
-                    
+                removed = remove_members(cur, chat_id, [member_id])
+                if removed:
+                    post_system_message(cur, chat_id, describe_members(removed, 'был(а) удален(а) из группы', 'удалены из группы'))
                     conn.commit()
+                    cache.invalidate(cache.participants_key(chat_id))
                 
                 return {
                     'statusCode': 200,
                     'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                     'body': json.dumps({'success': True})
                 }
+            
+            elif action in ('add_members', 'remove_members'):
+                # Bulk membership change: one statement for all members and
+                # a single system message naming them
+                member_ids = body_data.get('member_ids')
+                
+                if not isinstance(member_ids, list) or not all(isinstance(m, int) for m in member_ids):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'member_ids must be a list of user ids'})
+                    }
+                
+                if action == 'add_members':
+                    changed = add_members(cur, chat_id, member_ids)
+                    content = describe_members(changed, 'добавлен(а) в группу', 'добавлены в группу')
+                else:
+                    # The creator cannot remove themselves this way
+                    changed = remove_members(cur, chat_id, [m for m in member_ids if m != user_id])
+                    content = describe_members(changed, 'был(а) удален(а) из группы', 'удалены из группы')
+                
+                if changed:
+                    post_system_message(cur, chat_id, content)
+                    conn.commit()
+                    cache.invalidate(cache.participants_key(chat_id))
+                
+                return {
+                    'statusCode': 200,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'success': True, 'changed': len(changed)})
+                }
         
         return {
             'statusCode': 400,
@@ -180,4 +309,4 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     finally:
         cur.close()
-        conn.close()
+        db.release_connection(conn)
@@ -0,0 +1,235 @@
+'''
+Business: Read-through cache - a per-instance LRU with TTL in front of an optional shared store
+Args: CACHE_TTL / CACHE_SIZE for the local LRU, CACHE_REDIS_URL enables the shared store, CACHE_SHARED_TTL its expiry
+Returns: cached JSON-safe values by key, explicit invalidation and hit/miss counters
+
+Writers invalidate the keys they change after committing. Without a
+shared store that only reaches their own warm instance; other instances
+serve an old entry for at most CACHE_TTL seconds. Values are shared
+between threads and must not be mutated by callers.
+
+Identical copies live in every backend function directory that serves
+reads because each function is deployed on its own; change them together.
+'''
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import metrics
+
+LOCAL_TTL = float(os.environ.get('CACHE_TTL', '15'))
+LOCAL_SIZE = int(os.environ.get('CACHE_SIZE', '5000'))
+SHARED_TTL = int(os.environ.get('CACHE_SHARED_TTL', '300'))
+
+_MISSING = object()
+
+
+class LocalCache:
+    '''Thread-safe LRU whose entries expire `ttl` seconds after they were stored.'''
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.entries: 'OrderedDict[str, Tuple[Any, float]]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return _MISSING
+            if entry[1] <= time.monotonic():
+                del self.entries[key]
+                return _MISSING
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key: str, value: Any) -> None:
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class SharedCache:
+    '''Store shared by every instance of every function; values are JSON text.'''
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        raise NotImplementedError
+
+    def delete(self, *keys: str) -> None:
+        raise NotImplementedError
+
+
+class MemorySharedCache(SharedCache):
+    '''In-process stand-in for tests and local tooling.'''
+
+    def __init__(self):
+        self.entries: Dict[str, Tuple[str, float]] = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                self.entries.pop(key, None)
+                return None
+            return entry[0]
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+
+    def delete(self, *keys: str) -> None:
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+
+class RedisSharedCache(SharedCache):
+    '''Redis (or any server speaking its protocol) reachable from every function.'''
+
+    def __init__(self, url: str):
+        import redis
+
+        # A slow cache must not be slower than the query it saves
+        self.client = redis.Redis.from_url(url, socket_timeout=0.1, socket_connect_timeout=0.1)
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.client.get(key)
+        return value.decode('utf-8') if value is not None else None
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        self.client.set(key, value, ex=ttl)
+
+    def delete(self, *keys: str) -> None:
+        self.client.delete(*keys)
+
+
+_local = LocalCache(LOCAL_SIZE, LOCAL_TTL)
+_shared: Optional[SharedCache] = None
+_shared_configured = False
+_counters = {'hits': 0, 'shared_hits': 0, 'misses': 0, 'invalidations': 0, 'shared_errors': 0}
+_counters_lock = threading.Lock()
+
+
+def get_shared() -> Optional[SharedCache]:
+    global _shared, _shared_configured
+    if not _shared_configured:
+        url = os.environ.get('CACHE_REDIS_URL')
+        _shared = RedisSharedCache(url) if url else None
+        _shared_configured = True
+    return _shared
+
+
+def set_shared(shared: Optional[SharedCache]) -> None:
+    '''Override the configured shared store (tests, local tooling); None turns it off.'''
+    global _shared, _shared_configured
+    _shared = shared
+    _shared_configured = True
+
+
+def _count(name: str) -> None:
+    with _counters_lock:
+        _counters[name] += 1
+    record = metrics.current()
+    if record is not None:
+        record[f'cache_{name}'] = record.get(f'cache_{name}', 0) + 1
+
+
+def stats() -> Dict[str, int]:
+    '''Counters since the instance started (or the last reset).'''
+    with _counters_lock:
+        return {**_counters, 'local_entries': len(_local)}
+
+
+def reset() -> None:
+    '''Forget every local entry and zero the counters.'''
+    _local.clear()
+    with _counters_lock:
+        for name in _counters:
+            _counters[name] = 0
+
+
+def get_or_load(key: str, load: Callable[[], Any]) -> Any:
+    '''The cached value of `key`, or `load()`'s result, which is then cached.
+
+    None from `load` means "does not exist" and is not cached. A failing
+    shared store counts as a miss rather than failing the request.
+    '''
+    value = _local.get(key)
+    if value is not _MISSING:
+        _count('hits')
+        return value
+
+    shared = get_shared()
+    if shared is not None:
+        try:
+            raw = shared.get(key)
+        except Exception:
+            _count('shared_errors')
+            raw = None
+        if raw is not None:
+            value = json.loads(raw)
+            _local.set(key, value)
+            _count('shared_hits')
+            return value
+
+    _count('misses')
+    value = load()
+    if value is not None:
+        put(key, value)
+    return value
+
+
+def put(key: str, value: Any) -> None:
+    '''Store a freshly read value, replacing whatever the key held.'''
+    _local.set(key, value)
+    shared = get_shared()
+    if shared is not None:
+        try:
+            shared.set(key, json.dumps(value), SHARED_TTL)
+        except Exception:
+            _count('shared_errors')
+
+
+def invalidate(*keys: str) -> None:
+    '''Drop keys after the write that changed them has committed.'''
+    if not keys:
+        return
+    for key in keys:
+        _local.delete(key)
+        _count('invalidations')
+    shared = get_shared()
+    if shared is not None:
+        try:
+            shared.delete(*keys)
+        except Exception:
+            _count('shared_errors')
+
+
+def profile_key(user_id: int) -> str:
+    return f'profile:{user_id}'
+
+
+def participants_key(chat_id: int) -> str:
+    return f'participants:{chat_id}'
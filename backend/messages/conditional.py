@@ -0,0 +1,44 @@
+'''
+Business: Conditional GET helpers - ETag validators and 304 responses
+Args: request event headers and the version parts of a resource
+Returns: quoted ETag strings, If-None-Match checks and Not Modified responses
+
+Identical copies live in every backend function directory that serves
+cacheable reads because each function is deployed on its own; change
+them together.
+'''
+
+import hashlib
+from typing import Any, Dict
+
+CACHE_HEADERS = {'Cache-Control': 'no-cache', 'Access-Control-Expose-Headers': 'ETag'}
+
+
+def make_etag(*parts: Any) -> str:
+    '''Strong validator over the version parts of a resource.'''
+    digest = hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()[:20]
+    return f'"{digest}"'
+
+
+def if_none_match(event: Dict[str, Any]) -> str:
+    headers = event.get('headers') or {}
+    for name, value in headers.items():
+        if name.lower() == 'if-none-match':
+            return value or ''
+    return ''
+
+
+def matches(header: str, etag: str) -> bool:
+    '''True when an If-None-Match value names the representation tagged `etag`.'''
+    if not header:
+        return False
+    candidates = [tag.strip() for tag in header.split(',')]
+    return '*' in candidates or any(tag.removeprefix('W/') == etag for tag in candidates)
+
+
+def not_modified(etag: str) -> Dict[str, Any]:
+    return {
+        'statusCode': 304,
+        'headers': {'Access-Control-Allow-Origin': '*', 'ETag': etag, **CACHE_HEADERS},
+        'body': ''
+    }
@@ -5,12 +5,61 @@ Returns: HTTP response with message data
 '''
 
 import json
-import os
 import base64
-import psycopg2
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from datetime import datetime
 
+import conditional
+import db
+import images
+import media
+import metrics
+import multipart
+import reads
+import session
+
+def search_vector_sql(text_sql: str) -> str:
+    '''SQL for a message's search document, see V0012__add_message_search.sql.'''
+    return f"to_tsvector('russian', {text_sql}) || to_tsvector('simple', {text_sql})"
+
+def next_change_seq(cur, chat_id: Any) -> Optional[int]:
+    '''Take the next change_seq of a chat, holding its row until commit.
+
+    change_seq values are handed out when a row is written but become
+    visible when its transaction commits. Writers of one chat queue on the
+    row lock, so their values commit in order and a delta cursor can never
+    move past a change that is still in flight. chats.last_change_seq is
+    what conditional reads compare against. None if there is no chat.
+    '''
+    cur.execute(
+        "UPDATE chats SET last_change_seq = nextval('messages_change_seq') WHERE id = %s RETURNING last_change_seq",
+        (chat_id,)
+    )
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def message_change_seq(cur, message_id: Any, sender_id: int) -> Optional[int]:
+    '''next_change_seq for the chat of a message the sender wrote; None if there is none.'''
+    cur.execute("SELECT chat_id FROM messages WHERE id = %s AND sender_id = %s", (message_id, sender_id))
+    row = cur.fetchone()
+    return next_change_seq(cur, row[0]) if row else None
+
+def chat_not_found() -> Dict[str, Any]:
+    return {
+        'statusCode': 404,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'error': 'Chat not found'})
+    }
+
+def notify_chat_change(cur, chat_id: int) -> None:
+    '''Wake long-polls on the chat and on its members' chat lists.'''
+    cur.execute("SELECT pg_notify('chat_' || %s, '')", (chat_id,))
+    cur.execute(
+        "SELECT pg_notify('inbox_' || user_id, '') FROM user_inbox WHERE chat_id = %s AND left_at IS NULL",
+        (chat_id,)
+    )
+
+@metrics.instrument('messages')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
@@ -21,60 +70,29 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = db.get_connection()
     cur = conn.cursor()
     
     try:
+        session_user = session.authenticate(event, cur)
+        if session_user is None:
+            return session.unauthorized()
+        
         if method == 'GET':
-            # Get messages for a chat
-            chat_id = event.get('queryStringParameters', {}).get('chat_id')
-            
-            if not chat_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'chat_id required'})
-                }
-            
-            cur.execute("""
-                SELECT m.id, m.sender_id, u.nickname, u.username, m.content, 
-                       m.photo_url, m.photo_caption, m.voice_url, m.voice_duration,
-                       m.is_edited, m.is_read, m.created_at, m.updated_at
-                FROM messages m
-                JOIN users u ON m.sender_id = u.id
-                WHERE m.chat_id = %s
-                ORDER BY m.created_at ASC
-            """, (chat_id,))
-            
-            messages = []
-            for row in cur.fetchall():
-                messages.append({
-                    'id': row[0],
-                    'sender_id': row[1],
-                    'sender_nickname': row[2],
-                    'sender_username': row[3],
-                    'content': row[4],
-                    'photo_url': row[5],
-                    'photo_caption': row[6],
-                    'voice_url': row[7],
-                    'voice_duration': row[8],
-                    'is_edited': row[9],
-                    'is_read': row[10],
-                    'created_at': row[11].isoformat() if row[11] else None,
-                    'updated_at': row[12].isoformat() if row[12] else None
-                })
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'messages': messages})
-            }
+            # Get messages for a chat: a page, a delta since a cursor, or a long-poll.
+            # With `q`, search the user's chats instead.
+            params = dict(event.get('queryStringParameters') or {})
+            if not session.claim(params, session_user, 'user_id'):
+                return session.forbidden()
+            if params.get('q') is not None:
+                return reads.to_response(reads.search(cur, params), event)
+            return reads.to_response(reads.messages(conn, cur, params, conditional.if_none_match(event)), event)
         
         elif method == 'POST':
             content_type = event.get('headers', {}).get('content-type', '')
@@ -83,39 +101,34 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 body = event.get('body', '')
                 is_base64 = event.get('isBase64Encoded', False)
                 
-                if is_base64:
-                    body = base64.b64decode(body).decode('utf-8')
+                raw_body = base64.b64decode(body) if is_base64 else body.encode('utf-8')
                 
-                boundary = content_type.split('boundary=')[1] if 'boundary=' in content_type else None
-                if not boundary:
+                try:
+                    boundary = multipart.get_boundary(content_type)
+                    fields = {}
+                    audio_data = None
+                    audio_type = 'audio/webm'
+                    
+                    for part in multipart.iter_parts(raw_body, boundary):
+                        if part.name == 'audio' and part.filename is not None:
+                            audio_data = part.data
+                            if part.content_type and part.content_type.startswith('audio/'):
+                                audio_type = part.content_type.split(';')[0]
+                        elif part.filename is None:
+                            fields[part.name] = part.text().strip()
+                except (multipart.MultipartError, UnicodeDecodeError):
                     return {
                         'statusCode': 400,
                         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                         'body': json.dumps({'error': 'Invalid multipart request'})
                     }
                 
-                parts = body.split(f'--{boundary}')
-                
-                chat_id = None
-                sender_id = None
-                duration = None
-                caption = None
-                audio_data = None
-                
-                for part in parts:
-                    if 'name="chat_id"' in part:
-                        chat_id = part.split('\r\n\r\n')[1].split('\r\n')[0].strip()
-                    elif 'name="sender_id"' in part:
-                        sender_id = part.split('\r\n\r\n')[1].split('\r\n')[0].strip()
-                    elif 'name="duration"' in part:
-                        duration = part.split('\r\n\r\n')[1].split('\r\n')[0].strip()
-                    elif 'name="caption"' in part:
-                        caption = part.split('\r\n\r\n')[1].split('\r\n')[0].strip()
-                    elif 'name="audio"' in part and 'filename=' in part:
-                        audio_content = part.split('\r\n\r\n', 1)[1]
-                        if audio_content.endswith('\r\n'):
-                            audio_content = audio_content[:-2]
-                        audio_data = base64.b64encode(audio_content.encode('latin-1')).decode('utf-8')
+                if not session.claim(fields, session_user, 'sender_id'):
+                    return session.forbidden()
+                chat_id = fields.get('chat_id')
+                sender_id = fields.get('sender_id')
+                duration = fields.get('duration')
+                caption = fields.get('caption')
                 
                 if not all([chat_id, sender_id, duration, audio_data]):
                     return {
@@ -123,16 +136,32 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                         'body': json.dumps({'error': 'Missing required fields'})
                     }
+                try:
+                    chat_id, sender_id, duration = int(chat_id), int(sender_id), float(duration)
+                except ValueError:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'chat_id, sender_id and duration must be numbers'})
+                    }
                 
-                voice_url = f'data:audio/webm;base64,{audio_data}'
+                if not reads.is_member(cur, chat_id, session_user):
+                    return session.forbidden()
                 
-                cur.execute("""
-                    INSERT INTO messages (chat_id, sender_id, content, voice_url, voice_duration)
-                    VALUES (%s, %s, %s, %s, %s)
-                    RETURNING id, created_at
-                """, (int(chat_id), int(sender_id), caption or '', voice_url, float(duration)))
+                voice = media.store(cur, audio_data, audio_type)
+                change_seq = next_change_seq(cur, chat_id)
+                if change_seq is None:
+                    return chat_not_found()
+                
+                cur.execute(f"""
+                    INSERT INTO messages (chat_id, sender_id, content, voice_url, voice_key, voice_duration, change_seq, search_vector)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, {search_vector_sql('%s')})
+                    RETURNING id, created_at, chat_id
+                """, (chat_id, sender_id, caption or '', voice.url, voice.key, duration, change_seq, caption or '', caption or ''))
             else:
                 body_data = json.loads(event.get('body', '{}'))
+                if not session.claim(body_data, session_user, 'sender_id'):
+                    return session.forbidden()
                 chat_id = body_data.get('chat_id')
                 sender_id = body_data.get('sender_id')
                 content = body_data.get('content', '')
@@ -145,14 +174,50 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
                         'body': json.dumps({'error': 'chat_id and sender_id required'})
                     }
+                try:
+                    chat_id = int(chat_id)
+                except (TypeError, ValueError):
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'chat_id must be a number'})
+                    }
                 
-                cur.execute("""
-                    INSERT INTO messages (chat_id, sender_id, content, photo_url, photo_caption)
-                    VALUES (%s, %s, %s, %s, %s)
-                    RETURNING id, created_at
-                """, (chat_id, sender_id, content, photo_url, photo_caption))
+                if not reads.is_member(cur, chat_id, session_user):
+                    return session.forbidden()
+                
+                try:
+                    photo_url, photo_key, photo_thumb_url = media.store_image_data_url(cur, photo_url, images.PHOTO)
+                except (images.ImageError, media.DataURLError) as error:
+                    return {
+                        'statusCode': error.status,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': str(error)})
+                    }
+                change_seq = next_change_seq(cur, chat_id)
+                if change_seq is None:
+                    return chat_not_found()
+                
+                search_text = ' '.join(part for part in (content, photo_caption) if part)
+                cur.execute(f"""
+                    INSERT INTO messages (chat_id, sender_id, content, photo_url, photo_key, photo_thumb_url, photo_caption, change_seq, search_vector)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, {search_vector_sql('%s')})
+                    RETURNING id, created_at, chat_id
+                """, (chat_id, sender_id, content, photo_url, photo_key, photo_thumb_url, photo_caption, change_seq, search_text, search_text))
             
             result = cur.fetchone()
+            
+            # Refresh the chat list preview of every participant; created_at
+            # pins the lookup to the message's partition
+            cur.execute("""
+                UPDATE user_inbox i
+                SET last_message_id = m.id, last_message = m.content, last_message_time = m.created_at,
+                    unread_count = i.unread_count + CASE WHEN i.user_id = m.sender_id THEN 0 ELSE 1 END,
+                    version = nextval('user_inbox_version_seq')
+                FROM messages m
+                WHERE m.id = %s AND m.created_at = %s AND i.chat_id = m.chat_id AND i.left_at IS NULL
+            """, (result[0], result[1]))
+            notify_chat_change(cur, result[2])
             conn.commit()
             
             return {
@@ -172,12 +237,65 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             
             if action == 'edit':
                 new_content = body_data.get('content')
-                cur.execute(
-                    "UPDATE messages SET content = %s, is_edited = TRUE, updated_at = %s WHERE id = %s",
-                    (new_content, datetime.now(), message_id)
-                )
+                edited_text = "concat_ws(' ', %s::text, photo_caption)"
+                edited = None
+                change_seq = message_change_seq(cur, message_id, session_user)
+                if change_seq is not None:
+                    cur.execute(f"""
+                        UPDATE messages
+                        SET content = %s, is_edited = TRUE, updated_at = %s, change_seq = %s,
+                            search_vector = {search_vector_sql(edited_text)}
+                        WHERE id = %s AND sender_id = %s
+                        RETURNING chat_id, created_at
+                    """, (new_content, datetime.now(), change_seq, new_content, new_content, message_id, session_user))
+                    edited = cur.fetchone()
+                
+                if edited:
+                    cur.execute("""
+                        UPDATE user_inbox i SET last_message = m.content, version = nextval('user_inbox_version_seq')
+                        FROM messages m
+                        WHERE m.id = %s AND m.created_at = %s AND i.chat_id = m.chat_id AND i.last_message_id = m.id
+                    """, (message_id, edited[1]))
+                    notify_chat_change(cur, edited[0])
             elif action == 'mark_read':
-                cur.execute("UPDATE messages SET is_read = TRUE WHERE id = %s", (message_id,))
+                # One read cursor per (chat, user): everything up to
+                # message_id is read, and the cursor only moves forward
+                if not session.claim(body_data, session_user, 'user_id'):
+                    return session.forbidden()
+                chat_id = body_data.get('chat_id')
+                user_id = body_data.get('user_id')
+                
+                if not chat_id or not user_id or not message_id:
+                    return {
+                        'statusCode': 400,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': 'chat_id, user_id and message_id required'})
+                    }
+                
+                if not reads.is_member(cur, chat_id, user_id):
+                    return session.forbidden()
+                
+                cur.execute("""
+                    INSERT INTO chat_read_state (chat_id, user_id, last_read_message_id)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT (chat_id, user_id) DO UPDATE
+                    SET last_read_message_id = EXCLUDED.last_read_message_id, updated_at = CURRENT_TIMESTAMP
+                    WHERE chat_read_state.last_read_message_id < EXCLUDED.last_read_message_id
+                    RETURNING last_read_message_id
+                """, (chat_id, user_id, message_id))
+                
+                if cur.fetchone():
+                    cur.execute("""
+                        UPDATE user_inbox
+                        SET unread_count = (
+                                SELECT COUNT(*) FROM messages m
+                                WHERE m.chat_id = %s AND m.id > %s AND m.sender_id IS DISTINCT FROM %s
+                                  AND m.is_system IS NOT TRUE
+                            ),
+                            version = nextval('user_inbox_version_seq')
+                        WHERE chat_id = %s AND user_id = %s
+                    """, (chat_id, message_id, user_id, chat_id, user_id))
+                    cur.execute("SELECT pg_notify('chat_' || %s, ''), pg_notify('inbox_' || %s, '')", (chat_id, user_id))
             
             conn.commit()
             
@@ -192,7 +310,31 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             body_data = json.loads(event.get('body', '{}'))
             message_id = body_data.get('message_id')
             
-            cur.execute("UPDATE messages SET content = '[Удалено]', photo_url = NULL, photo_caption = NULL, voice_url = NULL, voice_duration = NULL WHERE id = %s", (message_id,))
+            deleted = None
+            change_seq = message_change_seq(cur, message_id, session_user)
+            if change_seq is not None:
+                cur.execute("""
+                    WITH old AS (
+                        SELECT id, created_at, photo_key, voice_key FROM messages WHERE id = %s AND sender_id = %s
+                    )
+                    UPDATE messages m
+                    SET content = '[Удалено]', photo_url = NULL, photo_key = NULL, photo_thumb_url = NULL, photo_caption = NULL,
+                        voice_url = NULL, voice_key = NULL, voice_duration = NULL, search_vector = NULL, change_seq = %s
+                    FROM old
+                    WHERE m.id = old.id AND m.created_at = old.created_at
+                    RETURNING m.chat_id, m.created_at, old.photo_key, old.voice_key
+                """, (message_id, session_user, change_seq))
+                deleted = cur.fetchone()
+                if deleted:
+                    media.release(cur, deleted[2:])
+            
+            if deleted:
+                cur.execute("""
+                    UPDATE user_inbox i SET last_message = m.content, version = nextval('user_inbox_version_seq')
+                    FROM messages m
+                    WHERE m.id = %s AND m.created_at = %s AND i.chat_id = m.chat_id AND i.last_message_id = m.id
+                """, (message_id, deleted[1]))
+                notify_chat_change(cur, deleted[0])
             conn.commit()
             
             return {
@@ -209,4 +351,4 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     finally:
         cur.close()
-        conn.close()
\ No newline at end of file
+        db.release_connection(conn)
\ No newline at end of file
@@ -0,0 +1,264 @@
+'''
+Business: Media storage - content-addressed blobs for photos, voice notes and avatars
+Args: MEDIA_STORAGE (s3 or local), MEDIA_BUCKET / S3_ENDPOINT_URL / MEDIA_BASE_URL, MEDIA_ROOT for local
+Returns: StoredMedia (key, url) for uploaded bytes or inline data URLs, preview and thumbnail URLs for images
+
+Identical copies live in every backend function directory that handles
+uploads because each function is deployed on its own; change them together.
+'''
+
+import base64
+import binascii
+import hashlib
+import mimetypes
+import os
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional, Sequence, Tuple
+
+import images
+
+EXTENSIONS = {
+    'image/jpeg': '.jpg',
+    'image/png': '.png',
+    'image/gif': '.gif',
+    'image/webp': '.webp',
+    'audio/webm': '.webm',
+    'audio/ogg': '.ogg',
+    'audio/mpeg': '.mp3',
+    'audio/mp4': '.m4a',
+}
+
+
+class StoredMedia(NamedTuple):
+    key: str
+    url: str
+
+
+class MediaStorage:
+    '''Blob store interface; keys are content hashes, so writes are idempotent.'''
+
+    def put(self, key: str, data: bytes, content_type: str) -> None:
+        raise NotImplementedError
+
+    def get(self, key: str) -> bytes:
+        raise NotImplementedError
+
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def url(self, key: str) -> str:
+        raise NotImplementedError
+
+
+class LocalMediaStorage(MediaStorage):
+    '''Filesystem store for development and tests.'''
+
+    def __init__(self, root: str, base_url: str):
+        self.root = Path(root)
+        self.base_url = base_url.rstrip('/')
+
+    def put(self, key: str, data: bytes, content_type: str) -> None:
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_bytes(data)
+        tmp.replace(path)
+
+    def get(self, key: str) -> bytes:
+        return (self.root / key).read_bytes()
+
+    def delete(self, key: str) -> None:
+        (self.root / key).unlink(missing_ok=True)
+
+    def url(self, key: str) -> str:
+        return f'{self.base_url}/{key}'
+
+
+class S3MediaStorage(MediaStorage):
+    '''S3-compatible bucket served through a CDN base URL.'''
+
+    def __init__(self, bucket: str, endpoint_url: str, base_url: str):
+        import boto3
+
+        self.bucket = bucket
+        self.base_url = base_url.rstrip('/')
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            aws_access_key_id=os.environ['AWS_ACCESS_KEY_ID'],
+            aws_secret_access_key=os.environ['AWS_SECRET_ACCESS_KEY']
+        )
+
+    def put(self, key: str, data: bytes, content_type: str) -> None:
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=bytes(data), ContentType=content_type)
+
+    def get(self, key: str) -> bytes:
+        return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def url(self, key: str) -> str:
+        return f'{self.base_url}/{key}'
+
+
+_storage: Optional[MediaStorage] = None
+
+
+def get_storage() -> MediaStorage:
+    global _storage
+    if _storage is None:
+        if os.environ.get('MEDIA_STORAGE', 's3') == 'local':
+            _storage = LocalMediaStorage(
+                os.environ.get('MEDIA_ROOT', '/tmp/pchat-media'),
+                os.environ.get('MEDIA_BASE_URL', '/media')
+            )
+        else:
+            bucket = os.environ.get('MEDIA_BUCKET', 'files')
+            _storage = S3MediaStorage(
+                bucket,
+                os.environ.get('S3_ENDPOINT_URL', 'https://bucket.poehali.dev'),
+                os.environ.get(
+                    'MEDIA_BASE_URL',
+                    f"https://cdn.poehali.dev/projects/{os.environ.get('AWS_ACCESS_KEY_ID', '')}/bucket"
+                )
+            )
+    return _storage
+
+
+def set_storage(storage: Optional[MediaStorage]) -> None:
+    '''Override the configured backend (tests, local tooling).'''
+    global _storage
+    _storage = storage
+
+
+def media_key(data: bytes, content_type: str) -> str:
+    extension = EXTENSIONS.get(content_type) or mimetypes.guess_extension(content_type) or ''
+    return f'media/{hashlib.sha256(data).hexdigest()}{extension}'
+
+
+def lock_keys(cur, keys: Sequence[str]) -> None:
+    '''Hold the upload lock of each key until the transaction ends.
+
+    Uploads take it before writing a blob and account purges before
+    deleting one, so a purge never deletes a blob an upload just wrote.
+    '''
+    cur.execute(
+        "SELECT pg_advisory_xact_lock(hashtextextended(k, 0)) FROM (SELECT DISTINCT k FROM unnest(%s::varchar[]) AS k ORDER BY k) s",
+        (list(keys),)
+    )
+
+
+def release(cur, keys: Iterable[Optional[str]]) -> None:
+    '''Queue the blobs of keys a row stopped referencing for purging.
+
+    tools/purge_accounts.py deletes each one once nothing references it
+    any more, so a key shared with another upload is safe to release.
+    '''
+    keys = sorted({key for key in keys if key})
+    if keys:
+        cur.execute(
+            "INSERT INTO media_purge_queue (key) SELECT unnest(%s::varchar[]) ON CONFLICT DO NOTHING",
+            (keys,)
+        )
+
+
+def store(cur, data: bytes, content_type: str, source_hash: Optional[str] = None,
+          variant: Optional[str] = None) -> StoredMedia:
+    '''Store bytes once per distinct content; repeats only reuse the key.
+
+    `data` may be any bytes-like object, e.g. a memoryview into the request
+    body. The media_objects row is written in the caller's transaction, so
+    an upload counts as deduplicated only once that transaction commits.
+    Image variants record the hash of the upload they were rendered from.
+
+    A repeat locks the existing row until the caller commits, so account
+    purges (which lock a row before deleting its blob) cannot remove a blob
+    that an uncommitted row is about to reference. The key's upload lock
+    does the same for a purge whose row is already gone, see lock_keys.
+    '''
+    storage = get_storage()
+    key = media_key(data, content_type)
+    lock_keys(cur, [key])
+    cur.execute("""
+        INSERT INTO media_objects (key, content_type, size, source_hash, variant)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (key) DO UPDATE SET size = EXCLUDED.size
+        RETURNING (xmax = 0)
+    """, (key, content_type, len(data), source_hash, variant))
+    if cur.fetchone()[0]:
+        storage.put(key, data, content_type)
+    return StoredMedia(key, storage.url(key))
+
+
+class DataURLError(ValueError):
+    '''An upload that is not a well-formed base64 data URL; answered with `status`.'''
+
+    status = 400
+
+
+def parse_data_url(value: str) -> Tuple[str, bytes]:
+    header, _, payload = value.partition(',')
+    content_type = header[len('data:'):].split(';')[0] or 'application/octet-stream'
+    if not header.endswith(';base64'):
+        raise DataURLError('Only base64 data URLs are supported')
+    try:
+        return content_type, base64.b64decode(payload)
+    except binascii.Error:
+        raise DataURLError('Invalid base64 in data URL') from None
+
+
+def store_data_url(cur, value: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    '''Move an inline data URL into storage and return (url, key).
+
+    Anything that is not a data URL (an existing link, None) passes through.
+    '''
+    if not value or not value.startswith('data:'):
+        return value, None
+    content_type, data = parse_data_url(value)
+    stored = store(cur, data, content_type)
+    return stored.url, stored.key
+
+
+def store_image_data_url(cur, value: Optional[str], variants: Sequence[images.Variant],
+                         current: Optional[Tuple[Optional[str], Optional[str], Optional[str]]] = None
+                         ) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    '''Store a photo or avatar data URL as its rendered variants and return
+    (preview url, preview key, thumbnail url).
+
+    The same picture uploaded again reuses the variants rendered the first
+    time. Uploads the pipeline leaves alone are stored as they came and
+    serve as their own thumbnail; anything that is not a data URL passes
+    through like in store_data_url. `current` is the stored
+    (url, key, thumbnail url) being replaced: sending back its url keeps it
+    as it is, key included, so the purge still sees the blob referenced.
+    Raises images.ImageError for a photo that cannot be rendered and
+    DataURLError for a malformed upload, so nothing of it is stored.
+    '''
+    if value is not None and not isinstance(value, str):
+        raise DataURLError('Images must be sent as data URLs')
+    if value and current and value in (current[0], current[2]):
+        return current
+    if not value or not value.startswith('data:'):
+        return value, None, value
+    content_type, data = parse_data_url(value)
+    source_hash = hashlib.sha256(data).hexdigest()
+    names = [variant.name for variant in variants]
+
+    cur.execute(
+        "SELECT variant, key FROM media_objects WHERE source_hash = %s AND variant = ANY(%s) FOR SHARE",
+        (source_hash, names)
+    )
+    keys = dict(cur.fetchall())
+    if len(keys) < len(names):
+        rendered = images.process(data, content_type, variants)
+        if rendered is None:
+            stored = store(cur, data, content_type)
+            return stored.url, stored.key, stored.url
+        keys = {
+            name: store(cur, blob, images.OUTPUT_TYPE, source_hash, name).key
+            for name, blob in rendered.items()
+        }
+
+    storage = get_storage()
+    return storage.url(keys['preview']), keys['preview'], storage.url(keys['thumb'])
@@ -0,0 +1,76 @@
+'''
+Business: multipart/form-data parsing over raw request bytes
+Args: body bytes and the request Content-Type header
+Returns: Part tuples whose data is a memoryview into the body (no copies)
+'''
+
+import re
+from typing import Dict, Iterator, NamedTuple, Optional
+
+_PARAM = re.compile(r';\s*([\w-]+)=(?:"([^"]*)"|([^;\s]*))')
+
+
+class MultipartError(ValueError):
+    pass
+
+
+class Part(NamedTuple):
+    name: Optional[str]
+    filename: Optional[str]
+    content_type: Optional[str]
+    data: memoryview
+
+    def text(self) -> str:
+        return str(self.data, 'utf-8')
+
+
+def _params(value: str) -> Dict[str, str]:
+    return {m.group(1).lower(): m.group(2) if m.group(2) is not None else m.group(3) for m in _PARAM.finditer(value)}
+
+
+def get_boundary(content_type: str) -> bytes:
+    boundary = _params(content_type).get('boundary')
+    if not boundary:
+        raise MultipartError('Missing multipart boundary')
+    return boundary.encode('latin-1')
+
+
+def iter_parts(body: bytes, boundary: bytes) -> Iterator[Part]:
+    '''Yield parts one at a time; only the small header blocks are copied.'''
+    view = memoryview(body)
+    delimiter = b'--' + boundary
+    separator = b'\r\n' + delimiter
+
+    pos = body.find(delimiter)
+    if pos < 0:
+        raise MultipartError('Boundary not found in body')
+    pos += len(delimiter)
+
+    while True:
+        if body.startswith(b'--', pos):
+            return
+        if not body.startswith(b'\r\n', pos):
+            raise MultipartError('Malformed boundary line')
+        pos += 2
+
+        headers_end = body.find(b'\r\n\r\n', pos)
+        if headers_end < 0:
+            raise MultipartError('Unterminated part headers')
+        headers = {}
+        for line in body[pos:headers_end].split(b'\r\n'):
+            key, _, value = line.decode('utf-8', 'replace').partition(':')
+            headers[key.strip().lower()] = value.strip()
+
+        data_start = headers_end + 4
+        data_end = body.find(separator, data_start)
+        if data_end < 0:
+            raise MultipartError('Unterminated part body')
+
+        disposition = _params(headers.get('content-disposition', ''))
+        yield Part(
+            disposition.get('name'),
+            disposition.get('filename'),
+            headers.get('content-type'),
+            view[data_start:data_end]
+        )
+        pos = data_end + len(separator)
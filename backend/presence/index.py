@@ -0,0 +1,169 @@
+'''
+Business: Presence - heartbeats, typing indicators and who is online in a set of chats
+Args: event with httpMethod, body {action: heartbeat | typing_start | typing_stop, chat_id}, queryStringParameters chat_ids
+Returns: HTTP response with online and typing members per chat and last_seen of the rest
+'''
+
+import json
+from typing import Dict, Any, List, Set, Tuple
+
+import db
+import metrics
+import presence
+import queries
+import session
+
+MAX_CHATS = 50
+
+CHAT_MEMBERS = queries.Statement('presence_chat_members', """
+    SELECT cp.chat_id, u.id, u.hide_online_status, u.last_seen
+    FROM chat_participants cp
+    JOIN users u ON u.id = cp.user_id
+    WHERE cp.chat_id = ANY(%s::int[]) AND cp.left_at IS NULL
+""")
+IS_MEMBER = queries.Statement(
+    'presence_is_member',
+    "SELECT 1 FROM chat_participants WHERE chat_id = %s AND user_id = %s AND left_at IS NULL"
+)
+
+def json_response(status: int, payload: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'statusCode': status,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps(payload)
+    }
+
+def parse_chat_ids(value: str) -> List[int]:
+    return sorted({int(part) for part in value.split(',') if part.strip()})
+
+def chat_members(cur, chat_ids: List[int]) -> Tuple[Dict[int, List[int]], Set[int], Dict[int, Any]]:
+    '''Active members of each chat, those hiding their online status, and known last_seen times.'''
+    CHAT_MEMBERS.execute(cur, (chat_ids,))
+    members: Dict[int, List[int]] = {chat_id: [] for chat_id in chat_ids}
+    hidden = set()
+    last_seen = {}
+    for chat_id, member_id, hide_online_status, seen_at in cur.fetchall():
+        members[chat_id].append(member_id)
+        if hide_online_status:
+            hidden.add(member_id)
+        elif seen_at is not None:
+            last_seen[member_id] = seen_at
+    return members, hidden, last_seen
+
+def chats_presence(user_id: int, members: Dict[int, List[int]], hidden: Set[int],
+                   last_seen: Dict[int, Any]) -> Dict[str, Any]:
+    '''Online and typing members of each chat, and last_seen of visible members who are offline.
+
+    Members who hide their online status are never reported online and
+    their last_seen is left out; typing in a chat they share is still shown.
+    When the presence store is down nobody is reported and "unknown" is
+    set, so clients keep what they showed before.
+    '''
+    visible = {member_id for ids in members.values() for member_id in ids} - hidden
+    found = presence.lookup(visible, members)
+    if found is None:
+        return {
+            'chats': {str(chat_id): {'online': [], 'typing': []} for chat_id in members},
+            'last_seen': {},
+            'unknown': True,
+        }
+    online, typing = found
+
+    chats = {}
+    for chat_id, ids in members.items():
+        chats[str(chat_id)] = {
+            'online': sorted(member_id for member_id in ids if member_id in online),
+            'typing': sorted(member_id for member_id in typing[chat_id] if member_id != user_id),
+        }
+
+    return {
+        'unknown': False,
+        'chats': chats,
+        'last_seen': {
+            str(member_id): seen_at.isoformat()
+            for member_id, seen_at in last_seen.items()
+            if member_id not in online
+        }
+    }
+
+@metrics.instrument('presence')
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    method: str = event.get('httpMethod', 'GET')
+
+    # Handle CORS OPTIONS
+    if method == 'OPTIONS':
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': ''
+        }
+
+    conn = db.get_connection()
+    cur = conn.cursor()
+
+    try:
+        session_user = session.authenticate(event, cur)
+        if session_user is None:
+            return session.unauthorized()
+
+        if method == 'GET':
+            # Presence of the members of one or more chats, e.g. the chat list
+            params = event.get('queryStringParameters') or {}
+            try:
+                chat_ids = parse_chat_ids(params.get('chat_ids') or params.get('chat_id') or '')
+            except ValueError:
+                return json_response(400, {'error': 'chat_ids must be a comma-separated list of numbers'})
+
+            if not chat_ids:
+                return json_response(400, {'error': 'chat_ids required'})
+            if len(chat_ids) > MAX_CHATS:
+                return json_response(400, {'error': f'At most {MAX_CHATS} chats per request'})
+
+            members, hidden, last_seen = chat_members(cur, chat_ids)
+            # Only members may see who is around in a chat
+            if any(session_user not in ids for ids in members.values()):
+                return session.forbidden()
+            response = json_response(200, chats_presence(session_user, members, hidden, last_seen))
+
+        elif method == 'POST':
+            body_data = json.loads(event.get('body') or '{}')
+            action = body_data.get('action')
+
+            if action == 'heartbeat':
+                presence.heartbeat(session_user)
+                response = json_response(200, {'success': True, 'interval': presence.PRESENCE_TTL / 3})
+
+            elif action in ('typing_start', 'typing_stop'):
+                chat_id = body_data.get('chat_id')
+                if not isinstance(chat_id, int):
+                    return json_response(400, {'error': 'chat_id must be a number'})
+
+                IS_MEMBER.execute(cur, (chat_id, session_user))
+                if not cur.fetchone():
+                    return session.forbidden()
+
+                presence.heartbeat(session_user)
+                stored = presence.set_typing(chat_id, session_user, action == 'typing_start')
+                response = json_response(200, {'success': stored})
+
+            else:
+                return json_response(400, {'error': 'Invalid action'})
+
+        else:
+            return json_response(400, {'error': 'Invalid request'})
+
+        # Coalesced last_seen write for every heartbeat this instance took
+        if presence.flush_due():
+            conn.rollback()
+            presence.flush(conn, cur)
+
+        return response
+
+    finally:
+        cur.close()
+        db.release_connection(conn)
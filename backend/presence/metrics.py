@@ -0,0 +1,177 @@
+'''
+Business: Per-invocation metrics - statement counts and timings, connect/serialize/wait phases, slow-query plans
+Args: METRICS=1 enables recording (checked on every invocation), METRICS_SLOW_QUERY_MS sets the EXPLAIN threshold
+Returns: one JSON record per invocation and one per slow statement, written to stdout unless set_sink overrides it
+
+Identical copies live in every backend function directory because each
+function is deployed on its own; change them together.
+'''
+
+import functools
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+import psycopg2
+import psycopg2.extensions
+
+SLOW_QUERY_MS = float(os.environ.get('METRICS_SLOW_QUERY_MS', '200'))
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'EXECUTE')
+MAX_SQL_LENGTH = 2000
+
+Handler = Callable[[Dict[str, Any], Any], Dict[str, Any]]
+
+_local = threading.local()
+
+
+def _print(record: Dict[str, Any]) -> None:
+    print(json.dumps(record, default=str), flush=True)
+
+
+_sink: Callable[[Dict[str, Any]], None] = _print
+
+
+def set_sink(sink: Optional[Callable[[Dict[str, Any]], None]]) -> None:
+    '''Send records somewhere other than stdout (tests, local tooling).'''
+    global _sink
+    _sink = sink or _print
+
+
+def enabled() -> bool:
+    return os.environ.get('METRICS') == '1'
+
+
+def current() -> Optional[Dict[str, Any]]:
+    '''The record of the invocation running on this thread, if it is being measured.'''
+    return getattr(_local, 'record', None)
+
+
+class phase:
+    '''Accumulate wall time spent in a named phase of the current invocation.'''
+
+    __slots__ = ('name', 'record', 'started')
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self) -> None:
+        self.record = current()
+        if self.record is not None:
+            self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info) -> None:
+        if self.record is not None:
+            phases = self.record['phases']
+            phases[self.name] = phases.get(self.name, 0.0) + (time.perf_counter() - self.started) * 1000
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    '''Cursor that counts and times statements, and explains slow ones.'''
+
+    def execute(self, query, vars=None):
+        record = current()
+        if record is None:
+            return super().execute(query, vars)
+        started = time.perf_counter()
+        result = super().execute(query, vars)
+        elapsed = (time.perf_counter() - started) * 1000
+        record['queries'] += 1
+        record['query_ms'] += elapsed
+        if elapsed >= SLOW_QUERY_MS:
+            record['slow_queries'] += 1
+            _sink({
+                'type': 'slow_query',
+                'function': record['function'],
+                'duration_ms': round(elapsed, 2),
+                'sql': _text(query)[:MAX_SQL_LENGTH],
+                'plan': _explain(self.connection, query, vars),
+            })
+        return result
+
+
+def attach(conn: psycopg2.extensions.connection) -> None:
+    '''Instrument cursors of a connection checked out by a measured invocation.
+
+    Connections checked out while metrics are off keep psycopg2's plain
+    cursor, so a disabled layer costs nothing per statement.
+    '''
+    if current() is not None:
+        conn.cursor_factory = InstrumentedCursor
+
+
+def _text(query) -> str:
+    return query.decode('utf-8', 'replace') if isinstance(query, bytes) else str(query)
+
+
+def _explain(conn, query, vars) -> Any:
+    '''EXPLAIN a statement that already ran, without disturbing its results.
+
+    A savepoint keeps a failing EXPLAIN from aborting the caller's
+    transaction.
+    '''
+    if not _text(query).lstrip().upper().startswith(EXPLAINABLE):
+        return None
+    cur = psycopg2.extensions.cursor(conn)
+    savepoint = not conn.autocommit
+    try:
+        if savepoint:
+            cur.execute('SAVEPOINT metrics_explain')
+        try:
+            cur.execute(f'EXPLAIN (FORMAT JSON) {_text(query)}', vars)
+            plan = cur.fetchone()[0]
+        except psycopg2.Error as error:
+            if savepoint:
+                cur.execute('ROLLBACK TO SAVEPOINT metrics_explain')
+            return f'EXPLAIN failed: {error}'
+        if savepoint:
+            cur.execute('RELEASE SAVEPOINT metrics_explain')
+        return plan
+    except psycopg2.Error as error:
+        return f'EXPLAIN failed: {error}'
+    finally:
+        cur.close()
+
+
+def instrument(function: str) -> Callable[[Handler], Handler]:
+    '''Decorate a cloud-function handler so each invocation emits one record.'''
+    return functools.partial(_instrument, function)
+
+
+def _instrument(function: str, handler: Handler) -> Handler:
+    @functools.wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        if not enabled() or current() is not None:
+            return handler(event, context)
+
+        record = {
+            'type': 'invocation',
+            'function': function,
+            'method': event.get('httpMethod'),
+            'status': None,
+            'queries': 0,
+            'query_ms': 0.0,
+            'slow_queries': 0,
+            'phases': {},
+        }
+        _local.record = record
+        started = time.perf_counter()
+        try:
+            response = handler(event, context)
+            record['status'] = response.get('statusCode')
+            body = response.get('body') or ''
+            record['response_bytes'] = len(body.encode('utf-8') if isinstance(body, str) else body)
+            return response
+        except Exception as error:
+            record['status'] = 500
+            record['error'] = type(error).__name__
+            raise
+        finally:
+            _local.record = None
+            record['total_ms'] = round((time.perf_counter() - started) * 1000, 2)
+            record['query_ms'] = round(record['query_ms'], 2)
+            record['phases'] = {name: round(ms, 2) for name, ms in record['phases'].items()}
+            _sink(record)
+
+    return wrapper
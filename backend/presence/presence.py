@@ -0,0 +1,257 @@
+'''
+Business: Presence - who is online and who is typing, held in an expiring store instead of the users table
+Args: PRESENCE_TTL, TYPING_TTL and PRESENCE_FLUSH_INTERVAL seconds; CACHE_REDIS_URL shares the store between instances
+Returns: online and typing lookups for many users at once, and coalesced users.last_seen writes
+
+Heartbeats only touch the store. Each instance also remembers the newest
+heartbeat of every user it served and writes them all to users.last_seen
+in one statement at most once per PRESENCE_FLUSH_INTERVAL, so a client
+polling every second costs one row update per interval instead of one per
+poll. last_seen is therefore up to that interval behind for offline users.
+
+A store that cannot be reached makes presence unknown: reads answer
+with "unknown": true instead of failing, and heartbeats still reach
+users.last_seen.
+
+Without CACHE_REDIS_URL every instance keeps its own store, so users
+served by another instance look offline; a warning is logged once per
+instance when that fallback is taken.
+'''
+
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, TypeVar
+
+import queries
+
+T = TypeVar('T')
+
+PRESENCE_TTL = float(os.environ.get('PRESENCE_TTL', '30'))
+TYPING_TTL = float(os.environ.get('TYPING_TTL', '6'))
+FLUSH_INTERVAL = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', '30'))
+
+FLUSH_LAST_SEEN = queries.Statement('flush_last_seen', """
+    UPDATE users u
+    SET last_seen = GREATEST(u.last_seen, to_timestamp(s.seen)::timestamp)
+    FROM unnest(%s::int[], %s::float8[]) AS s(id, seen)
+    WHERE u.id = s.id
+""")
+
+
+class PresenceStore:
+    '''Expiring heartbeats and typing flags; times are Unix seconds.'''
+
+    def touch(self, user_id: int, at: float) -> None:
+        raise NotImplementedError
+
+    def heartbeats(self, user_ids: Iterable[int]) -> Dict[int, float]:
+        '''Last heartbeat of each given user that is still online.'''
+        raise NotImplementedError
+
+    def set_typing(self, chat_id: int, user_id: int, typing: bool) -> None:
+        raise NotImplementedError
+
+    def typing(self, members: Dict[int, Iterable[int]]) -> Dict[int, List[int]]:
+        '''The given users of each chat who are currently typing in it.'''
+        raise NotImplementedError
+
+
+class MemoryPresenceStore(PresenceStore):
+    '''Per-instance store; the default, and the stand-in for tests.'''
+
+    def __init__(self):
+        self.seen: Dict[int, float] = {}
+        self.typing_until: Dict[Tuple[int, int], float] = {}
+        self.lock = threading.Lock()
+
+    def touch(self, user_id: int, at: float) -> None:
+        with self.lock:
+            self.seen[user_id] = max(at, self.seen.get(user_id, 0.0))
+
+    def heartbeats(self, user_ids: Iterable[int]) -> Dict[int, float]:
+        online_since = time.time() - PRESENCE_TTL
+        with self.lock:
+            return {
+                user_id: self.seen[user_id]
+                for user_id in user_ids
+                if self.seen.get(user_id, 0.0) > online_since
+            }
+
+    def set_typing(self, chat_id: int, user_id: int, typing: bool) -> None:
+        with self.lock:
+            if typing:
+                self.typing_until[(chat_id, user_id)] = time.time() + TYPING_TTL
+            else:
+                self.typing_until.pop((chat_id, user_id), None)
+
+    def typing(self, members: Dict[int, Iterable[int]]) -> Dict[int, List[int]]:
+        now = time.time()
+        with self.lock:
+            return {
+                chat_id: [user_id for user_id in user_ids if self.typing_until.get((chat_id, user_id), 0.0) > now]
+                for chat_id, user_ids in members.items()
+            }
+
+    def prune(self) -> None:
+        '''Forget users who went offline and typing flags that ran out.'''
+        now = time.time()
+        with self.lock:
+            self.seen = {user_id: at for user_id, at in self.seen.items() if at > now - PRESENCE_TTL}
+            self.typing_until = {key: until for key, until in self.typing_until.items() if until > now}
+
+
+class RedisPresenceStore(PresenceStore):
+    '''Store shared by every warm instance; Redis expires the keys.'''
+
+    def __init__(self, url: str):
+        import redis
+
+        self.client = redis.Redis.from_url(url, socket_timeout=0.1, socket_connect_timeout=0.1)
+
+    def touch(self, user_id: int, at: float) -> None:
+        self.client.set(f'presence:{user_id}', repr(at), ex=int(PRESENCE_TTL))
+
+    def heartbeats(self, user_ids: Iterable[int]) -> Dict[int, float]:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        values = self.client.mget([f'presence:{user_id}' for user_id in user_ids])
+        return {user_id: float(value) for user_id, value in zip(user_ids, values) if value is not None}
+
+    def set_typing(self, chat_id: int, user_id: int, typing: bool) -> None:
+        if typing:
+            self.client.set(f'typing:{chat_id}:{user_id}', b'1', ex=int(TYPING_TTL))
+        else:
+            self.client.delete(f'typing:{chat_id}:{user_id}')
+
+    def typing(self, members: Dict[int, Iterable[int]]) -> Dict[int, List[int]]:
+        # Every chat's flags in one MGET rather than a round trip per chat
+        pairs = [(chat_id, user_id) for chat_id, user_ids in members.items() for user_id in user_ids]
+        typing: Dict[int, List[int]] = {chat_id: [] for chat_id in members}
+        if not pairs:
+            return typing
+        values = self.client.mget([f'typing:{chat_id}:{user_id}' for chat_id, user_id in pairs])
+        for (chat_id, user_id), value in zip(pairs, values):
+            if value is not None:
+                typing[chat_id].append(user_id)
+        return typing
+
+
+_store: Optional[PresenceStore] = None
+_unflushed: Dict[int, float] = {}
+_unflushed_lock = threading.Lock()
+_last_flush = time.monotonic()
+_store_failing = False
+
+
+def _warn(message: str, **fields) -> None:
+    print(json.dumps({'type': 'warning', 'component': 'presence', 'message': message, **fields}, default=str), flush=True)
+
+
+def get_store() -> PresenceStore:
+    global _store
+    if _store is None:
+        url = os.environ.get('CACHE_REDIS_URL')
+        if url:
+            _store = RedisPresenceStore(url)
+        else:
+            _warn('CACHE_REDIS_URL is not set; presence is per instance and users served elsewhere look offline')
+            _store = MemoryPresenceStore()
+    return _store
+
+
+def set_store(store: Optional[PresenceStore]) -> None:
+    '''Override the configured store (tests, local tooling).'''
+    global _store
+    _store = store
+
+
+def _store_call(action: str, call: Callable[[], T]) -> Optional[T]:
+    '''Run a store call; None when the store failed.
+
+    A failing shared store makes presence unknown rather than failing the
+    request. The first failure of a run is logged, and so is the recovery.
+    '''
+    global _store_failing
+    try:
+        result = call()
+    except Exception as error:
+        if not _store_failing:
+            _store_failing = True
+            _warn('presence store failed; presence is unknown until it recovers', action=action, error=repr(error))
+        return None
+    if _store_failing:
+        _store_failing = False
+        _warn('presence store recovered', action=action)
+    return result
+
+
+def lookup(user_ids: Iterable[int], members: Dict[int, Iterable[int]]
+           ) -> Optional[Tuple[Dict[int, float], Dict[int, List[int]]]]:
+    '''Heartbeats of the given users that are still online and the typing
+    members of each chat, or None when the store cannot tell.'''
+    store = get_store()
+    online = _store_call('heartbeats', lambda: store.heartbeats(user_ids))
+    if online is None:
+        return None
+    typing = _store_call('typing', lambda: store.typing(members))
+    if typing is None:
+        return None
+    return online, typing
+
+
+def heartbeat(user_id: int) -> None:
+    '''Record a heartbeat; users.last_seen gets it even when the store is down.'''
+    now = time.time()
+    _store_call('touch', lambda: get_store().touch(user_id, now))
+    with _unflushed_lock:
+        _unflushed[user_id] = now
+
+
+def set_typing(chat_id: int, user_id: int, typing: bool) -> bool:
+    '''Set or clear a typing flag; False when the store failed.'''
+    def call() -> bool:
+        get_store().set_typing(chat_id, user_id, typing)
+        return True
+
+    return _store_call('set_typing', call) is not None
+
+
+def flush_due() -> bool:
+    return time.monotonic() - _last_flush >= FLUSH_INTERVAL
+
+
+def flush(conn, cur) -> int:
+    '''Write the heartbeats seen since the last flush to users.last_seen
+    and commit.
+
+    A failed write is rolled back and logged, and its heartbeats are put
+    back for the next flush, so it never fails the request that ran it.
+    Returns the number of users written.
+    '''
+    global _unflushed, _last_flush
+    with _unflushed_lock:
+        seen, _unflushed = _unflushed, {}
+        _last_flush = time.monotonic()
+    store = get_store()
+    if isinstance(store, MemoryPresenceStore):
+        store.prune()
+    if not seen:
+        return 0
+    try:
+        FLUSH_LAST_SEEN.execute(cur, (list(seen), list(seen.values())))
+        conn.commit()
+    except Exception as error:
+        try:
+            conn.rollback()
+        except Exception:
+            # A broken connection is discarded when it is released
+            pass
+        with _unflushed_lock:
+            for user_id, at in seen.items():
+                _unflushed[user_id] = max(at, _unflushed.get(user_id, 0.0))
+        _warn('last_seen flush failed; retrying on the next flush', users=len(seen), error=repr(error))
+        return 0
+    return len(seen)
@@ -0,0 +1,486 @@
+'''
+Business: Account deletion jobs - mark the account deleted at once, purge what it leaves behind in short batches
+Args: ACCOUNT_PURGE_BATCH rows per batch (default 500); run_once() is driven by tools/purge_accounts.py
+Returns: the job's stage and counters after each batch, observable in deletion_jobs
+
+A job moves through its stages in order, one committed batch per call:
+
+  messages     the user's messages, oldest first, emptied the way a
+               delete by the user does it so delta syncs see them go
+  chats        the user's memberships: inbox rows, read state, previews;
+               chats left without an active member are queued
+  empty_chats  queued chats with their remaining messages, one at a time
+  account      the users row itself
+  media        stored blobs of everything purged that nothing references
+               any more, together with their rendered variants; the blobs
+               are deleted only once the batch that dropped their rows
+               has committed
+
+Every batch is its own short transaction, so no lock on messages is held
+for longer than one batch takes. A failed batch is rolled back, recorded
+in last_error and retried on a later call.
+
+purge_released() applies the media stage's checks to the keys of
+messages their senders deleted, queued in media_purge_queue.
+'''
+
+import os
+import traceback
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+import cache
+import media
+import queries
+import session
+
+BATCH_SIZE = int(os.environ.get('ACCOUNT_PURGE_BATCH', '500'))
+# Same text as a message deleted by its sender
+TOMBSTONE = '[Удалено]'
+# Shown in place of the name of a personal chat's deleted peer
+DELETED_ACCOUNT_NAME = 'Удалённый аккаунт'
+STAGES = ('messages', 'chats', 'empty_chats', 'account', 'media', 'done')
+COUNTERS = ('messages_deleted', 'chats_left', 'chats_deleted', 'media_deleted')
+
+MARK_DELETED = queries.Statement(
+    'mark_user_deleted',
+    "UPDATE users SET deleted_at = CURRENT_TIMESTAMP WHERE id = %s AND deleted_at IS NULL RETURNING id"
+)
+CREATE_JOB = queries.Statement(
+    'create_deletion_job',
+    "INSERT INTO deletion_jobs (user_id) VALUES (%s) RETURNING id, stage"
+)
+# The job that waited longest; a job another worker is running is skipped
+CLAIM_JOB = queries.Statement('claim_deletion_job', """
+    SELECT id, user_id, stage FROM deletion_jobs
+    WHERE finished_at IS NULL
+    ORDER BY updated_at, id
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+""")
+# The user's messages that still have something to empty
+NEXT_SENT = queries.Statement('purge_next_sent', """
+    SELECT id, chat_id, photo_key, voice_key FROM messages
+    WHERE sender_id = %s
+      AND NOT (content IS NOT DISTINCT FROM %s AND photo_url IS NULL AND voice_url IS NULL AND photo_caption IS NULL)
+    ORDER BY id
+    LIMIT %s
+""")
+LOCK_CHATS = queries.Statement(
+    'purge_lock_chats',
+    "SELECT id FROM chats WHERE id = ANY(%s::int[]) ORDER BY id FOR UPDATE"
+)
+TOMBSTONE_SENT = queries.Statement('purge_tombstone_sent', """
+    UPDATE messages
+    SET content = %s, photo_url = NULL, photo_key = NULL, photo_thumb_url = NULL, photo_caption = NULL,
+        voice_url = NULL, voice_key = NULL, voice_duration = NULL, search_vector = NULL,
+        change_seq = nextval('messages_change_seq')
+    WHERE id = ANY(%s::int[]) AND sender_id = %s
+    RETURNING chat_id, change_seq
+""")
+ADVANCE_CHATS = queries.Statement('purge_advance_chats', """
+    UPDATE chats c SET last_change_seq = s.seq
+    FROM unnest(%s::int[], %s::bigint[]) AS s(id, seq)
+    WHERE c.id = s.id AND c.last_change_seq < s.seq
+""")
+TOMBSTONE_PREVIEWS = queries.Statement('purge_tombstone_previews', """
+    UPDATE user_inbox
+    SET last_message = %s, version = nextval('user_inbox_version_seq')
+    WHERE chat_id = ANY(%s::int[]) AND last_message_id = ANY(%s::int[])
+    RETURNING user_id
+""")
+DELETE_CHAT_MESSAGES = queries.Statement('purge_chat_messages', """
+    DELETE FROM messages
+    WHERE id IN (SELECT id FROM messages WHERE chat_id = %s ORDER BY id LIMIT %s)
+      AND chat_id = %s
+    RETURNING photo_key, voice_key
+""")
+QUEUE_MEDIA = queries.Statement('queue_purged_media', """
+    INSERT INTO deletion_job_media (job_id, key)
+    SELECT %s, unnest(%s::varchar[])
+    ON CONFLICT DO NOTHING
+""")
+MEMBERSHIPS = queries.Statement(
+    'purge_memberships',
+    "SELECT chat_id FROM chat_participants WHERE user_id = %s ORDER BY chat_id LIMIT %s"
+)
+QUEUE_EMPTY_CHATS = queries.Statement('queue_empty_chats', """
+    INSERT INTO deletion_job_chats (job_id, chat_id)
+    SELECT %s, c.id
+    FROM unnest(%s::int[]) AS c(id)
+    WHERE NOT EXISTS (SELECT 1 FROM chat_participants cp WHERE cp.chat_id = c.id AND cp.left_at IS NULL)
+    ON CONFLICT DO NOTHING
+""")
+NEXT_EMPTY_CHAT = queries.Statement(
+    'next_empty_chat',
+    "SELECT chat_id FROM deletion_job_chats WHERE job_id = %s ORDER BY chat_id LIMIT 1"
+)
+HAS_ACTIVE_MEMBER = queries.Statement(
+    'chat_has_active_member',
+    "SELECT 1 FROM chat_participants WHERE chat_id = %s AND left_at IS NULL LIMIT 1"
+)
+# Keys of messages their senders deleted; a key another worker is
+# checking is skipped
+NEXT_RELEASED = queries.Statement(
+    'next_released_media',
+    "SELECT key FROM media_purge_queue ORDER BY key LIMIT %s FOR UPDATE SKIP LOCKED"
+)
+NEXT_MEDIA = queries.Statement(
+    'next_purged_media',
+    "SELECT key FROM deletion_job_media WHERE job_id = %s ORDER BY key LIMIT %s"
+)
+# A blob and every variant rendered from the same upload
+MEDIA_GROUPS = queries.Statement('purged_media_groups', """
+    SELECT o.key, COALESCE(s.key, o.key)
+    FROM media_objects o
+    LEFT JOIN media_objects s ON s.source_hash = o.source_hash
+    WHERE o.key = ANY(%s::varchar[])
+""")
+# Locked so no upload can start reusing them while references are checked
+LOCK_MEDIA = queries.Statement(
+    'lock_purged_media',
+    "SELECT key FROM media_objects WHERE key = ANY(%s::varchar[]) ORDER BY key FOR UPDATE"
+)
+LIVE_MEDIA = queries.Statement(
+    'live_purged_media',
+    "SELECT key FROM media_objects WHERE key = ANY(%s::varchar[])"
+)
+REFERENCED_MEDIA = queries.Statement('referenced_media', """
+    SELECT k.key
+    FROM unnest(%s::varchar[]) AS k(key)
+    WHERE EXISTS (SELECT 1 FROM messages WHERE photo_key = k.key)
+       OR EXISTS (SELECT 1 FROM messages WHERE voice_key = k.key)
+       OR EXISTS (SELECT 1 FROM users WHERE avatar_key = k.key)
+       OR EXISTS (SELECT 1 FROM chats WHERE avatar_key = k.key)
+""")
+
+
+def queue(cur, user_id: int) -> Optional[Dict[str, Any]]:
+    '''Mark the account deleted, revoke its sessions and queue the purge.
+
+    Runs in the caller's transaction and touches only the users row and
+    the job row. Returns the job, or None when the account does not exist
+    or is already being deleted.
+    '''
+    MARK_DELETED.execute(cur, (user_id,))
+    if not cur.fetchone():
+        return None
+    session.revoke(cur, user_id)
+    CREATE_JOB.execute(cur, (user_id,))
+    job_id, stage = cur.fetchone()
+    return {'id': job_id, 'stage': stage}
+
+
+def status(cur, job_id: int) -> Optional[Dict[str, Any]]:
+    cur.execute(f"""
+        SELECT id, user_id, stage, {', '.join(COUNTERS)}, attempts, last_error, created_at, updated_at, finished_at
+        FROM deletion_jobs WHERE id = %s
+    """, (job_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    names = ('id', 'user_id', 'stage') + COUNTERS + ('attempts', 'last_error', 'created_at', 'updated_at', 'finished_at')
+    return dict(zip(names, row))
+
+
+def _queue_media(cur, job_id: int, keys: Iterable[Optional[str]]) -> None:
+    keys = sorted({key for key in keys if key})
+    if keys:
+        QUEUE_MEDIA.execute(cur, (job_id, keys))
+
+
+def _purge_messages(cur, job_id: int, user_id: int, batch: int, progress: Dict[str, int]) -> bool:
+    NEXT_SENT.execute(cur, (user_id, TOMBSTONE, batch))
+    rows = cur.fetchall()
+    if not rows:
+        return True
+    message_ids = [row[0] for row in rows]
+    chat_ids = sorted({row[1] for row in rows})
+    _queue_media(cur, job_id, (key for row in rows for key in row[2:]))
+
+    # Each row takes a change_seq of its own under the chat's lock, as in
+    # next_change_seq of the messages function, so delta cursors see
+    # every one of them
+    LOCK_CHATS.execute(cur, (chat_ids,))
+    TOMBSTONE_SENT.execute(cur, (TOMBSTONE, message_ids, user_id))
+    latest: Dict[int, int] = {}
+    for chat_id, change_seq in cur.fetchall():
+        latest[chat_id] = max(change_seq, latest.get(chat_id, 0))
+    ADVANCE_CHATS.execute(cur, (list(latest), list(latest.values())))
+    TOMBSTONE_PREVIEWS.execute(cur, (TOMBSTONE, chat_ids, message_ids))
+    inbox_users = sorted({row[0] for row in cur.fetchall()})
+
+    cur.execute("SELECT pg_notify('chat_' || id, '') FROM unnest(%s::int[]) AS id", (chat_ids,))
+    cur.execute("SELECT pg_notify('inbox_' || id, '') FROM unnest(%s::int[]) AS id", (inbox_users,))
+    progress['messages_deleted'] += len(rows)
+    return len(rows) < batch
+
+
+def _leave_chats(cur, job_id: int, user_id: int, batch: int, progress: Dict[str, int],
+                 touched: Set[int]) -> bool:
+    MEMBERSHIPS.execute(cur, (user_id, batch))
+    chat_ids = [row[0] for row in cur.fetchall()]
+    if not chat_ids:
+        return True
+
+    cur.execute("UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = ANY(%s)", (chat_ids,))
+    cur.execute("DELETE FROM chat_participants WHERE user_id = %s AND chat_id = ANY(%s)", (user_id, chat_ids))
+    cur.execute("DELETE FROM chat_read_state WHERE user_id = %s AND chat_id = ANY(%s)", (user_id, chat_ids))
+    cur.execute(
+        "DELETE FROM direct_chats WHERE chat_id = ANY(%s) AND (user_low = %s OR user_high = %s)",
+        (chat_ids, user_id, user_id)
+    )
+
+    # Drop the user's inbox rows, unlink them from peers' personal chats
+    # and recompute previews that may have pointed at their messages
+    cur.execute("DELETE FROM user_inbox WHERE user_id = %s AND chat_id = ANY(%s)", (user_id, chat_ids))
+    cur.execute("""
+        UPDATE user_inbox i
+        SET other_user_id = NULL, other_username = NULL, display_name = COALESCE(c.name, %s),
+            display_avatar = COALESCE(c.avatar_thumb_url, c.avatar), version = nextval('user_inbox_version_seq')
+        FROM chats c
+        WHERE i.other_user_id = %s AND i.chat_id = ANY(%s) AND c.id = i.chat_id
+    """, (DELETED_ACCOUNT_NAME, user_id, chat_ids))
+    cur.execute("""
+        UPDATE user_inbox i
+        SET (last_message_id, last_message, last_message_time) = (
+            SELECT m.id, m.content, m.created_at
+            FROM messages m
+            WHERE m.chat_id = i.chat_id
+            ORDER BY m.id DESC
+            LIMIT 1
+        ), version = nextval('user_inbox_version_seq')
+        WHERE i.chat_id = ANY(%s)
+    """, (chat_ids,))
+    cur.execute("SELECT pg_notify('inbox_' || user_id, '') FROM user_inbox WHERE chat_id = ANY(%s)", (chat_ids,))
+
+    QUEUE_EMPTY_CHATS.execute(cur, (job_id, chat_ids))
+    progress['chats_left'] += len(chat_ids)
+    touched.update(chat_ids)
+    return len(chat_ids) < batch
+
+
+def _purge_empty_chat(cur, job_id: int, batch: int, progress: Dict[str, int], touched: Set[int]) -> bool:
+    NEXT_EMPTY_CHAT.execute(cur, (job_id,))
+    row = cur.fetchone()
+    if not row:
+        return True
+    chat_id = row[0]
+
+    cur.execute("SELECT id FROM chats WHERE id = %s FOR UPDATE", (chat_id,))
+    exists = cur.fetchone() is not None
+    HAS_ACTIVE_MEMBER.execute(cur, (chat_id,))
+    if exists and not cur.fetchone():
+        DELETE_CHAT_MESSAGES.execute(cur, (chat_id, batch, chat_id))
+        rows = cur.fetchall()
+        _queue_media(cur, job_id, (key for row in rows for key in row))
+        progress['messages_deleted'] += len(rows)
+        if len(rows) == batch:
+            return False
+
+        cur.execute("DELETE FROM chat_read_state WHERE chat_id = %s", (chat_id,))
+        cur.execute("DELETE FROM chat_participants WHERE chat_id = %s", (chat_id,))
+        cur.execute("DELETE FROM user_inbox WHERE chat_id = %s", (chat_id,))
+        cur.execute("DELETE FROM direct_chats WHERE chat_id = %s", (chat_id,))
+        cur.execute("DELETE FROM chats WHERE id = %s RETURNING avatar_key", (chat_id,))
+        _queue_media(cur, job_id, [cur.fetchone()[0]])
+        progress['chats_deleted'] += 1
+        touched.add(chat_id)
+
+    cur.execute("DELETE FROM deletion_job_chats WHERE job_id = %s AND chat_id = %s", (job_id, chat_id))
+    return False
+
+
+def _delete_account(cur, job_id: int, user_id: int) -> bool:
+    cur.execute("DELETE FROM users WHERE id = %s AND deleted_at IS NOT NULL RETURNING avatar_key", (user_id,))
+    row = cur.fetchone()
+    if row:
+        _queue_media(cur, job_id, [row[0]])
+    return True
+
+
+def _drop_unreferenced(cur, keys: List[str]) -> Tuple[List[str], int]:
+    '''Delete the media rows of keys nothing references any more, with
+    every variant rendered from the same upload.
+
+    Returns the keys whose blobs are to go and how many rows were deleted.
+    '''
+    MEDIA_GROUPS.execute(cur, (keys,))
+    groups: Dict[str, Set[str]] = {}
+    for key, member in cur.fetchall():
+        groups.setdefault(key, set()).add(member)
+    # Keys without a row any more only wait for their blob to go
+    for key in keys:
+        groups.setdefault(key, {key})
+    siblings = sorted({member for members in groups.values() for member in members})
+    LOCK_MEDIA.execute(cur, (siblings,))
+    REFERENCED_MEDIA.execute(cur, (siblings,))
+    referenced = {row[0] for row in cur.fetchall()}
+
+    doomed = sorted({
+        member
+        for members in groups.values() if not members & referenced
+        for member in members
+    })
+    if not doomed:
+        return doomed, 0
+    cur.execute("DELETE FROM media_objects WHERE key = ANY(%s::varchar[])", (doomed,))
+    return doomed, cur.rowcount
+
+
+def _purge_media(cur, job_id: int, batch: int, progress: Dict[str, int], removed: List[str]) -> bool:
+    NEXT_MEDIA.execute(cur, (job_id, batch))
+    keys = [row[0] for row in cur.fetchall()]
+    if not keys:
+        return True
+
+    doomed, deleted = _drop_unreferenced(cur, keys)
+    progress['media_deleted'] += deleted
+    if doomed:
+        # The job keeps their keys until _delete_blobs is done with them,
+        # so a blob that failed to go is retried
+        _queue_media(cur, job_id, doomed)
+    kept = sorted(set(keys) - set(doomed))
+    cur.execute("DELETE FROM deletion_job_media WHERE job_id = %s AND key = ANY(%s::varchar[])", (job_id, kept))
+    removed.extend(doomed)
+    # The stage ends on a batch that finds no key left
+    return False
+
+
+def _delete_live_blobs(cur, keys: List[str]) -> None:
+    '''Delete the blobs of media rows a committed batch dropped.
+
+    The keys' upload locks (media.lock_keys) wait out any upload of the
+    same content still in flight; a key that has a row again belongs to
+    that upload and its blob stays.
+    '''
+    media.lock_keys(cur, keys)
+    LIVE_MEDIA.execute(cur, (keys,))
+    live = {row[0] for row in cur.fetchall()}
+    storage = media.get_storage()
+    for key in keys:
+        if key not in live:
+            storage.delete(key)
+
+
+def _delete_blobs(conn, cur, job_id: int, keys: List[str]) -> None:
+    _delete_live_blobs(cur, keys)
+    cur.execute("DELETE FROM deletion_job_media WHERE job_id = %s AND key = ANY(%s::varchar[])", (job_id, keys))
+    conn.commit()
+
+
+def _record_failure(conn, cur, job_id: int) -> None:
+    conn.rollback()
+    cur.execute(
+        "UPDATE deletion_jobs SET attempts = attempts + 1, last_error = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+        (traceback.format_exc(limit=3), job_id)
+    )
+    conn.commit()
+
+
+def run_once(conn, batch: int = BATCH_SIZE) -> Optional[Dict[str, Any]]:
+    '''Run one batch of the job that waited longest and commit it.
+
+    Returns the job's status afterwards, or None when no job is pending.
+    Exceptions are rolled back and recorded on the job rather than raised.
+    '''
+    cur = conn.cursor()
+    try:
+        CLAIM_JOB.execute(cur)
+        row = cur.fetchone()
+        if not row:
+            conn.rollback()
+            return None
+        job_id, user_id, stage = row
+
+        progress = {name: 0 for name in COUNTERS}
+        touched: Set[int] = set()
+        removed: List[str] = []
+        try:
+            if stage == 'messages':
+                finished = _purge_messages(cur, job_id, user_id, batch, progress)
+            elif stage == 'chats':
+                finished = _leave_chats(cur, job_id, user_id, batch, progress, touched)
+            elif stage == 'empty_chats':
+                finished = _purge_empty_chat(cur, job_id, batch, progress, touched)
+            elif stage == 'account':
+                finished = _delete_account(cur, job_id, user_id)
+            else:
+                finished = _purge_media(cur, job_id, batch, progress, removed)
+        except Exception:
+            _record_failure(conn, cur, job_id)
+            return status(cur, job_id)
+
+        next_stage = STAGES[STAGES.index(stage) + 1] if finished else stage
+        cur.execute(f"""
+            UPDATE deletion_jobs
+            SET stage = %s, {', '.join(f'{name} = {name} + %s' for name in COUNTERS)},
+                last_error = NULL, updated_at = CURRENT_TIMESTAMP,
+                finished_at = CASE WHEN %s = 'done' THEN CURRENT_TIMESTAMP END
+            WHERE id = %s
+        """, (next_stage, *(progress[name] for name in COUNTERS), next_stage, job_id))
+        conn.commit()
+
+        keys = [cache.participants_key(chat_id) for chat_id in sorted(touched)]
+        if stage == 'account':
+            keys.append(cache.profile_key(user_id))
+        cache.invalidate(*keys)
+
+        if removed:
+            try:
+                _delete_blobs(conn, cur, job_id, removed)
+            except Exception:
+                _record_failure(conn, cur, job_id)
+        return status(cur, job_id)
+    finally:
+        conn.rollback()
+        cur.close()
+
+
+def purge_released(conn, batch: int = BATCH_SIZE) -> int:
+    '''Purge one batch of the keys messages released (media.release).
+
+    Keys something still references leave the queue; the others stay
+    queued until their blobs are deleted, so a failed delete is retried.
+    Returns how many keys the batch took, 0 once the queue is empty.
+    Exceptions are rolled back and raised.
+    '''
+    cur = conn.cursor()
+    try:
+        NEXT_RELEASED.execute(cur, (batch,))
+        keys = [row[0] for row in cur.fetchall()]
+        if not keys:
+            return 0
+        doomed, _ = _drop_unreferenced(cur, keys)
+        kept = sorted(set(keys) - set(doomed))
+        cur.execute("DELETE FROM media_purge_queue WHERE key = ANY(%s::varchar[])", (kept,))
+        conn.commit()
+
+        if doomed:
+            _delete_live_blobs(cur, doomed)
+            cur.execute("DELETE FROM media_purge_queue WHERE key = ANY(%s::varchar[])", (doomed,))
+            conn.commit()
+        return len(keys)
+    finally:
+        conn.rollback()
+        cur.close()
+
+
+def run_pending(conn, batch: int = BATCH_SIZE) -> List[Dict[str, Any]]:
+    '''Run batches until no job is left or every remaining job just failed.
+
+    Returns the status of each job after its last batch.
+    '''
+    last: Dict[int, Dict[str, Any]] = {}
+    failed: Set[int] = set()
+    while True:
+        job = run_once(conn, batch)
+        if job is None:
+            break
+        last[job['id']] = job
+        if job['finished_at'] is None and job['last_error']:
+            if job['id'] in failed:
+                break
+            failed.add(job['id'])
+        else:
+            failed.discard(job['id'])
+    return list(last.values())
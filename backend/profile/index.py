@@ -5,10 +5,36 @@ Returns: HTTP response with updated user data
 '''
 
 import json
-import os
-import psycopg2
 from typing import Dict, Any
 
+import cache
+import conditional
+import db
+import deletion
+import images
+import media
+import metrics
+import reads
+import session
+
+def touch_member_chats(cur, user_id: int) -> None:
+    '''Move updated_at of every chat the user is in.
+
+    The rows are locked in id order first, like writers of a single chat
+    and the account purge lock them, so concurrent profile updates and
+    sends cannot deadlock on each other.
+    '''
+    cur.execute("""
+        SELECT id FROM chats
+        WHERE id IN (SELECT chat_id FROM chat_participants WHERE user_id = %s)
+        ORDER BY id
+        FOR UPDATE
+    """, (user_id,))
+    chat_ids = [row[0] for row in cur.fetchall()]
+    if chat_ids:
+        cur.execute("UPDATE chats SET updated_at = CURRENT_TIMESTAMP WHERE id = ANY(%s)", (chat_ids,))
+
+@metrics.instrument('profile')
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method: str = event.get('httpMethod', 'GET')
     
@@ -19,56 +45,31 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'headers': {
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id',
+                'Access-Control-Allow-Headers': 'Content-Type, Authorization, If-None-Match',
                 'Access-Control-Max-Age': '86400'
             },
             'body': ''
         }
     
-    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    conn = db.get_connection()
     cur = conn.cursor()
     
     try:
+        session_user = session.authenticate(event, cur)
+        if session_user is None:
+            return session.unauthorized()
+        
         if method == 'GET':
             # Get user profile
-            params = event.get('queryStringParameters') or {}
-            user_id = params.get('user_id')
-            
-            if not user_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'user_id required'})
-                }
-            
-            cur.execute(
-                "SELECT id, username, nickname, avatar, theme, hide_online_status FROM users WHERE id = CAST(%s AS INTEGER)",
-                (user_id,)
-            )
-            user = cur.fetchone()
-            
-            if not user:
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'User not found'})
-                }
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'id': user[0],
-                    'username': user[1],
-                    'nickname': user[2],
-                    'avatar': user[3],
-                    'theme': user[4],
-                    'hide_online_status': user[5]
-                })
-            }
+            params = dict(event.get('queryStringParameters') or {})
+            if not session.claim(params, session_user, 'user_id'):
+                return session.forbidden()
+            return reads.to_response(reads.profile(cur, params, conditional.if_none_match(event)), event)
         
         elif method == 'PUT':
             body_data = json.loads(event.get('body', '{}'))
+            if not session.claim(body_data, session_user, 'user_id'):
+                return session.forbidden()
             user_id = body_data.get('user_id')
             action = body_data.get('action')
             
@@ -82,8 +83,17 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'body': json.dumps({'error': 'Nickname required'})
                     }
                 
-                cur.execute("UPDATE users SET nickname = %s WHERE id = %s", (nickname, user_id))
+                cur.execute("UPDATE users SET nickname = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (nickname, user_id))
+                # Group participant lists show the member's name and avatar
+                touch_member_chats(cur, user_id)
+                cur.execute(
+                    "UPDATE user_inbox SET display_name = %s, version = nextval('user_inbox_version_seq') WHERE other_user_id = %s RETURNING user_id",
+                    (nickname, user_id)
+                )
+                for row in cur.fetchall():
+                    cur.execute("SELECT pg_notify(%s, '')", (f'inbox_{row[0]}',))
                 conn.commit()
+                cache.invalidate(cache.profile_key(user_id))
                 
                 return {
                     'statusCode': 200,
@@ -92,10 +102,31 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 }
             
             elif action == 'update_avatar':
-                avatar = body_data.get('avatar')
+                cur.execute("SELECT avatar, avatar_key, avatar_thumb_url FROM users WHERE id = %s", (user_id,))
+                current = cur.fetchone()
+                try:
+                    avatar, avatar_key, avatar_thumb = media.store_image_data_url(cur, body_data.get('avatar'), images.AVATAR, current)
+                except (images.ImageError, media.DataURLError) as error:
+                    return {
+                        'statusCode': error.status,
+                        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                        'body': json.dumps({'error': str(error)})
+                    }
                 
-                cur.execute("UPDATE users SET avatar = %s WHERE id = %s", (avatar, user_id))
+                cur.execute(
+                    "UPDATE users SET avatar = %s, avatar_key = %s, avatar_thumb_url = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+                    (avatar, avatar_key, avatar_thumb, user_id)
+                )
+                # Group participant lists show the member's name and avatar
+                touch_member_chats(cur, user_id)
+                cur.execute(
+                    "UPDATE user_inbox SET display_avatar = %s, version = nextval('user_inbox_version_seq') WHERE other_user_id = %s RETURNING user_id",
+                    (avatar_thumb, user_id)
+                )
+                for row in cur.fetchall():
+                    cur.execute("SELECT pg_notify(%s, '')", (f'inbox_{row[0]}',))
                 conn.commit()
+                cache.invalidate(cache.profile_key(user_id))
                 
                 return {
                     'statusCode': 200,
@@ -113,8 +144,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                         'body': json.dumps({'error': 'Invalid theme'})
                     }
                 
-                cur.execute("UPDATE users SET theme = %s WHERE id = %s", (theme, user_id))
+                cur.execute("UPDATE users SET theme = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (theme, user_id))
                 conn.commit()
+                cache.invalidate(cache.profile_key(user_id))
                 
                 return {
                     'statusCode': 200,
@@ -125,8 +157,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             elif action == 'update_online_status':
                 hide_online = body_data.get('hide_online_status', False)
                 
-                cur.execute("UPDATE users SET hide_online_status = %s WHERE id = %s", (hide_online, user_id))
+                cur.execute("UPDATE users SET hide_online_status = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s", (hide_online, user_id))
                 conn.commit()
+                cache.invalidate(cache.profile_key(user_id))
                 
                 return {
                     'statusCode': 200,
@@ -136,6 +169,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         
         elif method == 'DELETE':
             body_data = json.loads(event.get('body', '{}'))
+            if not session.claim(body_data, session_user, 'user_id'):
+                return session.forbidden()
             user_id = body_data.get('user_id')
             
             if not user_id:
@@ -145,15 +180,23 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'body': json.dumps({'error': 'user_id required'})
                 }
             
-            cur.execute("DELETE FROM chat_participants WHERE user_id = %s", (user_id,))
-            cur.execute("DELETE FROM messages WHERE sender_id = %s", (user_id,))
-            cur.execute("DELETE FROM users WHERE id = %s", (user_id,))
+            # Everything the account leaves behind is purged in batches by
+            # deletion.run_once (tools/purge_accounts.py)
+            job = deletion.queue(cur, user_id)
             conn.commit()
+            cache.invalidate(cache.profile_key(user_id))
+            
+            if job is None:
+                return {
+                    'statusCode': 404,
+                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                    'body': json.dumps({'error': 'User not found'})
+                }
             
             return {
-                'statusCode': 200,
+                'statusCode': 202,
                 'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'success': True, 'message': 'Account deleted'})
+                'body': json.dumps({'success': True, 'message': 'Account deleted', 'deletion_job': job})
             }
         
         return {
@@ -164,4 +207,4 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     
     finally:
         cur.close()
-        conn.close()
\ No newline at end of file
+        db.release_connection(conn)
\ No newline at end of file
@@ -0,0 +1,11 @@
+-- Change sequence for incremental (delta) message sync.
+-- Every insert, edit, read mark and delete takes a fresh value, so clients
+-- can ask for "everything that changed after the watermark I already have".
+CREATE SEQUENCE IF NOT EXISTS messages_change_seq;
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS change_seq BIGINT;
+UPDATE messages SET change_seq = nextval('messages_change_seq') WHERE change_seq IS NULL;
+ALTER TABLE messages ALTER COLUMN change_seq SET DEFAULT nextval('messages_change_seq');
+ALTER TABLE messages ALTER COLUMN change_seq SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_messages_chat_change_seq ON messages(chat_id, change_seq);
@@ -0,0 +1,5 @@
+-- Keyset pagination over a chat's history: WHERE chat_id = ? AND id < ? ORDER BY id DESC.
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages(chat_id, id);
+
+-- The composite index serves every lookup the single-column one did.
+DROP INDEX IF EXISTS idx_messages_chat;
@@ -0,0 +1,54 @@
+-- Per-user chat list projection, maintained by the message, chat, group
+-- and profile handlers on write so the chat list is a single range scan.
+CREATE TABLE IF NOT EXISTS user_inbox (
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    is_group BOOLEAN DEFAULT FALSE,
+    creator_id INTEGER,
+    other_user_id INTEGER DEFAULT NULL,
+    other_username VARCHAR(50) DEFAULT NULL,
+    display_name VARCHAR(255) DEFAULT NULL,
+    display_avatar TEXT DEFAULT NULL,
+    last_message_id INTEGER DEFAULT NULL,
+    last_message TEXT DEFAULT NULL,
+    last_message_time TIMESTAMP DEFAULT NULL,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, chat_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_inbox_user_time ON user_inbox(user_id, last_message_time DESC NULLS LAST);
+CREATE INDEX IF NOT EXISTS idx_user_inbox_chat ON user_inbox(chat_id);
+CREATE INDEX IF NOT EXISTS idx_user_inbox_other_user ON user_inbox(other_user_id) WHERE other_user_id IS NOT NULL;
+
+-- Backfill from existing memberships
+INSERT INTO user_inbox (
+    user_id, chat_id, is_group, creator_id, other_user_id, other_username,
+    display_name, display_avatar, last_message_id, last_message, last_message_time, unread_count
+)
+SELECT cp.user_id, c.id, c.is_group, c.creator_id, ou.id, ou.username,
+       CASE WHEN ou.id IS NOT NULL THEN ou.nickname ELSE c.name END,
+       CASE WHEN ou.id IS NOT NULL THEN ou.avatar ELSE c.avatar END,
+       lm.id, lm.content, lm.created_at, ur.unread
+FROM chat_participants cp
+JOIN chats c ON c.id = cp.chat_id
+LEFT JOIN LATERAL (
+    SELECT m.id, m.content, m.created_at
+    FROM messages m
+    WHERE m.chat_id = c.id
+    ORDER BY m.id DESC
+    LIMIT 1
+) lm ON TRUE
+LEFT JOIN LATERAL (
+    SELECT u.id, u.username, u.nickname, u.avatar
+    FROM chat_participants ocp
+    JOIN users u ON u.id = ocp.user_id
+    WHERE NOT c.is_group AND ocp.chat_id = c.id AND ocp.user_id != cp.user_id
+    LIMIT 1
+) ou ON TRUE
+CROSS JOIN LATERAL (
+    SELECT COUNT(*) AS unread
+    FROM messages m
+    WHERE m.chat_id = c.id AND m.is_read = FALSE AND m.sender_id IS DISTINCT FROM cp.user_id
+) ur
+WHERE cp.left_at IS NULL
+ON CONFLICT (user_id, chat_id) DO NOTHING;
@@ -0,0 +1,15 @@
+-- Content-addressed media: one row per distinct blob in the media store.
+-- Rows reference blobs by key; the *_url columns keep the public URL.
+CREATE TABLE IF NOT EXISTS media_objects (
+    key VARCHAR(255) PRIMARY KEY,
+    content_type VARCHAR(100) NOT NULL,
+    size INTEGER NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS photo_key VARCHAR(255) DEFAULT NULL;
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS voice_key VARCHAR(255) DEFAULT NULL;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS avatar_key VARCHAR(255) DEFAULT NULL;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS avatar_key VARCHAR(255) DEFAULT NULL;
+
+-- Existing inline data: URLs are moved out by tools/migrate_inline_media.py
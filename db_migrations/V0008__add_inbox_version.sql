@@ -0,0 +1,13 @@
+-- Change watermark for the chat list: every inbox write takes a fresh
+-- version, so long-polling clients can tell whether anything changed.
+CREATE SEQUENCE IF NOT EXISTS user_inbox_version_seq;
+ALTER TABLE user_inbox ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT nextval('user_inbox_version_seq');
+
+-- Leaving a group hides the inbox row instead of deleting it, so the
+-- leaver's watermark still moves forward.
+ALTER TABLE user_inbox ADD COLUMN IF NOT EXISTS left_at TIMESTAMP DEFAULT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_user_inbox_user_version ON user_inbox(user_id, version);
+DROP INDEX IF EXISTS idx_user_inbox_user_time;
+CREATE INDEX IF NOT EXISTS idx_user_inbox_user_time_active
+    ON user_inbox(user_id, last_message_time DESC NULLS LAST) WHERE left_at IS NULL;
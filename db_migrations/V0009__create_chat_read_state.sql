@@ -0,0 +1,19 @@
+-- Read receipts as one cursor per (chat, user) instead of a flag per message.
+CREATE TABLE IF NOT EXISTS chat_read_state (
+    chat_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    last_read_message_id INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (chat_id, user_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_chat_read_state_chat_cursor ON chat_read_state(chat_id, last_read_message_id DESC);
+
+-- Backfill: a participant has read up to the newest message from someone
+-- else that carries the old is_read flag
+INSERT INTO chat_read_state (chat_id, user_id, last_read_message_id)
+SELECT cp.chat_id, cp.user_id, MAX(m.id)
+FROM chat_participants cp
+JOIN messages m ON m.chat_id = cp.chat_id AND m.is_read = TRUE AND m.sender_id IS DISTINCT FROM cp.user_id
+GROUP BY cp.chat_id, cp.user_id
+ON CONFLICT (chat_id, user_id) DO NOTHING;
@@ -0,0 +1,5 @@
+-- Version tokens for conditional GETs: profile and group participant
+-- reads are validated against these timestamps instead of re-running
+-- the query. Writers set them to CURRENT_TIMESTAMP on every change.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
@@ -0,0 +1,23 @@
+-- Canonical 1:1 chat per user pair, (smaller id, larger id), so finding
+-- an existing personal chat is one primary-key probe and concurrent
+-- "start chat" requests cannot create duplicates.
+CREATE TABLE IF NOT EXISTS direct_chats (
+    user_low INTEGER NOT NULL,
+    user_high INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    PRIMARY KEY (user_low, user_high),
+    CHECK (user_low < user_high)
+);
+
+CREATE INDEX IF NOT EXISTS idx_direct_chats_user_high ON direct_chats(user_high);
+
+-- Backfill from existing personal chats; where duplicates already exist
+-- the oldest chat becomes canonical
+INSERT INTO direct_chats (user_low, user_high, chat_id)
+SELECT cp1.user_id, cp2.user_id, MIN(c.id)
+FROM chats c
+JOIN chat_participants cp1 ON cp1.chat_id = c.id
+JOIN chat_participants cp2 ON cp2.chat_id = c.id AND cp2.user_id > cp1.user_id
+WHERE c.is_group = FALSE
+GROUP BY cp1.user_id, cp2.user_id
+ON CONFLICT (user_low, user_high) DO NOTHING;
@@ -0,0 +1,18 @@
+-- Full-text search over message text and photo captions. The document
+-- combines the russian config (stemmed words) with the simple config
+-- (names, nicknames and mixed-language text as typed). The messages
+-- handler keeps it current on send, edit and delete.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector;
+
+UPDATE messages
+SET search_vector = to_tsvector('russian', concat_ws(' ', content, photo_caption))
+                 || to_tsvector('simple', concat_ws(' ', content, photo_caption))
+WHERE search_vector IS NULL
+  AND is_system IS NOT TRUE
+  AND content IS DISTINCT FROM '[Удалено]';
+
+CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_vector);
+
+-- Cross-chat search joins through the searcher's active memberships
+CREATE INDEX IF NOT EXISTS idx_chat_participants_user_active
+    ON chat_participants(user_id, chat_id) WHERE left_at IS NULL;
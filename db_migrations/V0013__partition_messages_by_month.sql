@@ -0,0 +1,66 @@
+-- Monthly range partitions for messages on created_at. Each month has
+-- its own heap and indexes, so index size and vacuum work stay bounded
+-- by one month of traffic and cold months can be compacted and frozen
+-- by tools/archive_messages.py. Queries with a created_at bound (the
+-- recent window used for history pages) only touch matching months.
+
+CREATE OR REPLACE FUNCTION create_messages_partition(month DATE) RETURNS TEXT AS $$
+DECLARE
+    start_at DATE := date_trunc('month', month)::date;
+    partition_name TEXT := 'messages_' || to_char(start_at, 'YYYY_MM');
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+        partition_name, start_at, (start_at + INTERVAL '1 month')::date
+    );
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Archival bookkeeping, one row per compacted partition
+CREATE TABLE IF NOT EXISTS message_archive_log (
+    partition_name VARCHAR(63) PRIMARY KEY,
+    archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    media_moved INTEGER NOT NULL DEFAULT 0,
+    bytes_before BIGINT NOT NULL,
+    bytes_after BIGINT NOT NULL
+);
+
+-- Rebuild the table as a partitioned one and copy the rows over
+ALTER TABLE messages RENAME TO messages_unpartitioned;
+UPDATE messages_unpartitioned SET created_at = COALESCE(updated_at, CURRENT_TIMESTAMP) WHERE created_at IS NULL;
+
+CREATE TABLE messages (LIKE messages_unpartitioned INCLUDING DEFAULTS) PARTITION BY RANGE (created_at);
+ALTER TABLE messages ALTER COLUMN created_at SET NOT NULL;
+ALTER SEQUENCE messages_id_seq OWNED BY messages.id;
+
+-- Rows outside every monthly range land here instead of failing; the
+-- archival job creates months ahead so it normally stays empty
+CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+DO $$
+DECLARE
+    month DATE;
+BEGIN
+    FOR month IN
+        SELECT generate_series(
+            date_trunc('month', LEAST(COALESCE((SELECT MIN(created_at) FROM messages_unpartitioned), CURRENT_DATE), CURRENT_DATE)),
+            date_trunc('month', CURRENT_DATE) + INTERVAL '3 months',
+            INTERVAL '1 month'
+        )::date
+    LOOP
+        PERFORM create_messages_partition(month);
+    END LOOP;
+END $$;
+
+INSERT INTO messages SELECT * FROM messages_unpartitioned;
+DROP TABLE messages_unpartitioned;
+
+-- Indexes are declared on the parent and built per partition. The
+-- primary key has to include the partition key; lookups by id still
+-- use it as a leading-column index.
+ALTER TABLE messages ADD PRIMARY KEY (id, created_at);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_id_id ON messages(chat_id, id);
+CREATE INDEX IF NOT EXISTS idx_messages_chat_change_seq ON messages(chat_id, change_seq);
+CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender_id);
+CREATE INDEX IF NOT EXISTS idx_messages_search ON messages USING GIN (search_vector);
@@ -0,0 +1,4 @@
+-- Session tokens carry the user's session epoch; bumping it (logout,
+-- account deletion) revokes every token issued before. Passwords move
+-- to salted PBKDF2 hashes as users next log in, see backend/*/session.py.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS session_epoch INTEGER NOT NULL DEFAULT 0;
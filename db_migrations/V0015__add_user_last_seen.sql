@@ -0,0 +1,3 @@
+-- Presence lives in an expiring store (backend/presence); only the time a
+-- user was last online is kept here, written in coalesced batches.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen TIMESTAMP;
@@ -0,0 +1,11 @@
+-- Uploaded photos and avatars are stored as rendered variants (see
+-- backend/*/images.py): a size-capped, metadata-free preview in the
+-- existing url/key columns and a small thumbnail next to it. List views
+-- (chat list, participants) reference only thumbnails.
+ALTER TABLE media_objects ADD COLUMN IF NOT EXISTS source_hash CHAR(64) DEFAULT NULL;
+ALTER TABLE media_objects ADD COLUMN IF NOT EXISTS variant VARCHAR(20) DEFAULT NULL;
+CREATE INDEX IF NOT EXISTS idx_media_objects_source ON media_objects (source_hash, variant) WHERE source_hash IS NOT NULL;
+
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS photo_thumb_url TEXT DEFAULT NULL;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS avatar_thumb_url TEXT DEFAULT NULL;
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS avatar_thumb_url TEXT DEFAULT NULL;
@@ -0,0 +1,43 @@
+-- Account deletion runs as a job (see backend/profile/deletion.py): the
+-- account is marked deleted at once, then a worker purges its messages,
+-- memberships, chats left without members and unreferenced media in
+-- short batches, recording its progress here.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP DEFAULT NULL;
+
+CREATE TABLE IF NOT EXISTS deletion_jobs (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER NOT NULL UNIQUE,
+    -- messages -> chats -> empty_chats -> account -> media -> done
+    stage VARCHAR(20) NOT NULL DEFAULT 'messages',
+    messages_deleted INTEGER NOT NULL DEFAULT 0,
+    chats_left INTEGER NOT NULL DEFAULT 0,
+    chats_deleted INTEGER NOT NULL DEFAULT 0,
+    media_deleted INTEGER NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT DEFAULT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP DEFAULT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_deletion_jobs_pending ON deletion_jobs(updated_at) WHERE finished_at IS NULL;
+
+-- Chats a job found without active members, purged one at a time
+CREATE TABLE IF NOT EXISTS deletion_job_chats (
+    job_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    PRIMARY KEY (job_id, chat_id)
+);
+
+-- Media keys of purged rows; deleted from the store once nothing references them
+CREATE TABLE IF NOT EXISTS deletion_job_media (
+    job_id INTEGER NOT NULL,
+    key VARCHAR(255) NOT NULL,
+    PRIMARY KEY (job_id, key)
+);
+
+-- Reference checks before a blob is deleted
+CREATE INDEX IF NOT EXISTS idx_messages_photo_key ON messages(photo_key) WHERE photo_key IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_messages_voice_key ON messages(voice_key) WHERE voice_key IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_users_avatar_key ON users(avatar_key) WHERE avatar_key IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_chats_avatar_key ON chats(avatar_key) WHERE avatar_key IS NOT NULL;
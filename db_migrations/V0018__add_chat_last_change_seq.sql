@@ -0,0 +1,10 @@
+-- Newest change_seq of each chat, kept on the chat row so conditional and
+-- long-poll reads of a chat never scan the message partitions. Writers
+-- take the next value with UPDATE ... RETURNING, which also queues them
+-- on the row lock so values commit in order.
+ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_change_seq BIGINT NOT NULL DEFAULT 0;
+
+UPDATE chats c
+SET last_change_seq = latest.change_seq
+FROM (SELECT chat_id, MAX(change_seq) AS change_seq FROM messages GROUP BY chat_id) latest
+WHERE latest.chat_id = c.id AND c.last_change_seq < latest.change_seq;
@@ -0,0 +1,8 @@
+-- Media keys a message stopped referencing when its sender deleted it
+-- (see media.release). tools/purge_accounts.py deletes each blob, with its
+-- rendered variants, once nothing references it; a key stays queued
+-- until its blob is gone.
+CREATE TABLE IF NOT EXISTS media_purge_queue (
+    key VARCHAR(255) PRIMARY KEY,
+    queued_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,55 @@
+-- create_messages_partition for a month whose rows already landed in
+-- messages_default, e.g. after tools/archive_messages.py stopped running
+-- for a while: Postgres refuses to add a partition while the default
+-- partition holds rows of its range. The default partition is detached,
+-- the month's partition created and its rows moved over, then the
+-- default partition is attached again, all in the caller's transaction.
+-- Writers of messages wait for that transaction; the move only takes as
+-- long as the month's stray rows take to copy.
+
+CREATE OR REPLACE FUNCTION create_messages_partition(month DATE) RETURNS TEXT AS $$
+DECLARE
+    start_at DATE := date_trunc('month', month)::date;
+    end_at DATE := (date_trunc('month', month) + INTERVAL '1 month')::date;
+    partition_name TEXT := 'messages_' || to_char(start_at, 'YYYY_MM');
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN partition_name;
+    END IF;
+
+    -- Keeps writers out until the month's partition exists, so no row of
+    -- it can reach the default partition after the check; reads go on.
+    -- The parent is locked first, in the order writers lock it.
+    LOCK TABLE messages IN SHARE ROW EXCLUSIVE MODE;
+    IF NOT EXISTS (SELECT 1 FROM messages_default WHERE created_at >= start_at AND created_at < end_at) THEN
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+            partition_name, start_at, end_at
+        );
+        RETURN partition_name;
+    END IF;
+
+    ALTER TABLE messages DETACH PARTITION messages_default;
+    EXECUTE format(
+        'CREATE TABLE %I PARTITION OF messages FOR VALUES FROM (%L) TO (%L)',
+        partition_name, start_at, end_at
+    );
+    EXECUTE format(
+        'WITH moved AS (DELETE FROM messages_default WHERE created_at >= %L AND created_at < %L RETURNING *) '
+        'INSERT INTO %I SELECT * FROM moved',
+        start_at, end_at, partition_name
+    );
+    ALTER TABLE messages ATTACH PARTITION messages_default DEFAULT;
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Months that already have rows in the default partition
+DO $$
+DECLARE
+    month DATE;
+BEGIN
+    FOR month IN SELECT DISTINCT date_trunc('month', created_at)::date FROM messages_default ORDER BY 1 LOOP
+        PERFORM create_messages_partition(month);
+    END LOOP;
+END $$;
@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react';
+import { useState, useEffect, useRef } from 'react';
 import { Button } from '@/components/ui/button';
 import { Input } from '@/components/ui/input';
 import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogTrigger } from '@/components/ui/dialog';
@@ -8,6 +8,10 @@ import { toast } from 'sonner';
 import CreateGroupDialog from '@/components/CreateGroupDialog';
 import ProfileSettings from '@/components/ProfileSettings';
 import type { User, Chat } from '@/pages/Index';
+import { apiFetch } from '@/lib/api';
+
+const LONG_POLL_SECONDS = 25;
+const POLL_RETRY_MS = 2000;
 
 interface ChatListProps {
   user: User;
@@ -24,36 +28,57 @@ export default function ChatList({ user, onSelectChat, onLogout, activeChat }: C
   const [isSettingsOpen, setIsSettingsOpen] = useState(false);
   const [loading, setLoading] = useState(false);
   const [currentUser, setCurrentUser] = useState(user);
+  const versionRef = useRef<string | null>(null);
 
-  const loadChats = async () => {
+  const loadChats = async (wait = 0, signal?: AbortSignal): Promise<boolean> => {
     try {
-      const url = `https://functions.poehali.dev/eb5187df-736f-4f3f-ab42-b9ea5b5b4e7c?user_id=${user.id}`;
-      console.log('Fetching chats from:', url);
+      const since = versionRef.current;
+      const url = `https://functions.poehali.dev/eb5187df-736f-4f3f-ab42-b9ea5b5b4e7c?user_id=${user.id}` +
+        (since !== null && wait > 0 ? `&since=${encodeURIComponent(since)}&wait=${wait}` : '');
       
-      const response = await fetch(url);
-      console.log('Response status:', response.status);
-      console.log('Response ok:', response.ok);
+      const response = await apiFetch(url, { signal });
       
       if (!response.ok) {
         const text = await response.text();
         console.error('Response error:', text);
         toast.error('Ошибка загрузки чатов');
-        return;
+        return false;
       }
       
       const data = await response.json();
-      console.log('Chats loaded:', data);
-      setChats(data.chats || []);
+      versionRef.current = data.version ?? null;
+      if (!data.unchanged) {
+        setChats(data.chats || []);
+      }
+      // Every long-poll slot on the server was taken: pause before the next one
+      if (data.retry_after) {
+        await new Promise(resolve => setTimeout(resolve, data.retry_after * 1000));
+      }
+      return true;
     } catch (error) {
+      if (signal?.aborted) return false;
       console.error('Fetch error:', error, 'for', `https://functions.poehali.dev/eb5187df-736f-4f3f-ab42-b9ea5b5b4e7c?user_id=${user.id}`);
       toast.error('Ошибка сети');
+      return false;
     }
   };
 
   useEffect(() => {
-    loadChats();
-    const interval = setInterval(loadChats, 3000);
-    return () => clearInterval(interval);
+    versionRef.current = null;
+
+    // Long-poll: the server answers as soon as the chat list changes
+    const controller = new AbortController();
+    const poll = async () => {
+      await loadChats(0, controller.signal);
+      while (!controller.signal.aborted) {
+        const ok = await loadChats(LONG_POLL_SECONDS, controller.signal);
+        if (!ok && !controller.signal.aborted) {
+          await new Promise(resolve => setTimeout(resolve, POLL_RETRY_MS));
+        }
+      }
+    };
+    poll();
+    return () => controller.abort();
   }, [user.id]);
 
   const handleCreateChat = async () => {
@@ -65,7 +90,7 @@ export default function ChatList({ user, onSelectChat, onLogout, activeChat }: C
     setLoading(true);
 
     try {
-      const response = await fetch('https://functions.poehali.dev/eb5187df-736f-4f3f-ab42-b9ea5b5b4e7c', {
+      const response = await apiFetch('https://functions.poehali.dev/eb5187df-736f-4f3f-ab42-b9ea5b5b4e7c', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
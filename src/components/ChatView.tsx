@@ -9,14 +9,16 @@ import type { User, Chat } from '@/pages/Index';
 import { useAudioRecorder } from '@/hooks/useAudioRecorder';
 import { VoiceMessagePreview } from '@/components/VoiceMessagePreview';
 import { VoiceMessage } from '@/components/VoiceMessage';
+import { apiFetch } from '@/lib/api';
 
 interface Message {
   id: number;
-  sender_id: number;
+  sender_id: number | null;
   sender_nickname: string;
   sender_username: string;
   content: string;
   photo_url: string | null;
+  photo_thumb_url?: string | null;
   photo_caption: string | null;
   voice_url: string | null;
   voice_duration: number | null;
@@ -35,6 +37,9 @@ interface Participant {
   is_creator: boolean;
 }
 
+const LONG_POLL_SECONDS = 25;
+const POLL_RETRY_MS = 2000;
+
 interface ChatViewProps {
   user: User;
   chat: Chat;
@@ -52,10 +57,15 @@ export default function ChatView({ user, chat, onBack }: ChatViewProps) {
   const [showSettings, setShowSettings] = useState(false);
   const [participants, setParticipants] = useState<Participant[]>([]);
   const [sending, setSending] = useState(false);
+  const [hasMore, setHasMore] = useState(false);
+  const [loadingOlder, setLoadingOlder] = useState(false);
+  const [readUpTo, setReadUpTo] = useState(0);
   const [showVoicePreview, setShowVoicePreview] = useState(false);
   const { isRecording, recordingTime, audioBlob, startRecording, stopRecording, clearRecording } = useAudioRecorder();
   const messagesEndRef = useRef<HTMLDivElement>(null);
   const lastMessageIdRef = useRef<number>(0);
+  const cursorRef = useRef<number | null>(null);
+  const readReportedRef = useRef<number>(0);
   const shouldScrollRef = useRef<boolean>(true);
   const audioRef = useRef<HTMLAudioElement | null>(null);
 
@@ -70,16 +80,53 @@ export default function ChatView({ user, chat, onBack }: ChatViewProps) {
     }
   };
 
-  const loadMessages = useCallback(async () => {
+  const markRead = useCallback((messageId: number) => {
+    apiFetch('https://functions.poehali.dev/3c819211-4c93-4d90-a7ff-2493141d605b', {
+      method: 'PUT',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({
+        action: 'mark_read',
+        chat_id: chat.id,
+        user_id: user.id,
+        message_id: messageId
+      })
+    }).catch(error => console.error('Failed to mark messages read:', error));
+  }, [chat.id, user.id]);
+
+  const loadMessages = useCallback(async (wait = 0, signal?: AbortSignal): Promise<boolean> => {
     try {
-      const response = await fetch(
-        `https://functions.poehali.dev/3c819211-4c93-4d90-a7ff-2493141d605b?chat_id=${chat.id}`
+      const since = cursorRef.current;
+      const response = await apiFetch(
+        `https://functions.poehali.dev/3c819211-4c93-4d90-a7ff-2493141d605b?chat_id=${chat.id}&user_id=${user.id}` +
+          (since !== null ? `&since=${since}` : '') +
+          (since !== null && wait > 0 ? `&wait=${wait}` : ''),
+        { signal }
       );
       const data = await response.json();
-      const newMessages = data.messages || [];
+      const changed: Message[] = data.messages || [];
+      cursorRef.current = Math.max(cursorRef.current ?? 0, data.cursor ?? 0);
+      if (since === null) setHasMore(Boolean(data.has_more));
+      if (typeof data.read_up_to === 'number') setReadUpTo(data.read_up_to);
+      
+      // Every long-poll slot on the server was taken: pause before the next one
+      if (data.retry_after) {
+        await new Promise(resolve => setTimeout(resolve, data.retry_after * 1000));
+      }
+      
+      const newestId = changed.reduce((max, m) => Math.max(max, m.id), 0);
+      if (newestId > readReportedRef.current) {
+        readReportedRef.current = newestId;
+        markRead(newestId);
+      }
+      
+      if (since !== null && changed.length === 0) return true;
       
       setMessages(prevMessages => {
-        const lastId = prevMessages.length > 0 ? prevMessages[prevMessages.length - 1]?.id : 0;
+        const byId = new Map(prevMessages.map(m => [m.id, m]));
+        changed.forEach(m => byId.set(m.id, m));
+        const newMessages = Array.from(byId.values()).sort((a, b) => a.id - b.id);
+        
+        const lastId = lastMessageIdRef.current;
         const newLastId = newMessages.length > 0 ? newMessages[newMessages.length - 1]?.id : 0;
         
         if (newLastId > lastId) {
@@ -87,24 +134,69 @@ export default function ChatView({ user, chat, onBack }: ChatViewProps) {
           lastMessageIdRef.current = newLastId;
           
           const lastMessage = newMessages[newMessages.length - 1];
-          if (lastMessage && lastMessage.sender_id !== user.id && !lastMessage.is_system) {
+          if (since !== null && lastMessage && lastMessage.sender_id !== user.id && !lastMessage.is_system) {
             audioRef.current?.play().catch(() => {});
           }
         }
         
         return newMessages;
       });
+      return true;
     } catch (error) {
-      console.error('Failed to load messages:', error);
+      if (!signal?.aborted) console.error('Failed to load messages:', error);
+      return false;
     }
-  }, [chat.id, user.id]);
+  }, [chat.id, user.id, markRead]);
 
   useEffect(() => {
-    loadMessages();
-    const interval = setInterval(loadMessages, 1000);
-    return () => clearInterval(interval);
+    cursorRef.current = null;
+    lastMessageIdRef.current = 0;
+    readReportedRef.current = 0;
+    setMessages([]);
+    setHasMore(false);
+    setReadUpTo(0);
+
+    // Long-poll: each request is held by the server until the chat changes
+    const controller = new AbortController();
+    const poll = async () => {
+      await loadMessages(0, controller.signal);
+      while (!controller.signal.aborted) {
+        const ok = await loadMessages(LONG_POLL_SECONDS, controller.signal);
+        if (!ok && !controller.signal.aborted) {
+          await new Promise(resolve => setTimeout(resolve, POLL_RETRY_MS));
+        }
+      }
+    };
+    poll();
+    return () => controller.abort();
   }, [loadMessages]);
 
+  const loadOlderMessages = async () => {
+    const oldest = messages[0];
+    if (!oldest || loadingOlder) return;
+
+    setLoadingOlder(true);
+    shouldScrollRef.current = false;
+
+    try {
+      const response = await apiFetch(
+        `https://functions.poehali.dev/3c819211-4c93-4d90-a7ff-2493141d605b?chat_id=${chat.id}&before_id=${oldest.id}`
+      );
+      const data = await response.json();
+      const older: Message[] = data.messages || [];
+
+      setMessages(prev => {
+        const known = new Set(prev.map(m => m.id));
+        return [...older.filter(m => !known.has(m.id)), ...prev];
+      });
+      setHasMore(Boolean(data.has_more));
+    } catch (error) {
+      console.error('Failed to load older messages:', error);
+    } finally {
+      setLoadingOlder(false);
+    }
+  };
+
   useEffect(() => {
     scrollToBottom('auto');
   }, []);
@@ -147,7 +239,7 @@ export default function ChatView({ user, chat, onBack }: ChatViewProps) {
     setPhotoCaption('');
 
     try {
-      await fetch('https://functions.poehali.dev/3c819211-4c93-4d90-a7ff-2493141d605b', {
+      await apiFetch('https://functions.poehali.dev/3c819211-4c93-4d90-a7ff-2493141d605b', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -159,6 +251,7 @@ export default function ChatView({ user, chat, onBack }: ChatViewProps) {
         })
       });
 
+      setMessages(prev => prev.filter(m => m.id !== tempMessage.id));
       await loadMessages();
     } catch (error) {
       toast.error('Ошибка отправки');
@@ -178,7 +271,7 @@ export default function ChatView({ user, chat, onBack }: ChatViewProps) {
     setSending(true);
 
     try {
-      await fetch('https://functions.poehali.dev/3c819211-4c93-4d90-a7ff-2493141d605b', {
+      await apiFetch('https://functions.poehali.dev/3c819211-4c93-4d90-a7ff-2493141d605b', {
         method: 'PUT',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -207,7 +300,7 @@ export default function ChatView({ user, chat, onBack }: ChatViewProps) {
 
   const handleDeleteMessage = async (messageId: number) => {
     try {
-      await fetch('https://functions.poehali.dev/3c819211-4c93-4d90-a7ff-2493141d605b', {
+      await apiFetch('https://functions.poehali.dev/3c819211-4c93-4d90-a7ff-2493141d605b', {
         method: 'DELETE',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({ message_id: messageId })
@@ -247,7 +340,7 @@ export default function ChatView({ user, chat, onBack }: ChatViewProps) {
     if (!chat.is_group) return;
     
     try {
-      const response = await fetch(
+      const response = await apiFetch(
         `https://functions.poehali.dev/0626e1aa-311f-4d69-8a75-88cbee535b25?chat_id=${chat.id}`
       );
       const data = await response.json();
@@ -261,7 +354,7 @@ export default function ChatView({ user, chat, onBack }: ChatViewProps) {
     if (!confirm('Вы уверены, что хотите покинуть группу?')) return;
 
     try {
-      await fetch('https://functions.poehali.dev/0626e1aa-311f-4d69-8a75-88cbee535b25', {
+      await apiFetch('https://functions.poehali.dev/0626e1aa-311f-4d69-8a75-88cbee535b25', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -302,7 +395,7 @@ export default function ChatView({ user, chat, onBack }: ChatViewProps) {
       formData.append('duration', recordingTime.toString());
       if (caption) formData.append('caption', caption);
 
-      await fetch('https://functions.poehali.dev/3c819211-4c93-4d90-a7ff-2493141d605b', {
+      await apiFetch('https://functions.poehali.dev/3c819211-4c93-4d90-a7ff-2493141d605b', {
         method: 'POST',
         body: formData
       });
@@ -326,7 +419,7 @@ export default function ChatView({ user, chat, onBack }: ChatViewProps) {
     if (!confirm('Удалить участника из группы?')) return;
 
     try {
-      await fetch('https://functions.poehali.dev/0626e1aa-311f-4d69-8a75-88cbee535b25', {
+      await apiFetch('https://functions.poehali.dev/0626e1aa-311f-4d69-8a75-88cbee535b25', {
         method: 'PUT',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -396,6 +489,13 @@ export default function ChatView({ user, chat, onBack }: ChatViewProps) {
       </div>
 
       <div className="flex-1 overflow-y-auto p-4 space-y-3" onScroll={handleScroll}>
+        {hasMore && (
+          <div className="flex justify-center">
+            <Button variant="ghost" size="sm" onClick={loadOlderMessages} disabled={loadingOlder}>
+              {loadingOlder ? 'Загрузка...' : 'Показать предыдущие сообщения'}
+            </Button>
+          </div>
+        )}
         {messages.map((message) => {
           const isOwn = message.sender_id === user.id;
           
@@ -442,7 +542,7 @@ export default function ChatView({ user, chat, onBack }: ChatViewProps) {
                     <>
                       {message.photo_url && message.content !== '[Удалено]' && (
                         <img
-                          src={message.photo_url}
+                          src={message.photo_thumb_url || message.photo_url}
                           alt="Photo"
                           className="rounded-lg mb-2 max-w-full max-h-64 object-cover"
                           loading="lazy"
@@ -470,9 +570,9 @@ export default function ChatView({ user, chat, onBack }: ChatViewProps) {
                     )}
                     {isOwn && message.content !== '[Удалено]' && (
                       <Icon
-                        name={message.is_read ? 'CheckCheck' : 'Check'}
+                        name={message.is_read || message.id <= readUpTo ? 'CheckCheck' : 'Check'}
                         size={14}
-                        className={message.is_read ? 'text-primary' : 'text-muted-foreground'}
+                        className={message.is_read || message.id <= readUpTo ? 'text-primary' : 'text-muted-foreground'}
                       />
                     )}
                   </div>
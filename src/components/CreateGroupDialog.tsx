@@ -7,6 +7,7 @@ import { Checkbox } from '@/components/ui/checkbox';
 import Icon from '@/components/ui/icon';
 import { toast } from 'sonner';
 import type { User, Chat } from '@/pages/Index';
+import { apiFetch } from '@/lib/api';
 
 interface CreateGroupDialogProps {
   open: boolean;
@@ -56,7 +57,7 @@ export default function CreateGroupDialog({
     setLoading(true);
 
     try {
-      const response = await fetch('https://functions.poehali.dev/eb5187df-736f-4f3f-ab42-b9ea5b5b4e7c', {
+      const response = await apiFetch('https://functions.poehali.dev/eb5187df-736f-4f3f-ab42-b9ea5b5b4e7c', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -8,6 +8,7 @@ import { Switch } from '@/components/ui/switch';
 import Icon from '@/components/ui/icon';
 import { toast } from 'sonner';
 import type { User } from '@/pages/Index';
+import { apiFetch } from '@/lib/api';
 
 interface ProfileSettingsProps {
   open: boolean;
@@ -50,7 +51,7 @@ export default function ProfileSettings({
     setLoading(true);
 
     try {
-      const response = await fetch('https://functions.poehali.dev/25098e9f-957d-48bd-8f99-07459fab8fe9', {
+      const response = await apiFetch('https://functions.poehali.dev/25098e9f-957d-48bd-8f99-07459fab8fe9', {
         method: 'PUT',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -79,7 +80,7 @@ export default function ProfileSettings({
     setLoading(true);
 
     try {
-      const response = await fetch('https://functions.poehali.dev/25098e9f-957d-48bd-8f99-07459fab8fe9', {
+      const response = await apiFetch('https://functions.poehali.dev/25098e9f-957d-48bd-8f99-07459fab8fe9', {
         method: 'PUT',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -108,7 +109,7 @@ export default function ProfileSettings({
     setTheme(newTheme);
     
     try {
-      const response = await fetch('https://functions.poehali.dev/25098e9f-957d-48bd-8f99-07459fab8fe9', {
+      const response = await apiFetch('https://functions.poehali.dev/25098e9f-957d-48bd-8f99-07459fab8fe9', {
         method: 'PUT',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify({
@@ -226,7 +227,7 @@ export default function ProfileSettings({
               onClick={async () => {
                 if (confirm('Вы уверены, что хотите удалить аккаунт? Это действие необратимо.')) {
                   try {
-                    const response = await fetch('https://functions.poehali.dev/25098e9f-957d-48bd-8f99-07459fab8fe9', {
+                    const response = await apiFetch('https://functions.poehali.dev/25098e9f-957d-48bd-8f99-07459fab8fe9', {
                       method: 'DELETE',
                       headers: { 'Content-Type': 'application/json' },
                       body: JSON.stringify({ user_id: user.id })
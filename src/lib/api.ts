@@ -0,0 +1,26 @@
+const STORAGE_KEY = 'pchat_user';
+
+export function sessionToken(): string | null {
+  const saved = localStorage.getItem(STORAGE_KEY);
+  if (!saved) return null;
+  try {
+    return JSON.parse(saved).token ?? null;
+  } catch {
+    return null;
+  }
+}
+
+export async function apiFetch(input: RequestInfo | URL, init: RequestInit = {}): Promise<Response> {
+  const token = sessionToken();
+  const headers = new Headers(init.headers);
+  if (token) {
+    headers.set('Authorization', `Bearer ${token}`);
+  }
+  const response = await fetch(input, { ...init, headers });
+  if (response.status === 401 && localStorage.getItem(STORAGE_KEY)) {
+    // The session expired or was revoked: sign in again
+    localStorage.removeItem(STORAGE_KEY);
+    window.location.reload();
+  }
+  return response;
+}
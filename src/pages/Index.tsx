@@ -2,6 +2,7 @@ import { useState, useEffect } from 'react';
 import AuthScreen from '@/components/AuthScreen';
 import ChatList from '@/components/ChatList';
 import ChatView from '@/components/ChatView';
+import { apiFetch } from '@/lib/api';
 
 export interface User {
   id: number;
@@ -9,6 +10,7 @@ export interface User {
   nickname: string;
   avatar: string | null;
   theme: string;
+  token?: string;
 }
 
 export interface Chat {
@@ -49,6 +51,11 @@ export default function Index() {
   };
 
   const handleLogout = () => {
+    apiFetch('https://functions.poehali.dev/0442c07d-c526-4392-8291-b3f8d0136aa7', {
+      method: 'POST',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ action: 'logout' })
+    }).catch(() => {});
     setUser(null);
     setActiveChat(null);
     localStorage.removeItem('pchat_user');
@@ -0,0 +1,130 @@
+'''
+Maintain the monthly messages partitions (see
+db_migrations/V0013__partition_messages_by_month.sql):
+
+  1. create partitions for the coming months so new rows never land in
+     messages_default, and for every month that already has rows there
+     (the job lapsed); create_messages_partition moves those rows into
+     the new partition (V0020)
+  2. compact every month older than --older-than that has not been
+     archived yet: move leftover inline data: URLs to the media store
+     (they are what bloats the TOAST tables), rebuild the partition's
+     indexes with REINDEX CONCURRENTLY, then VACUUM (FREEZE, ANALYZE) so
+     the month is never rewritten by anti-wraparound vacuums again.
+     Neither blocks reads or writes of the partition; the heap is not
+     rewritten, its freed space is reused by later rows of the month
+
+Each archived partition is recorded in message_archive_log with its size
+before and after. Safe to re-run; archived months are skipped.
+
+Usage: DATABASE_URL=postgres://... python tools/archive_messages.py [--ahead 3] [--older-than 3] [--dry-run]
+'''
+
+import argparse
+from datetime import date
+from typing import List, Tuple
+
+from common import connect, load_module
+from migrate_inline_media import migrate_column
+
+MEDIA_COLUMNS = (('photo_url', 'photo_key'), ('voice_url', 'voice_key'))
+
+
+def add_months(month: date, count: int) -> date:
+    index = month.year * 12 + month.month - 1 + count
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_month(name: str) -> date:
+    year, month = name[len('messages_'):].split('_')
+    return date(int(year), int(month), 1)
+
+
+def create_upcoming(conn, ahead: int, dry_run: bool) -> None:
+    this_month = date.today().replace(day=1)
+    with conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT date_trunc('month', created_at)::date FROM messages_default")
+        stranded = {row[0] for row in cur.fetchall()}
+        for month in sorted(stranded | {add_months(this_month, offset) for offset in range(ahead + 1)}):
+            if dry_run:
+                print(f'would ensure partition for {month:%Y-%m}')
+                continue
+            cur.execute("SELECT create_messages_partition(%s)", (month,))
+            print(f'ensured {cur.fetchone()[0]}')
+    conn.commit()
+
+
+def pending_partitions(conn, older_than: int) -> List[str]:
+    cutoff = add_months(date.today().replace(day=1), -older_than)
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_inherits h
+            JOIN pg_class c ON c.oid = h.inhrelid
+            WHERE h.inhparent = 'messages'::regclass
+              AND c.relname ~ '^messages_[0-9]{4}_[0-9]{2}$'
+              AND NOT EXISTS (SELECT 1 FROM message_archive_log l WHERE l.partition_name = c.relname)
+            ORDER BY c.relname
+        """)
+        names = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    return [name for name in names if partition_month(name) < cutoff]
+
+
+def table_size(conn, table: str) -> int:
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_total_relation_size(%s::regclass)", (table,))
+        size = cur.fetchone()[0]
+    conn.commit()
+    return size
+
+
+def archive_partition(conn, media, table: str, batch: int) -> Tuple[int, int, int]:
+    bytes_before = table_size(conn, table)
+    moved = sum(
+        migrate_column(conn, media, table, url_column, key_column, batch)
+        for url_column, key_column in MEDIA_COLUMNS
+    )
+
+    # REINDEX CONCURRENTLY and VACUUM cannot run inside a transaction block
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'REINDEX TABLE CONCURRENTLY "{table}"')
+            cur.execute(f'VACUUM (FREEZE, ANALYZE) "{table}"')
+    finally:
+        conn.autocommit = False
+
+    bytes_after = table_size(conn, table)
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO message_archive_log (partition_name, media_moved, bytes_before, bytes_after)
+            VALUES (%s, %s, %s, %s)
+        """, (table, moved, bytes_before, bytes_after))
+    conn.commit()
+    return moved, bytes_before, bytes_after
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ahead', type=int, default=3, help='months of partitions to create in advance')
+    parser.add_argument('--older-than', type=int, default=3, help='archive months at least this many months old')
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--dry-run', action='store_true', help='only report what would be done')
+    args = parser.parse_args()
+
+    conn = connect()
+    create_upcoming(conn, args.ahead, args.dry_run)
+
+    media = load_module('messages', 'media')
+    for table in pending_partitions(conn, args.older_than):
+        if args.dry_run:
+            print(f'would archive {table} ({table_size(conn, table)} bytes)')
+            continue
+        moved, bytes_before, bytes_after = archive_partition(conn, media, table, args.batch)
+        print(f'{table}: moved {moved} inline media, {bytes_before} -> {bytes_after} bytes')
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
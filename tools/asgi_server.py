@@ -0,0 +1,198 @@
+'''
+ASGI harness that hosts the backend cloud functions for load tests and
+profiling against a local Postgres.
+
+Routes /<function> (auth, batch, chats, groups, messages, profile) to
+backend/<function>/index.py, translates each request into the platform
+event dict (binary bodies arrive base64-encoded with isBase64Encoded set)
+and runs the handler in a fixed-size worker thread pool, the same way a
+pool of warm function instances would serve it. MEDIA_ROOT is served
+under /media when MEDIA_STORAGE=local.
+
+  --workers N    concurrent handler invocations; requests beyond that queue
+  --cold-start   re-import the function (fresh module state, fresh
+                 connection pool) for every request instead of reusing a
+                 warm instance
+
+Every response carries X-Cold-Start: 1 or 0 so a client can tell which
+path served it.
+
+Usage: pip install uvicorn
+       DATABASE_URL=postgres://... python tools/asgi_server.py [--port 8000] [--workers 8] [--cold-start]
+The app object can also be served by any ASGI server:
+       uvicorn --app-dir tools asgi_server:app
+'''
+
+import argparse
+import asyncio
+import base64
+import inspect
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from common import BACKEND_DIR, load_handler
+from devserver import build_event
+
+Handler = Callable[[Dict[str, Any], Any], Dict[str, Any]]
+
+
+class FunctionHost:
+    '''Loads function handlers and invokes them warm or cold.'''
+
+    def __init__(self, names: List[str], cold_start: bool = False):
+        self.names = set(names)
+        self.cold_start = cold_start
+        self._warm: Dict[str, Handler] = {}
+        # load_handler swaps sys.path and sys.modules, so imports are serialized
+        self._loading = threading.Lock()
+
+    def _handler(self, name: str) -> Tuple[Handler, bool]:
+        with self._loading:
+            handler = None if self.cold_start else self._warm.get(name)
+            if handler is not None:
+                return handler, False
+            handler = load_handler(name)
+            if not self.cold_start:
+                self._warm[name] = handler
+            return handler, True
+
+    def invoke(self, name: str, event: Dict[str, Any]) -> Tuple[Dict[str, Any], bool]:
+        handler, cold = self._handler(name)
+        try:
+            return handler(event, None), cold
+        finally:
+            if self.cold_start:
+                close_pool(handler)
+
+    def close(self) -> None:
+        for handler in self._warm.values():
+            close_pool(handler)
+        self._warm.clear()
+
+
+def close_pool(handler: Handler) -> None:
+    # Look through decorators such as metrics.instrument to the module globals
+    db = inspect.unwrap(handler).__globals__.get('db')
+    if db is not None:
+        db.close_idle()
+
+
+async def read_body(receive) -> bytes:
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def send_response(send, status: int, headers: Dict[str, str], body: bytes) -> None:
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (key.lower().encode('latin-1'), str(value).encode('latin-1')) for key, value in headers.items()
+        ] + [(b'content-length', str(len(body)).encode('ascii'))],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+def read_media(media_root: Path, relative: str) -> Optional[bytes]:
+    path = (media_root / relative).resolve()
+    if media_root not in path.parents or not path.is_file():
+        return None
+    return path.read_bytes()
+
+
+def make_app(host: FunctionHost, workers: int, media_root: Path):
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='function')
+
+    async def lifespan(receive, send) -> None:
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                executor.shutdown(wait=True)
+                host.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def app(scope, receive, send) -> None:
+        if scope['type'] == 'lifespan':
+            return await lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        loop = asyncio.get_running_loop()
+        method = scope['method']
+        path = scope['path']
+        name = path.strip('/').split('/')[0]
+        body = await read_body(receive)
+
+        if method == 'GET' and name == 'media':
+            data = await loop.run_in_executor(executor, read_media, media_root, path[len('/media/'):])
+            if data is None:
+                return await send_response(send, 404, {}, b'')
+            return await send_response(send, 200, {'Cache-Control': 'public, max-age=31536000, immutable'}, data)
+
+        if name not in host.names:
+            return await send_response(
+                send, 404, {'Content-Type': 'application/json'}, json.dumps({'error': 'Unknown function'}).encode()
+            )
+
+        query = scope.get('query_string', b'').decode('latin-1')
+        headers = {key.decode('latin-1'): value.decode('latin-1') for key, value in scope['headers']}
+        event = build_event(method, f'{path}?{query}' if query else path, headers, body)
+        response, cold = await loop.run_in_executor(executor, host.invoke, name, event)
+
+        payload = response.get('body') or ''
+        if response.get('isBase64Encoded'):
+            payload = base64.b64decode(payload)
+        else:
+            payload = payload.encode('utf-8')
+        headers = dict(response.get('headers') or {})
+        headers['X-Cold-Start'] = '1' if cold else '0'
+        await send_response(send, response.get('statusCode', 200), headers, payload)
+
+    return app
+
+
+def function_names() -> List[str]:
+    return [path.parent.name for path in sorted(BACKEND_DIR.glob('*/index.py'))]
+
+
+def create_app(workers: int = 8, cold_start: bool = False):
+    media_root = Path(os.environ.get('MEDIA_ROOT', '/tmp/pchat-media')).resolve()
+    return make_app(FunctionHost(function_names(), cold_start), workers, media_root)
+
+
+# For `uvicorn asgi_server:app`; configured through the environment
+app = create_app(
+    int(os.environ.get('HARNESS_WORKERS', '8')),
+    os.environ.get('HARNESS_COLD_START', '') == '1'
+)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=8, help='handler thread pool size')
+    parser.add_argument('--cold-start', action='store_true', help='re-import the function for every request')
+    args = parser.parse_args()
+
+    import uvicorn
+
+    mode = 'cold' if args.cold_start else 'warm'
+    print(f"Serving {', '.join(function_names())} on http://{args.host}:{args.port} "
+          f"({args.workers} workers, {mode} starts)")
+    uvicorn.run(create_app(args.workers, args.cold_start), host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
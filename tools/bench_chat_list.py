@@ -0,0 +1,140 @@
+'''
+Benchmark the chat list endpoint (backend/chats GET) for users with
+10, 100 and 1000 chats. Reports statements per request and latency for
+the current handler next to the previous correlated-subquery + N+1
+implementation, which is reproduced here for comparison.
+
+Usage: DATABASE_URL=postgres://... python tools/bench_chat_list.py [--runs 20]
+The target database is wiped and re-created from db_migrations.
+'''
+
+import argparse
+import json
+import statistics
+import time
+from typing import Any, Dict, List
+
+from psycopg2.extras import execute_values
+
+from common import (
+    CountingCursor, backfill_inbox, connect, count_queries, load_handler, percentile, reset_schema, session_headers
+)
+
+SIZES = (10, 100, 1000)
+MESSAGES_PER_CHAT = 20
+
+
+def seed(conn, size: int) -> int:
+    '''Create a user with `size` chats (half personal, half group) and return its id.'''
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO users (username, password, nickname) VALUES (%s, 'x', %s) RETURNING id",
+            (f'bench{size}', f'Bench {size}')
+        )
+        user_id = cur.fetchone()[0]
+
+        peers = execute_values(
+            cur,
+            "INSERT INTO users (username, password, nickname) VALUES %s RETURNING id",
+            [(f'peer{size}x{i}', 'x', f'Peer {i}') for i in range(size // 2)],
+            fetch=True
+        )
+        chat_ids = execute_values(
+            cur,
+            "INSERT INTO chats (name, is_group, creator_id) VALUES %s RETURNING id",
+            [(None, False, user_id) for _ in peers] + [(f'Group {i}', True, user_id) for i in range(size - len(peers))],
+            fetch=True
+        )
+        participants = [(chat[0], user_id) for chat in chat_ids]
+        participants += [(chat[0], peer[0]) for chat, peer in zip(chat_ids, peers)]
+        execute_values(cur, "INSERT INTO chat_participants (chat_id, user_id) VALUES %s", participants)
+        execute_values(
+            cur,
+            "INSERT INTO messages (chat_id, sender_id, content) VALUES %s",
+            [(chat[0], user_id, f'message {n}') for chat in chat_ids for n in range(MESSAGES_PER_CHAT)]
+        )
+    conn.commit()
+    backfill_inbox(conn)
+    return user_id
+
+
+def legacy_chat_list(cur, user_id: int) -> List[Dict[str, Any]]:
+    cur.execute(f"""
+        SELECT DISTINCT c.id, c.name, c.avatar, c.is_group, c.creator_id,
+               (SELECT content FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message,
+               (SELECT created_at FROM messages WHERE chat_id = c.id ORDER BY created_at DESC LIMIT 1) as last_message_time
+        FROM chats c
+        JOIN chat_participants cp ON c.id = cp.chat_id
+        WHERE cp.user_id = {user_id} AND cp.left_at IS NULL
+        ORDER BY last_message_time DESC NULLS LAST
+    """)
+    chats = []
+    for row in cur.fetchall():
+        chat_data = {'id': row[0], 'name': row[1], 'avatar': row[2]}
+        if not row[3]:
+            cur.execute(f"""
+                SELECT u.username, u.nickname, u.avatar
+                FROM users u
+                JOIN chat_participants cp ON u.id = cp.user_id
+                WHERE cp.chat_id = {row[0]} AND cp.user_id != {user_id}
+            """)
+            cur.fetchone()
+        chats.append(chat_data)
+    return chats
+
+
+def measure(call, runs: int) -> Dict[str, float]:
+    latencies = []
+    queries = []
+    for _ in range(runs):
+        CountingCursor.reset()
+        started = time.perf_counter()
+        call()
+        latencies.append((time.perf_counter() - started) * 1000)
+        queries.append(CountingCursor.stats['queries'])
+    return {
+        'queries_per_request': statistics.mean(queries),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    count_queries()
+    conn = connect()
+    reset_schema(conn)
+    handler = load_handler('chats')
+
+    results = []
+    for size in SIZES:
+        user_id = seed(conn, size)
+        event = {
+            'httpMethod': 'GET', 'headers': session_headers(user_id),
+            'queryStringParameters': {'user_id': str(user_id)}
+        }
+
+        def legacy():
+            with conn.cursor() as cur:
+                legacy_chat_list(cur, user_id)
+            conn.rollback()
+
+        results.append({'chats': size, 'implementation': 'legacy', **measure(legacy, args.runs)})
+        results.append({'chats': size, 'implementation': 'handler', **measure(lambda: handler(event, None), args.runs)})
+    conn.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'chats':>6} {'implementation':>14} {'queries/req':>12} {'p50 ms':>9} {'p95 ms':>9}")
+    for row in results:
+        print(f"{row['chats']:>6} {row['implementation']:>14} {row['queries_per_request']:>12.0f} "
+              f"{row['p50_ms']:>9.2f} {row['p95_ms']:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
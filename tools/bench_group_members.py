@@ -0,0 +1,140 @@
+'''
+Benchmark group membership writes for groups of 10, 1000 and 10000
+members. Reports statements per operation and latency for:
+
+  create  - backend/chats create_group (one set-based insert) next to the
+            previous loop of one formatted INSERT per member
+  add     - backend/groups add_members into an empty group
+  remove  - backend/groups remove_members next to one remove_member
+            request per member, the only option before the bulk API
+
+Usage: DATABASE_URL=postgres://... python tools/bench_group_members.py [--runs 3] [--json]
+The target database is wiped and re-created from db_migrations.
+'''
+
+import argparse
+import json
+import statistics
+import time
+from typing import Any, Callable, Dict, List
+
+from psycopg2.extras import execute_values
+
+from common import CountingCursor, connect, count_queries, load_handler, percentile, reset_schema, session_headers
+
+SIZES = (10, 1000, 10000)
+
+
+def seed_users(conn, count: int) -> List[int]:
+    with conn.cursor() as cur:
+        rows = execute_values(
+            cur,
+            "INSERT INTO users (username, password, nickname) VALUES %s RETURNING id",
+            [(f'member{i}', 'x', f'Member {i}') for i in range(count + 1)],
+            fetch=True,
+            page_size=1000
+        )
+    conn.commit()
+    return [row[0] for row in rows]
+
+
+def legacy_create_group(conn, creator_id: int, member_ids: List[int]) -> None:
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO chats (name, is_group, creator_id) VALUES (%s, TRUE, %s) RETURNING id",
+            ('Legacy group', creator_id)
+        )
+        chat_id = cur.fetchone()[0]
+        cur.execute(f"INSERT INTO chat_participants (chat_id, user_id) VALUES ({chat_id}, {creator_id})")
+        for member_id in member_ids:
+            cur.execute(f"INSERT INTO chat_participants (chat_id, user_id) VALUES ({chat_id}, {member_id})")
+        cur.execute("""
+            INSERT INTO user_inbox (user_id, chat_id, is_group, creator_id, display_name, display_avatar)
+            SELECT cp.user_id, c.id, TRUE, c.creator_id, c.name, c.avatar
+            FROM chat_participants cp
+            JOIN chats c ON c.id = cp.chat_id
+            WHERE cp.chat_id = %s
+        """, (chat_id,))
+    conn.commit()
+
+
+def call(handler, method: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    event = {'httpMethod': method, 'headers': session_headers(body['user_id']), 'body': json.dumps(body)}
+    response = handler(event, None)
+    if response['statusCode'] != 200:
+        raise RuntimeError(f"{body.get('action')} failed: {response['body']}")
+    return json.loads(response['body'])
+
+
+def measure(operation: Callable[[Any], Any], runs: int, setup: Callable[[], Any] = lambda: None) -> Dict[str, float]:
+    latencies = []
+    queries = []
+    for _ in range(runs):
+        state = setup()
+        CountingCursor.reset()
+        started = time.perf_counter()
+        operation(state)
+        latencies.append((time.perf_counter() - started) * 1000)
+        queries.append(CountingCursor.stats['queries'])
+    return {
+        'queries_per_operation': statistics.mean(queries),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    count_queries()
+    conn = connect()
+    reset_schema(conn)
+    user_ids = seed_users(conn, max(SIZES))
+    creator_id, everyone = user_ids[0], user_ids[1:]
+    chats = load_handler('chats')
+    groups = load_handler('groups')
+
+    def create_group(members: List[int]) -> int:
+        return call(chats, 'POST', {
+            'action': 'create_group', 'user_id': creator_id, 'name': 'Bench', 'member_ids': members
+        })['chat_id']
+
+    def change_members(action: str, chat_id: int, members: List[int]) -> None:
+        call(groups, 'PUT', {'action': action, 'chat_id': chat_id, 'user_id': creator_id, 'member_ids': members})
+
+    results = []
+    for size in SIZES:
+        members = everyone[:size]
+
+        def remove_one_by_one(chat_id: int) -> None:
+            for member_id in members:
+                call(groups, 'PUT', {'action': 'remove_member', 'chat_id': chat_id, 'user_id': creator_id, 'member_id': member_id})
+
+        cases = [
+            ('create', 'legacy', lambda _: legacy_create_group(conn, creator_id, members), None),
+            ('create', 'handler', lambda _: create_group(members), None),
+            ('add', 'handler', lambda chat_id: change_members('add_members', chat_id, members), lambda: create_group([])),
+            ('remove', 'per-member', remove_one_by_one, lambda: create_group(members)),
+            ('remove', 'handler', lambda chat_id: change_members('remove_members', chat_id, members), lambda: create_group(members)),
+        ]
+        for operation, implementation, run, setup in cases:
+            results.append({
+                'members': size, 'operation': operation, 'implementation': implementation,
+                **measure(run, args.runs, setup or (lambda: None))
+            })
+    conn.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'members':>8} {'operation':>10} {'implementation':>15} {'queries/op':>11} {'p50 ms':>10} {'p95 ms':>10}")
+    for row in results:
+        print(f"{row['members']:>8} {row['operation']:>10} {row['implementation']:>15} "
+              f"{row['queries_per_operation']:>11.0f} {row['p50_ms']:>10.2f} {row['p95_ms']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+'''
+Micro-benchmark for voice-note multipart parsing: the byte-level parser
+in backend/messages/multipart.py against the previous string-splitting
+code, reproduced here. Reports parse time and tracemalloc peak memory
+for 100 KB to 10 MB payloads, starting from the base64 event body the
+platform delivers. Also checks that arbitrary binary audio survives the
+round trip; the old code raised on non-UTF-8 bytes.
+
+Usage: python tools/bench_multipart.py [--runs 5]
+'''
+
+import argparse
+import base64
+import json
+import os
+import time
+import tracemalloc
+
+from common import load_module
+
+SIZES = (100 * 1024, 1024 * 1024, 5 * 1024 * 1024, 10 * 1024 * 1024)
+BOUNDARY = '----pchatbench7MA4YWxkTrZu0gW'
+
+
+def build_body(audio: bytes) -> str:
+    fields = b''.join(
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        for name, value in (('chat_id', '1'), ('sender_id', '1'), ('duration', '4.2'))
+    )
+    audio_part = (
+        f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="audio"; filename="voice.webm"\r\n'
+        'Content-Type: audio/webm\r\n\r\n'
+    ).encode() + audio + b'\r\n'
+    return base64.b64encode(fields + audio_part + f'--{BOUNDARY}--\r\n'.encode()).decode()
+
+
+def legacy_parse(body: str) -> bytes:
+    body = base64.b64decode(body).decode('utf-8')
+    audio = None
+    for part in body.split(f'--{BOUNDARY}'):
+        if 'name="audio"' in part and 'filename=' in part:
+            audio_content = part.split('\r\n\r\n', 1)[1]
+            if audio_content.endswith('\r\n'):
+                audio_content = audio_content[:-2]
+            audio = base64.b64encode(audio_content.encode('latin-1')).decode('utf-8')
+    return audio
+
+
+def make_parser(multipart):
+    def parse(body: str) -> memoryview:
+        raw = base64.b64decode(body)
+        for part in multipart.iter_parts(raw, BOUNDARY.encode()):
+            if part.name == 'audio':
+                return part.data
+    return parse
+
+
+def measure(parse, body: str, runs: int):
+    times = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        parse(body)
+        times.append((time.perf_counter() - started) * 1000)
+    tracemalloc.start()
+    parse(body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(min(times), 2), round(peak / 1024 / 1024, 2)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    multipart = load_module('messages', 'multipart')
+    parse = make_parser(multipart)
+
+    binary = os.urandom(64 * 1024)
+    assert bytes(parse(build_body(binary))) == binary, 'binary payload did not round-trip'
+    try:
+        legacy_parse(build_body(binary))
+        legacy_binary = 'ok'
+    except UnicodeDecodeError:
+        legacy_binary = 'UnicodeDecodeError'
+
+    results = []
+    for size in SIZES:
+        # ASCII payload so the legacy path can run at all
+        body = build_body(bytes(b % 128 for b in os.urandom(size)))
+        body_mb = round(len(body) / 1024 / 1024, 2)
+        for name, fn in (('legacy', legacy_parse), ('bytes', parse)):
+            ms, peak_mb = measure(fn, body, args.runs)
+            results.append({'audio_bytes': size, 'body_mb': body_mb, 'parser': name, 'ms': ms, 'peak_mb': peak_mb})
+
+    if args.json:
+        print(json.dumps({'legacy_binary_audio': legacy_binary, 'results': results}, indent=2))
+        return
+    print(f'legacy parser on binary audio: {legacy_binary}')
+    print(f"{'audio KB':>9} {'body MB':>8} {'parser':>7} {'ms':>9} {'peak MB':>8}")
+    for row in results:
+        print(f"{row['audio_bytes'] // 1024:>9} {row['body_mb']:>8} {row['parser']:>7} {row['ms']:>9} {row['peak_mb']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+'''
+Measure connection reuse under concurrent pollers. Each poller thread
+calls the messages GET handler in a loop, as ChatView does every second,
+once with the warm pool and once with idle connections closed after
+every request, which is what connect-per-invocation used to cost.
+
+Usage: DATABASE_URL=postgres://... python tools/bench_pool.py [--pollers 20] [--seconds 10]
+The target database is wiped and re-created from db_migrations.
+'''
+
+import argparse
+import inspect
+import json
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from common import connect, load_handler, percentile, reset_schema, session_headers
+
+
+def seed(conn) -> Tuple[int, int]:
+    with conn.cursor() as cur:
+        cur.execute("INSERT INTO users (username, password, nickname) VALUES ('poller', 'x', 'Poller') RETURNING id")
+        user_id = cur.fetchone()[0]
+        cur.execute("INSERT INTO chats (is_group) VALUES (FALSE) RETURNING id")
+        chat_id = cur.fetchone()[0]
+        cur.execute("INSERT INTO chat_participants (chat_id, user_id) VALUES (%s, %s)", (chat_id, user_id))
+        cur.execute(
+            "INSERT INTO messages (chat_id, sender_id, content) SELECT %s, %s, 'm' || n FROM generate_series(1, 200) n",
+            (chat_id, user_id)
+        )
+    conn.commit()
+    return user_id, chat_id
+
+
+def run(handler, user_id: int, chat_id: int, pollers: int, seconds: float, reuse: bool) -> Dict[str, float]:
+    pool = inspect.unwrap(handler).__globals__['db']
+    pool.close_idle()
+    event = {
+        'httpMethod': 'GET', 'headers': session_headers(user_id),
+        'queryStringParameters': {'chat_id': str(chat_id)}
+    }
+    latencies: List[float] = []
+    lock = threading.Lock()
+    stop_at = time.monotonic() + seconds
+
+    def poll():
+        local = []
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            handler(event, None)
+            if not reuse:
+                pool.close_idle()
+            local.append((time.perf_counter() - started) * 1000)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=poll) for _ in range(pollers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    pool.close_idle()
+
+    return {
+        'mode': 'pooled' if reuse else 'connect-per-request',
+        'requests': len(latencies),
+        'throughput_rps': round(len(latencies) / seconds, 1),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p95_ms': round(percentile(latencies, 95), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pollers', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    os.environ['DB_POOL_SIZE'] = str(args.pollers)
+    conn = connect()
+    reset_schema(conn)
+    user_id, chat_id = seed(conn)
+    conn.close()
+    handler = load_handler('messages')
+
+    results = [run(handler, user_id, chat_id, args.pollers, args.seconds, reuse) for reuse in (False, True)]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for row in results:
+        print(f"{row['mode']:>20}: {row['requests']} requests, {row['throughput_rps']} req/s, "
+              f"p50 {row['p50_ms']} ms, p95 {row['p95_ms']} ms, p99 {row['p99_ms']} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+'''
+Shared helpers for local tooling: load cloud-function handlers from
+backend/<name>/index.py and prepare a scratch Postgres schema.
+All scripts expect DATABASE_URL to point at a disposable database.
+'''
+
+import importlib.util
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+import psycopg2
+import psycopg2.extensions
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+BACKEND_DIR = ROOT_DIR / 'backend'
+MIGRATIONS_DIR = ROOT_DIR / 'db_migrations'
+
+# Handlers need SESSION_SECRET for any token they check, even on
+# requests sent before a tool signs anyone in, so local runs that do not
+# set it get a throwaway one up front, shared by the tools and the
+# handlers loaded into the same process
+os.environ.setdefault('SESSION_SECRET', 'local-tooling')
+
+
+def load_handler(name: str) -> Callable[[Dict[str, Any], Any], Dict[str, Any]]:
+    '''Import backend/<name>/index.py in isolation and return its handler.
+
+    Every function directory is deployed on its own and may ship sibling
+    modules with the same file names, so those are evicted from
+    sys.modules before each load.
+    '''
+    func_dir = BACKEND_DIR / name
+    sys.path.insert(0, str(func_dir))
+    try:
+        for sibling in func_dir.glob('*.py'):
+            sys.modules.pop(sibling.stem, None)
+        spec = importlib.util.spec_from_file_location(f'pchat_backend_{name}', func_dir / 'index.py')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(func_dir))
+    return module.handler
+
+
+def load_module(function: str, name: str) -> Any:
+    '''Import a helper module (db, media, ...) from one function directory.
+
+    The directory is on sys.path while the module runs so that the
+    siblings it imports (media needs images) resolve as they do deployed.
+    '''
+    func_dir = BACKEND_DIR / function
+    sys.path.insert(0, str(func_dir))
+    try:
+        spec = importlib.util.spec_from_file_location(f'pchat_backend_{function}_{name}', func_dir / f'{name}.py')
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(str(func_dir))
+    return module
+
+
+def session_headers(user_id: int) -> Dict[str, str]:
+    '''Headers of a request signed in as a freshly seeded user (session epoch 0).'''
+    return {'Authorization': f"Bearer {load_module('auth', 'session').issue(user_id, 0)}"}
+
+
+def connect() -> psycopg2.extensions.connection:
+    return psycopg2.connect(os.environ['DATABASE_URL'])
+
+
+def reset_schema(conn: psycopg2.extensions.connection) -> None:
+    '''Drop everything in the public schema and apply db_migrations in order.'''
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA public CASCADE')
+        cur.execute('CREATE SCHEMA public')
+        for migration in sorted(MIGRATIONS_DIR.glob('V*.sql')):
+            cur.execute(migration.read_text())
+    conn.commit()
+
+
+def backfill_inbox(conn: psycopg2.extensions.connection) -> None:
+    '''Populate user_inbox and chats.last_change_seq for rows seeded
+    directly, bypassing the handlers.'''
+    with conn.cursor() as cur:
+        cur.execute((MIGRATIONS_DIR / 'V0006__create_user_inbox.sql').read_text())
+        cur.execute((MIGRATIONS_DIR / 'V0018__add_chat_last_change_seq.sql').read_text())
+    conn.commit()
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    '''Cursor that records how many statements ran and for how long.
+
+    `stats` is process-wide; `thread_queries()` counts only the calling
+    thread's statements, for attributing queries to concurrent requests.
+    '''
+
+    stats: Dict[str, float] = {'queries': 0, 'seconds': 0.0}
+    _local = threading.local()
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            CountingCursor.stats['queries'] += 1
+            CountingCursor.stats['seconds'] += time.perf_counter() - started
+            CountingCursor._local.queries = CountingCursor.thread_queries() + 1
+
+    @classmethod
+    def thread_queries(cls) -> int:
+        return getattr(cls._local, 'queries', 0)
+
+    @classmethod
+    def reset(cls) -> None:
+        cls.stats = {'queries': 0, 'seconds': 0.0}
+
+
+def count_queries() -> None:
+    '''Make every psycopg2.connect() in this process hand out CountingCursors.'''
+    original = psycopg2.connect
+    if getattr(original, 'counting', False):
+        return
+
+    def counting_connect(*args, **kwargs):
+        kwargs.setdefault('cursor_factory', CountingCursor)
+        return original(*args, **kwargs)
+
+    counting_connect.counting = True
+    psycopg2.connect = counting_connect
+
+
+def percentile(samples: List[float], pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
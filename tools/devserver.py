@@ -0,0 +1,98 @@
+'''
+Local HTTP server that hosts the backend cloud functions, for testing
+long-polling and other request flows against a local Postgres.
+
+Routes /<function> (auth, batch, chats, groups, messages, profile) to
+backend/<function>/index.py and serves MEDIA_ROOT under /media when
+MEDIA_STORAGE=local. Requests run on their own threads, so held
+long-poll requests do not block writers.
+For load tests and profiling use tools/asgi_server.py, which bounds
+concurrency and can simulate cold starts.
+
+Usage: DATABASE_URL=postgres://... python tools/devserver.py [--port 8000]
+'''
+
+import argparse
+import base64
+import json
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qsl, urlsplit
+
+from common import BACKEND_DIR, load_handler
+
+TEXT_TYPES = ('application/json', 'text/', 'application/x-www-form-urlencoded')
+
+
+def build_event(method: str, path: str, headers, body: bytes) -> dict:
+    url = urlsplit(path)
+    headers = {key.lower(): value for key, value in headers.items()}
+    content_type = headers.get('content-type', '')
+    is_text = not body or content_type.startswith(TEXT_TYPES)
+    return {
+        'httpMethod': method,
+        'path': url.path,
+        'headers': headers,
+        'queryStringParameters': dict(parse_qsl(url.query)),
+        'body': body.decode('utf-8') if is_text else base64.b64encode(body).decode('ascii'),
+        'isBase64Encoded': not is_text,
+    }
+
+
+def make_request_handler(handlers: dict, media_root: Path):
+    class RequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _dispatch(self):
+            name = urlsplit(self.path).path.strip('/').split('/')[0]
+            if self.command == 'GET' and name == 'media':
+                return self._serve_media()
+            handler = handlers.get(name)
+            if handler is None:
+                return self._send(404, {'Content-Type': 'application/json'}, json.dumps({'error': 'Unknown function'}).encode())
+
+            length = int(self.headers.get('Content-Length') or 0)
+            event = build_event(self.command, self.path, self.headers, self.rfile.read(length))
+            response = handler(event, None)
+            body = response.get('body') or ''
+            body = base64.b64decode(body) if response.get('isBase64Encoded') else body.encode('utf-8')
+            self._send(response.get('statusCode', 200), response.get('headers') or {}, body)
+
+        def _serve_media(self):
+            path = (media_root / urlsplit(self.path).path[len('/media/'):]).resolve()
+            if media_root not in path.parents or not path.is_file():
+                return self._send(404, {}, b'')
+            self._send(200, {'Cache-Control': 'public, max-age=31536000, immutable'}, path.read_bytes())
+
+        def _send(self, status: int, headers: dict, body: bytes):
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        do_GET = do_POST = do_PUT = do_DELETE = do_OPTIONS = _dispatch
+
+    return RequestHandler
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    handlers = {
+        path.parent.name: load_handler(path.parent.name)
+        for path in sorted(BACKEND_DIR.glob('*/index.py'))
+    }
+    media_root = Path(os.environ.get('MEDIA_ROOT', '/tmp/pchat-media')).resolve()
+    server = ThreadingHTTPServer((args.host, args.port), make_request_handler(handlers, media_root))
+    print(f"Serving {', '.join(handlers)} on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
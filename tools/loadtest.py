@@ -0,0 +1,426 @@
+'''
+Replay the real client traffic mix against the backend and report, per
+endpoint, p50/p95/p99 latency, throughput, statements per request and
+bytes per response.
+
+Every simulated client is one user with the app open on one of their
+chats, doing what ChatView and ChatList do:
+
+  messages.poll        chat history since the last cursor, every --view-interval s
+  chats.poll           chat list since the last version, every --list-interval s
+  messages.send        a text message, on average every --send-every s
+  messages.mark_read   after a poll returns someone else's message
+  messages.open        switch to another chat and load its first page,
+                       on average every --open-every s
+  groups.participants  member list when the opened chat is a group
+  messages.history     the next older page, on average every --history-every s
+  messages.search      a full-text search, on average every --search-every s
+
+Requests carry a session token for their user and polls carry
+If-None-Match, like the browser does. Requests are scheduled
+open-loop and run on --workers threads; latency is measured from the
+moment a request was due, so queueing under overload shows up in it.
+The first --warmup seconds are not recorded.
+
+By default handlers run in-process, which is also what makes statement
+counts possible. --url sends the same traffic over HTTP instead, e.g. to
+tools/asgi_server.py; export the server's SESSION_SECRET for that.
+
+Usage: DATABASE_URL=postgres://... python tools/loadtest.py [--clients 1000] [--duration 60]
+         [--seed-users 1000] [--reuse] [--output results.json] [--compare baseline.json]
+Unless --reuse is given, the database is wiped and seeded by seed_dataset.py.
+'''
+
+import argparse
+import base64
+import gzip
+import heapq
+import http.client
+import itertools
+import json
+import os
+import random
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+
+from common import ROOT_DIR, CountingCursor, connect, count_queries, load_handler, percentile, session_headers
+from devserver import build_event
+from seed_dataset import WORDS, seed, sentence
+
+FUNCTIONS = ('chats', 'groups', 'messages')
+
+
+class Result(NamedTuple):
+    status: int
+    headers: Dict[str, str]
+    body: bytes
+    queries: Optional[int]
+
+
+def decode_body(result: Result) -> bytes:
+    '''Response bytes as the handler encoded them, before any Content-Encoding.'''
+    coding = result.headers.get('content-encoding')
+    if coding == 'gzip':
+        return gzip.decompress(result.body)
+    if coding == 'br':
+        import brotli
+
+        return brotli.decompress(result.body)
+    return result.body
+
+
+class InProcessTarget:
+    '''Call the handlers directly, counting statements per request.'''
+
+    counts_queries = True
+
+    def __init__(self):
+        count_queries()
+        self.handlers = {name: load_handler(name) for name in FUNCTIONS}
+
+    def request(self, function: str, method: str, params: Dict[str, Any], body: Optional[dict],
+                headers: Dict[str, str]) -> Result:
+        raw = json.dumps(body).encode('utf-8') if body is not None else b''
+        if raw:
+            headers = {**headers, 'Content-Type': 'application/json'}
+        event = build_event(method, f'/{function}?{urlencode(params)}', headers, raw)
+        before = CountingCursor.thread_queries()
+        response = self.handlers[function](event, None)
+        payload = response.get('body') or ''
+        if response.get('isBase64Encoded'):
+            payload = base64.b64decode(payload)
+        return Result(
+            response.get('statusCode', 200),
+            {key.lower(): value for key, value in (response.get('headers') or {}).items()},
+            payload.encode('utf-8') if isinstance(payload, str) else payload,
+            CountingCursor.thread_queries() - before
+        )
+
+
+class HttpTarget:
+    '''Send requests to a running server, one keep-alive connection per worker.'''
+
+    counts_queries = False
+
+    def __init__(self, url: str):
+        self.url = urlsplit(url)
+        self.local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=60)
+        return self.local.connection
+
+    def request(self, function: str, method: str, params: Dict[str, Any], body: Optional[dict],
+                headers: Dict[str, str]) -> Result:
+        raw = json.dumps(body).encode('utf-8') if body is not None else None
+        if raw is not None:
+            headers = {**headers, 'Content-Type': 'application/json'}
+        path = f"{self.url.path.rstrip('/')}/{function}?{urlencode(params)}"
+        connection = self._connection()
+        try:
+            connection.request(method, path, body=raw, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            self.local.connection = None
+            raise
+        return Result(response.status, {key.lower(): value for key, value in response.getheaders()}, data, None)
+
+
+class Recorder:
+    def __init__(self, record_from: float):
+        self.record_from = record_from
+        self.samples: Dict[str, List[Tuple[float, int, int, Optional[int]]]] = {}
+        self.lock = threading.Lock()
+
+    def add(self, endpoint: str, due: float, latency_ms: float, status: int, size: int,
+            queries: Optional[int]) -> None:
+        if due < self.record_from:
+            return
+        with self.lock:
+            self.samples.setdefault(endpoint, []).append((latency_ms, status, size, queries))
+
+    def summary(self, seconds: float) -> Dict[str, Dict[str, Any]]:
+        report = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            latencies = [sample[0] for sample in samples]
+            queries = [sample[3] for sample in samples if sample[3] is not None]
+            report[endpoint] = {
+                'requests': len(samples),
+                'throughput_rps': round(len(samples) / seconds, 2),
+                'p50_ms': round(percentile(latencies, 50), 2),
+                'p95_ms': round(percentile(latencies, 95), 2),
+                'p99_ms': round(percentile(latencies, 99), 2),
+                'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+                'bytes_per_response': round(sum(sample[2] for sample in samples) / len(samples)),
+                'not_modified': sum(1 for sample in samples if sample[1] == 304),
+                'errors': sum(1 for sample in samples if sample[1] >= 500),
+            }
+        return report
+
+
+class Scheduler:
+    '''Open-loop dispatcher: hands due tasks to the worker pool.'''
+
+    def __init__(self, executor: ThreadPoolExecutor):
+        self.executor = executor
+        self.heap: List[Tuple[float, int, Callable[[float], None]]] = []
+        self.order = itertools.count()
+        self.changed = threading.Condition()
+
+    def add(self, due: float, task: Callable[[float], None]) -> None:
+        with self.changed:
+            heapq.heappush(self.heap, (due, next(self.order), task))
+            self.changed.notify()
+
+    def run(self, until: float) -> None:
+        while True:
+            with self.changed:
+                now = time.monotonic()
+                if now >= until:
+                    return
+                if not self.heap or self.heap[0][0] > now:
+                    next_due = self.heap[0][0] if self.heap else until
+                    self.changed.wait(min(next_due, until) - now)
+                    continue
+                due, _, task = heapq.heappop(self.heap)
+            self.executor.submit(task, due)
+
+
+class Client:
+    '''State one open app keeps between requests.'''
+
+    def __init__(self, user_id: int, chats: List[Tuple[int, bool]], rng: random.Random):
+        self.user_id = user_id
+        self.headers = session_headers(user_id)
+        self.chats = chats
+        self.rng = rng
+        self.chat_id, self.is_group = rng.choice(chats)
+        self.cursor: Optional[int] = None
+        self.oldest: Optional[int] = None
+        self.version: Optional[str] = None
+        self.read_reported = 0
+        self.etags: Dict[str, str] = {}
+
+
+class LoadTest:
+    def __init__(self, target, recorder: Recorder, scheduler: Scheduler, args: argparse.Namespace):
+        self.target = target
+        self.recorder = recorder
+        self.scheduler = scheduler
+        self.args = args
+        self.stop_at = 0.0
+
+    def call(self, client: Client, endpoint: str, due: float, function: str, method: str,
+             params: Dict[str, Any], body: Optional[dict] = None, etag_key: Optional[str] = None) -> Optional[Any]:
+        headers = dict(client.headers)
+        if self.args.accept_encoding:
+            headers['Accept-Encoding'] = self.args.accept_encoding
+        if etag_key and client.etags.get(etag_key):
+            headers['If-None-Match'] = client.etags[etag_key]
+        try:
+            result = self.target.request(function, method, params, body, headers)
+        except Exception:
+            self.recorder.add(endpoint, due, (time.monotonic() - due) * 1000, 599, 0, None)
+            return None
+        self.recorder.add(endpoint, due, (time.monotonic() - due) * 1000, result.status, len(result.body),
+                          result.queries)
+        if etag_key and result.headers.get('etag'):
+            client.etags[etag_key] = result.headers['etag']
+        if result.status != 200:
+            return None
+        return json.loads(decode_body(result))
+
+    def every(self, interval: Callable[[], float], action: Callable[[float], None]) -> None:
+        '''Run `action` repeatedly; the next run is due one interval after the previous was.'''
+        def task(due: float) -> None:
+            action(due)
+            next_due = max(due + interval(), time.monotonic())
+            if next_due < self.stop_at:
+                self.scheduler.add(next_due, task)
+
+        self.scheduler.add(time.monotonic() + interval() * random.random(), task)
+
+    def start(self, client: Client) -> None:
+        args = self.args
+        rng = client.rng
+        self.every(lambda: args.view_interval, lambda due: self.poll_chat(client, due))
+        self.every(lambda: args.list_interval, lambda due: self.poll_list(client, due))
+        self.every(lambda: rng.expovariate(1 / args.send_every), lambda due: self.send(client, due))
+        self.every(lambda: rng.expovariate(1 / args.open_every), lambda due: self.open_chat(client, due))
+        self.every(lambda: rng.expovariate(1 / args.history_every), lambda due: self.older_page(client, due))
+        self.every(lambda: rng.expovariate(1 / args.search_every), lambda due: self.search(client, due))
+
+    def poll_chat(self, client: Client, due: float) -> None:
+        params = {'chat_id': client.chat_id, 'user_id': client.user_id}
+        if client.cursor is not None:
+            params['since'] = client.cursor
+        data = self.call(client, 'messages.poll', due, 'messages', 'GET', params,
+                         etag_key=f'chat:{client.chat_id}')
+        if data is None:
+            return
+        client.cursor = max(client.cursor or 0, data.get('cursor') or 0)
+        newest = max((m['id'] for m in data['messages'] if m.get('sender_id') != client.user_id), default=0)
+        if newest > client.read_reported:
+            client.read_reported = newest
+            self.call(client, 'messages.mark_read', time.monotonic(), 'messages', 'PUT', {}, {
+                'action': 'mark_read', 'chat_id': client.chat_id, 'user_id': client.user_id, 'message_id': newest
+            })
+
+    def poll_list(self, client: Client, due: float) -> None:
+        params = {'user_id': client.user_id}
+        if client.version is not None:
+            params['since'] = client.version
+        data = self.call(client, 'chats.poll', due, 'chats', 'GET', params, etag_key='chats')
+        if data is not None:
+            client.version = data.get('version')
+
+    def send(self, client: Client, due: float) -> None:
+        self.call(client, 'messages.send', due, 'messages', 'POST', {}, {
+            'chat_id': client.chat_id, 'sender_id': client.user_id, 'content': sentence(client.rng)
+        })
+
+    def open_chat(self, client: Client, due: float) -> None:
+        client.chat_id, client.is_group = client.rng.choice(client.chats)
+        client.cursor = client.oldest = None
+        client.read_reported = 0
+        data = self.call(client, 'messages.open', due, 'messages', 'GET',
+                         {'chat_id': client.chat_id, 'user_id': client.user_id})
+        if data is not None:
+            client.cursor = data.get('cursor')
+            client.oldest = min((m['id'] for m in data['messages']), default=None)
+        if client.is_group:
+            self.call(client, 'groups.participants', time.monotonic(), 'groups', 'GET', {'chat_id': client.chat_id},
+                      etag_key=f'members:{client.chat_id}')
+
+    def older_page(self, client: Client, due: float) -> None:
+        if client.oldest is None:
+            return
+        data = self.call(client, 'messages.history', due, 'messages', 'GET',
+                         {'chat_id': client.chat_id, 'before_id': client.oldest})
+        if data is not None and data['messages']:
+            client.oldest = min(m['id'] for m in data['messages'])
+
+    def search(self, client: Client, due: float) -> None:
+        self.call(client, 'messages.search', due, 'messages', 'GET',
+                  {'q': client.rng.choice(WORDS), 'user_id': client.user_id})
+
+
+def load_clients(conn, count: int, seed_value: int) -> List[Client]:
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT cp.user_id, array_agg(c.id ORDER BY c.id), array_agg(c.is_group ORDER BY c.id)
+            FROM chat_participants cp
+            JOIN chats c ON c.id = cp.chat_id
+            WHERE cp.left_at IS NULL
+            GROUP BY cp.user_id
+            ORDER BY cp.user_id
+            LIMIT %s
+        """, (count,))
+        rows = cur.fetchall()
+    conn.rollback()
+    return [
+        Client(user_id, list(zip(chat_ids, flags)), random.Random(seed_value * 1000003 + user_id))
+        for user_id, chat_ids, flags in rows
+    ]
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]]) -> None:
+    print(f"{'endpoint':<20} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} "
+          f"{'queries':>8} {'bytes':>8} {'304':>6} {'errors':>6}")
+    for endpoint, row in report['endpoints'].items():
+        queries = '-' if row['queries_per_request'] is None else f"{row['queries_per_request']:.1f}"
+        print(f"{endpoint:<20} {row['throughput_rps']:>8.1f} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} "
+              f"{row['p99_ms']:>8.1f} {queries:>8} {row['bytes_per_response']:>8} "
+              f"{row['not_modified']:>6} {row['errors']:>6}")
+        previous = (baseline or {}).get('endpoints', {}).get(endpoint)
+        if previous:
+            print(f"{'  vs baseline':<20} {row['throughput_rps'] - previous['throughput_rps']:>+8.1f} "
+                  f"{row['p50_ms'] - previous['p50_ms']:>+8.1f} {row['p95_ms'] - previous['p95_ms']:>+8.1f} "
+                  f"{row['p99_ms'] - previous['p99_ms']:>+8.1f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--duration', type=float, default=60, help='seconds of recorded traffic')
+    parser.add_argument('--warmup', type=float, default=10, help='seconds of unrecorded traffic first')
+    parser.add_argument('--workers', type=int, default=64)
+    parser.add_argument('--view-interval', type=float, default=1)
+    parser.add_argument('--list-interval', type=float, default=3)
+    parser.add_argument('--send-every', type=float, default=30)
+    parser.add_argument('--open-every', type=float, default=60)
+    parser.add_argument('--history-every', type=float, default=120)
+    parser.add_argument('--search-every', type=float, default=300)
+    parser.add_argument('--seed-users', type=int, default=1000)
+    parser.add_argument('--seed-years', type=float, default=2)
+    parser.add_argument('--seed-messages-per-chat', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--reuse', action='store_true', help='keep the data already in the database')
+    parser.add_argument('--url', help='target a running server instead of in-process handlers')
+    parser.add_argument('--accept-encoding', help='Accept-Encoding to send, e.g. "gzip, br"; bytes are then counted compressed')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    parser.add_argument('--compare', help='JSON report of an earlier run to diff against')
+    args = parser.parse_args()
+
+    # Handlers share one module-level pool per function across all workers
+    os.environ.setdefault('DB_POOL_SIZE', str(args.workers))
+
+    conn = connect()
+    dataset = None
+    if not args.reuse:
+        dataset = seed(conn, args.seed_users, args.seed_years, args.seed_messages_per_chat, seed_value=args.seed)._asdict()
+    clients = load_clients(conn, args.clients, args.seed)
+    conn.close()
+
+    target = HttpTarget(args.url) if args.url else InProcessTarget()
+    executor = ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='client')
+    scheduler = Scheduler(executor)
+    started = time.monotonic()
+    recorder = Recorder(started + args.warmup)
+    test = LoadTest(target, recorder, scheduler, args)
+    test.stop_at = started + args.warmup + args.duration
+    random.seed(args.seed)
+    for client in clients:
+        test.start(client)
+
+    scheduler.run(test.stop_at)
+    executor.shutdown(wait=True)
+
+    report = {
+        'revision': git_revision(),
+        'finished_at': datetime.now().isoformat(timespec='seconds'),
+        'target': args.url or 'in-process',
+        'clients': len(clients),
+        'dataset': dataset,
+        'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        'endpoints': recorder.summary(args.duration),
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
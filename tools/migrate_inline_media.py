@@ -0,0 +1,74 @@
+'''
+Move inline data: URLs (photos, voice notes, user and group avatars) out
+of Postgres into the configured media store, in small committed batches.
+Identical payloads are stored once. Safe to re-run; it only touches rows
+that still hold a data: URL.
+
+Usage: DATABASE_URL=postgres://... [MEDIA_STORAGE=local] python tools/migrate_inline_media.py [--batch 100]
+'''
+
+import argparse
+
+from common import connect, load_module
+
+# (table, url column, key column)
+COLUMNS = (
+    ('messages', 'photo_url', 'photo_key'),
+    ('messages', 'voice_url', 'voice_key'),
+    ('users', 'avatar', 'avatar_key'),
+    ('chats', 'avatar', 'avatar_key'),
+)
+
+
+def migrate_column(conn, media, table: str, url_column: str, key_column: str, batch: int) -> int:
+    moved = 0
+    while True:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"SELECT id, {url_column} FROM {table} WHERE {url_column} LIKE 'data:%%' ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED",
+                (batch,)
+            )
+            rows = cur.fetchall()
+            for row_id, value in rows:
+                url, key = media.store_data_url(cur, value)
+                cur.execute(
+                    f"UPDATE {table} SET {url_column} = %s, {key_column} = %s WHERE id = %s",
+                    (url, key, row_id)
+                )
+        conn.commit()
+        moved += len(rows)
+        if len(rows) < batch:
+            return moved
+
+
+def refresh_inbox_avatars(conn) -> None:
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE user_inbox i SET display_avatar = u.avatar
+            FROM users u
+            WHERE i.other_user_id = u.id AND i.display_avatar LIKE 'data:%%'
+        """)
+        cur.execute("""
+            UPDATE user_inbox i SET display_avatar = c.avatar
+            FROM chats c
+            WHERE i.is_group AND i.chat_id = c.id AND i.display_avatar LIKE 'data:%%'
+        """)
+    conn.commit()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch', type=int, default=100)
+    args = parser.parse_args()
+
+    media = load_module('messages', 'media')
+    conn = connect()
+    for table, url_column, key_column in COLUMNS:
+        moved = migrate_column(conn, media, table, url_column, key_column, args.batch)
+        print(f'{table}.{url_column}: moved {moved}')
+    refresh_inbox_avatars(conn)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+'''
+Drive account deletion jobs (see backend/profile/deletion.py): purge the
+messages, memberships, emptied chats and media of deleted accounts in
+committed batches, printing each job's progress. Several workers may run
+at once; each batch locks its job, so they never share one. Between jobs
+the blobs of messages their senders deleted are purged as well.
+
+  --once     run until no job is left, then exit (tests, cron)
+  --status   print every unfinished job and exit
+
+Usage: DATABASE_URL=postgres://... [MEDIA_STORAGE=local] python tools/purge_accounts.py [--batch 500] [--interval 5] [--once] [--status]
+'''
+
+import argparse
+import time
+
+from common import connect, load_module
+
+
+def describe(job) -> str:
+    line = (
+        f"job {job['id']} (user {job['user_id']}): {job['stage']}, "
+        f"{job['messages_deleted']} messages, {job['chats_left']} chats left, "
+        f"{job['chats_deleted']} chats and {job['media_deleted']} media deleted"
+    )
+    if job['last_error']:
+        line += f", attempt {job['attempts']} failed: {job['last_error'].strip().splitlines()[-1]}"
+    return line
+
+
+def print_status(conn, deletion) -> None:
+    with conn.cursor() as cur:
+        cur.execute("SELECT id FROM deletion_jobs WHERE finished_at IS NULL ORDER BY id")
+        for (job_id,) in cur.fetchall():
+            print(describe(deletion.status(cur, job_id)))
+    conn.rollback()
+
+
+def purge_released(conn, deletion, batch: int) -> int:
+    '''Purge released message media until the queue is empty or a batch
+    fails; returns how many keys were checked.'''
+    total = 0
+    try:
+        while True:
+            taken = deletion.purge_released(conn, batch)
+            if not taken:
+                break
+            total += taken
+    except Exception as error:
+        print(f'released media: batch failed: {error}')
+    if total:
+        print(f'released media: {total} keys checked')
+    return total
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--interval', type=float, default=5.0, help='seconds to sleep while idle')
+    parser.add_argument('--once', action='store_true')
+    parser.add_argument('--status', action='store_true')
+    args = parser.parse_args()
+
+    deletion = load_module('profile', 'deletion')
+    conn = connect()
+    try:
+        if args.status:
+            print_status(conn, deletion)
+            return
+        while True:
+            jobs = deletion.run_pending(conn, args.batch)
+            for job in jobs:
+                print(describe(job))
+            released = purge_released(conn, deletion, args.batch)
+            if args.once:
+                break
+            # Idle, or only failing jobs left to retry
+            if not (jobs or released) or any(job['last_error'] for job in jobs):
+                time.sleep(args.interval)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+'''
+Run the backend/<name>/tests.json cases in-process against a scratch
+database. A case with "session": <user id> is sent with a bearer token for
+that user; cases without one go out unauthenticated.
+
+The schema is reset first, then the auth cases register testuser123
+(user 1). The fixture added after them:
+
+  user 2 testuser456, user 3 testuser789
+  chat 1  group "Test group" of users 1 and 2, with one message from user 2
+  chat 2  personal chat of users 2 and 3, which user 1 is not in
+
+The other functions run in a fixed order so that state-changing cases
+(leaving the group) come last.
+
+Usage: DATABASE_URL=postgres://... python tools/run_function_tests.py [function ...]
+'''
+
+import argparse
+import base64
+import gzip
+import json
+import sys
+from typing import Any, Dict, List
+from urllib.parse import parse_qsl, urlsplit
+
+from common import BACKEND_DIR, backfill_inbox, connect, load_handler, reset_schema, session_headers
+
+ORDER = ('auth', 'profile', 'chats', 'messages', 'batch', 'presence', 'groups')
+TYPE_NAMES = {
+    'array': list, 'object': dict, 'string': str, 'boolean': bool, 'number': (int, float),
+}
+
+
+def seed_fixture(conn) -> None:
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO users (username, password, nickname)
+            VALUES ('testuser456', 'pass456', 'Second User'), ('testuser789', 'pass789', 'Third User')
+        """)
+        cur.execute("INSERT INTO chats (name, is_group, creator_id) VALUES ('Test group', TRUE, 1)")
+        cur.execute("INSERT INTO chats (is_group) VALUES (FALSE)")
+        cur.execute("INSERT INTO chat_participants (chat_id, user_id) VALUES (1, 1), (1, 2), (2, 2), (2, 3)")
+        cur.execute("INSERT INTO direct_chats (user_low, user_high, chat_id) VALUES (2, 3, 2)")
+        cur.execute("INSERT INTO messages (chat_id, sender_id, content) VALUES (1, 2, 'Hello')")
+    conn.commit()
+    backfill_inbox(conn)
+
+
+def build_event(case: Dict[str, Any]) -> Dict[str, Any]:
+    headers = {'content-type': 'application/json'}
+    if case.get('session') is not None:
+        headers.update(session_headers(case['session']))
+    params = case.get('queryStringParameters')
+    if params is None and case.get('path'):
+        params = dict(parse_qsl(urlsplit(case['path']).query))
+    return {
+        'httpMethod': case['method'],
+        'headers': headers,
+        'queryStringParameters': params,
+        'body': json.dumps(case.get('body', {})),
+    }
+
+
+def decode_body(response: Dict[str, Any]) -> Any:
+    body = response.get('body') or ''
+    if response.get('isBase64Encoded'):
+        raw = base64.b64decode(body)
+        if (response.get('headers') or {}).get('Content-Encoding') == 'gzip':
+            raw = gzip.decompress(raw)
+        body = raw.decode('utf-8')
+    return json.loads(body) if body else None
+
+
+def matches(expected: Any, actual: Any) -> bool:
+    '''"partial" matching: every expected key is present; type names such
+    as "array" or "number" match any value of that type.'''
+    if isinstance(expected, dict):
+        return isinstance(actual, dict) and all(
+            key in actual and matches(value, actual[key]) for key, value in expected.items()
+        )
+    if isinstance(expected, str) and expected in TYPE_NAMES:
+        # bool is an int subclass, but true is not a number here
+        if expected == 'number' and isinstance(actual, bool):
+            return False
+        return isinstance(actual, TYPE_NAMES[expected])
+    return expected == actual
+
+
+def run_case(handler, case: Dict[str, Any]) -> List[str]:
+    '''Problems with the handler's answer to one case; empty if it passed.'''
+    response = handler(build_event(case), None)
+    problems = []
+    if response['statusCode'] != case['expectedStatus']:
+        problems.append(f"status {response['statusCode']}, expected {case['expectedStatus']}")
+    if 'expectedBody' in case:
+        body = decode_body(response)
+        if not matches(case['expectedBody'], body):
+            problems.append(f'body {json.dumps(body, ensure_ascii=False, default=str)[:300]}')
+    return problems
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('functions', nargs='*', help=f"default: {' '.join(ORDER)}")
+    args = parser.parse_args()
+    selected = [name for name in ORDER if not args.functions or name in args.functions]
+
+    conn = connect()
+    failures = 0
+    try:
+        reset_schema(conn)
+        for name in ORDER:
+            cases = json.loads((BACKEND_DIR / name / 'tests.json').read_text())['tests']
+            # The fixture expects the auth cases to have created user 1
+            if name in selected or name == 'auth':
+                handler = load_handler(name)
+                for case in cases:
+                    problems = run_case(handler, case)
+                    failures += bool(problems)
+                    print(f"{'FAIL' if problems else 'ok  '} {name}: {case['name']}")
+                    for problem in problems:
+                        print(f'       {problem}')
+            if name == 'auth':
+                seed_fixture(conn)
+    finally:
+        conn.close()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+'''
+Seed a scratch Postgres with a realistic, reproducible chat dataset:
+users with a handful of personal chats each, groups of 3-50 members and
+multi-year message histories that mix text, photo and voice messages.
+Message ids grow with created_at, as they do in production, and every
+month of history gets its own messages partition.
+
+Usage: DATABASE_URL=postgres://... python tools/seed_dataset.py [--users 1000] [--years 2] [--messages-per-chat 100] [--seed 1]
+The target database is wiped and re-created from db_migrations.
+'''
+
+import argparse
+import random
+from datetime import datetime, timedelta
+from typing import Dict, List, NamedTuple, Tuple
+
+from psycopg2.extras import execute_values
+
+from common import MIGRATIONS_DIR, backfill_inbox, connect, reset_schema
+
+WORDS = (
+    'привет как дела сегодня завтра встреча проект отчёт договорились спасибо хорошо '
+    'отлично посмотри файл фото голосовое позвоню вечером утром созвон готово '
+    'hello thanks deploy release meeting review tomorrow today ok sure link draft'
+).split()
+PHOTO_SHARE = 0.04
+VOICE_SHARE = 0.03
+
+
+class Dataset(NamedTuple):
+    users: int
+    chats: int
+    groups: int
+    messages: int
+
+
+def month_starts(first: datetime, last: datetime) -> List[datetime]:
+    month = first.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    months = []
+    while month <= last:
+        months.append(month)
+        month = (month + timedelta(days=32)).replace(day=1)
+    return months
+
+
+def sentence(rng: random.Random) -> str:
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 14))).capitalize()
+
+
+def media_reference(rng: random.Random, extension: str) -> Tuple[str, str]:
+    key = f'media/{rng.getrandbits(256):064x}{extension}'
+    return f'/media/{key}', key
+
+
+def seed_users(cur, count: int) -> List[int]:
+    rows = execute_values(
+        cur,
+        "INSERT INTO users (username, password, nickname) VALUES %s RETURNING id",
+        [(f'user{i}', 'x', f'User {i}') for i in range(count)],
+        fetch=True,
+        page_size=1000
+    )
+    return [row[0] for row in rows]
+
+
+def seed_chats(cur, rng: random.Random, user_ids: List[int], contacts: int, started: datetime,
+               now: datetime) -> Dict[int, Tuple[datetime, List[int]]]:
+    '''Create personal chats and groups; returns chat id -> (created_at, members).'''
+    pairs = set()
+    for user_id in user_ids:
+        for peer in rng.sample(user_ids, min(contacts // 2, len(user_ids) - 1)):
+            if peer != user_id:
+                pairs.add((min(user_id, peer), max(user_id, peer)))
+    groups = []
+    for _ in range(max(1, len(user_ids) // 10)):
+        groups.append(rng.sample(user_ids, min(len(user_ids), rng.randint(3, 50))))
+
+    specs = [(False, None, list(pair)) for pair in sorted(pairs)]
+    specs += [(True, f'Group {index}', members) for index, members in enumerate(groups)]
+    span = (now - started).total_seconds()
+    created = [started + timedelta(seconds=rng.uniform(0, span * 0.8)) for _ in specs]
+
+    rows = execute_values(
+        cur,
+        "INSERT INTO chats (name, is_group, creator_id, created_at) VALUES %s RETURNING id",
+        [(name, is_group, members[0], at) for (is_group, name, members), at in zip(specs, created)],
+        fetch=True,
+        page_size=1000
+    )
+    chats = {row[0]: (at, members) for row, (_, _, members), at in zip(rows, specs, created)}
+    execute_values(
+        cur,
+        "INSERT INTO chat_participants (chat_id, user_id, joined_at) VALUES %s",
+        [(chat_id, member, at) for chat_id, (at, members) in chats.items() for member in members],
+        page_size=5000
+    )
+    return chats
+
+
+def message_row(rng: random.Random, chat_id: int, sender_id: int, at: datetime, now: datetime) -> tuple:
+    kind = rng.random()
+    photo_url = photo_key = caption = voice_url = voice_key = duration = None
+    content = sentence(rng)
+    if kind < PHOTO_SHARE:
+        photo_url, photo_key = media_reference(rng, '.jpg')
+        caption = content if rng.random() < 0.5 else None
+        content = ''
+    elif kind < PHOTO_SHARE + VOICE_SHARE:
+        voice_url, voice_key = media_reference(rng, '.webm')
+        duration = round(rng.uniform(1, 60), 1)
+        content = ''
+    search_text = ' '.join(part for part in (content, caption) if part)
+    return (
+        chat_id, sender_id, content, photo_url, photo_key, caption, voice_url, voice_key, duration,
+        now - at > timedelta(days=1), at, search_text, search_text
+    )
+
+
+def seed_messages(cur, rng: random.Random, chats: Dict[int, Tuple[datetime, List[int]]],
+                  per_chat: int, now: datetime) -> int:
+    '''Insert each chat's history month by month so ids follow time.'''
+    rates = {
+        chat_id: rng.expovariate(1 / per_chat) / max((now - at).total_seconds(), 1)
+        for chat_id, (at, _) in chats.items()
+    }
+    first = min(at for at, _ in chats.values())
+    total = 0
+    for month in month_starts(first, now):
+        cur.execute("SELECT create_messages_partition(%s)", (month.date(),))
+        month_end = min((month + timedelta(days=32)).replace(day=1), now)
+        rows = []
+        for chat_id, (at, members) in chats.items():
+            start = max(at, month)
+            if start >= month_end:
+                continue
+            expected = rates[chat_id] * (month_end - start).total_seconds()
+            count = int(expected) + (rng.random() < expected % 1)
+            seconds = (month_end - start).total_seconds()
+            for _ in range(count):
+                sent = start + timedelta(seconds=rng.uniform(0, seconds))
+                rows.append(message_row(rng, chat_id, rng.choice(members), sent, now))
+        rows.sort(key=lambda row: row[10])
+        execute_values(
+            cur,
+            """INSERT INTO messages (chat_id, sender_id, content, photo_url, photo_key, photo_caption,
+                                     voice_url, voice_key, voice_duration, is_read, created_at, search_vector)
+               VALUES %s""",
+            rows,
+            template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, "
+                     "to_tsvector('russian', %s) || to_tsvector('simple', %s))",
+            page_size=5000
+        )
+        total += len(rows)
+    return total
+
+
+def seed(conn, users: int = 1000, years: float = 2, messages_per_chat: int = 100,
+         contacts: int = 8, seed_value: int = 1) -> Dataset:
+    '''Wipe the database and load a dataset; the same arguments give the same data.'''
+    rng = random.Random(seed_value)
+    now = datetime.now().replace(microsecond=0)
+    started = now - timedelta(days=365 * years)
+
+    reset_schema(conn)
+    with conn.cursor() as cur:
+        user_ids = seed_users(cur, users)
+        chats = seed_chats(cur, rng, user_ids, contacts, started, now)
+        messages = seed_messages(cur, rng, chats, messages_per_chat, now)
+        # Re-run the direct_chats backfill for the seeded personal chats
+        cur.execute((MIGRATIONS_DIR / 'V0011__create_direct_chats.sql').read_text())
+    conn.commit()
+    backfill_inbox(conn)
+
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute('VACUUM ANALYZE')
+    conn.autocommit = False
+
+    groups = sum(1 for _, members in chats.values() if len(members) > 2)
+    return Dataset(users, len(chats), groups, messages)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--years', type=float, default=2)
+    parser.add_argument('--messages-per-chat', type=int, default=100, help='mean history length')
+    parser.add_argument('--contacts', type=int, default=8, help='personal chats per user, on average')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    conn = connect()
+    dataset = seed(conn, args.users, args.years, args.messages_per_chat, args.contacts, args.seed)
+    conn.close()
+    print(f'{dataset.users} users, {dataset.chats} chats ({dataset.groups} groups), {dataset.messages} messages')
+
+
+if __name__ == '__main__':
+    main()